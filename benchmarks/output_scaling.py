@@ -0,0 +1,88 @@
+# Plays the same animation over 1, 2, 4, ... emulated controllers through ShardedOutput and reports the fps every one of them got
+# Every controller drives the same number of LEDs, so more controllers means a wider frame, the fps shouldn't go down with it
+# python benchmarks/output_scaling.py --controllers 1 2 4 8 --leds 150 --protocol udp
+import argparse
+import asyncio
+import json
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "src"))
+
+import numpy as np
+from emulator import EmulatedDevice, StartEmulator
+from frame_buffer import FrameBuffer
+from playback import PlaybackScheduler
+from sharded_output import EvenSegmentMap, ShardedOutput
+
+BASE_PORT = 17800
+
+
+def MakeFrames(led_count, seconds, aps): # Rainbow moving one LED per frame, every frame changes every LED
+    count = int(seconds * aps)
+    hues = (np.arange(count)[:, np.newaxis] + np.arange(led_count)[np.newaxis]) % 256
+    frames = np.stack((hues, (hues + 85) % 256, (hues + 170) % 256), axis=2).astype(np.uint8)
+    return FrameBuffer(np.arange(count, dtype=np.int64) * 1000 // aps, frames)
+
+
+async def RunOnce(controllers, leds, protocol, seconds, aps, first_port):
+    devices = [EmulatedDevice(leds) for _ in range(controllers)]
+    handles = []
+    addresses = []
+    for i, device in enumerate(devices):
+        port = first_port + i
+        handles += await StartEmulator(device, udp_port=port if protocol == "udp" else None, tcp_port=port if protocol == "tcp" else None)
+        addresses.append(("127.0.0.1", port))
+
+    output = ShardedOutput(EvenSegmentMap(addresses, controllers * leds, protocol))
+    frames = MakeFrames(controllers * leds, seconds, aps)
+    try:
+        async with output:
+            for device in devices:
+                device.ResetWindow()
+            stats = await PlaybackScheduler(frames, output, aps).Run()
+            await asyncio.sleep(0.05) # Let the last packets arrive
+            reports = [device.GetReport() for device in devices]
+    finally:
+        for handle in handles:
+            handle.close()
+        await asyncio.sleep(0.05) # Emulator TCP handlers see the connection close and finish
+
+    sent = output.GetStats()
+    return {
+        "controllers": controllers,
+        "frame_leds": controllers * leds,
+        "min_fps": min(report["fps"] for report in reports),
+        "mean_fps": sum(report["fps"] for report in reports) / controllers,
+        "packets_lost": sum(report["packets_lost"] for report in reports),
+        "frames_dropped": sum(link["frames_dropped"] for link in sent.values()),
+        "max_send_ms": max(link["max_send_ms"] for link in sent.values()),
+        "scheduler_dropped": stats.frames_dropped,
+        "mean_lateness_ms": stats.GetMeanLateness() * 1000,
+    }
+
+
+async def Main(args):
+    results = []
+    port = BASE_PORT
+    for controllers in args.controllers:
+        result = await RunOnce(controllers, args.leds, args.protocol, args.seconds, args.aps, port)
+        port += controllers # Closed sockets let go of their port a bit later, every run gets new ones
+        results.append(result)
+        print(f"{controllers:3} controllers | {result['frame_leds']:5} LEDs | min {result['min_fps']:6.1f} fps, mean {result['mean_fps']:6.1f} fps"
+              f" | dropped {result['frames_dropped']} (scheduler {result['scheduler_dropped']}) | lost {result['packets_lost']}"
+              f" | lateness {result['mean_lateness_ms']:.2f} ms | max send {result['max_send_ms']:.2f} ms")
+    if args.output:
+        args.output.write_text(json.dumps({"protocol": args.protocol, "leds": args.leds, "aps": args.aps, "results": results}, indent=1))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="fps per controller as controllers get added")
+    parser.add_argument("--controllers", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--leds", type=int, default=150, help="LEDs per controller")
+    parser.add_argument("--protocol", choices=("udp", "tcp"), default="udp")
+    parser.add_argument("--seconds", type=float, default=3.0)
+    parser.add_argument("--aps", type=int, default=100)
+    parser.add_argument("--output", type=Path, default=None)
+    asyncio.run(Main(parser.parse_args()))
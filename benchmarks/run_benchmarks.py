@@ -0,0 +1,255 @@
+# Times the parser and timeline stages on synthetic presets, results go to a JSON file so runs can be compared
+# python benchmarks/run_benchmarks.py --lines 2000 --output bench_results.json
+# python benchmarks/run_benchmarks.py --compare bench_results.json   (prints the ratio to an older run)
+import argparse
+import copy
+import gc
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT / "src"))
+
+import numpy as np
+import sequence_definitions as SD
+from argbex_parser import BuildSequence, FnFormatParser, Objectify, ObjectifyPlayback, ParseFile
+from argbex_syntax import ParseSource
+from post_process import MakePostProcessor
+from synthetic_preset import GeneratePreset
+
+MAX_APS = 100
+
+
+def BuildSequences(preset):
+    sequences_database = {}
+    for definition in preset.sequences:
+        sequence = SD.UserDefinedSequence(definition.name, definition.params, sequences_database)
+        sequences_database[definition.name] = sequence
+        for statement in definition.body:
+            sequence.addActionRaw(statement.ToRaw())
+    return sequences_database
+
+
+class Workload(): # Everything the stages need, built once from the generated source
+    def __init__(self, source):
+        self.source = source
+        self.directory = tempfile.TemporaryDirectory() # ParseFile wants a path, removed together with the workload
+        self.path = Path(self.directory.name) / "synthetic.argbex"
+        self.path.write_text(source)
+        self.preset = ParseSource(source)
+        self.playback_text = [line.split(maxsplit=1)[1] for line in source.split("<Playback>", 1)[1].splitlines() if line.strip()]
+        self.raw = [line.call.ToRaw() for line in self.preset.playback]
+        self.timestamps = [line.timestamp for line in self.preset.playback]
+
+    def Objectified(self): # Fresh (timestamp, action) pairs, sequence calls resolved like ParseFile does
+        sequences_database = BuildSequences(self.preset)
+        actions = []
+        for timestamp, raw in zip(self.timestamps, copy.deepcopy(self.raw)):
+            action, params = Objectify(raw, sequences_database)
+            if isinstance(action, SD.UserDefinedSequence):
+                action = SD.SequenceCall(action, params)
+            actions.append((timestamp, action))
+        return actions
+
+    def ActionTimelines(self):
+        actions = self.Objectified()
+        return [(timestamp, action.GetTimeline()) for timestamp, action in actions]
+
+    def Timeline(self):
+        timeline = SD.Timeline(MAX_APS)
+        timeline.addActions(self.ActionTimelines())
+        return timeline
+
+
+# Every stage is (setup, run), only run is measured, setup builds fresh inputs for each repeat
+def StageFnFormatParser(work):
+    def run(lines):
+        for idx, line in enumerate(lines):
+            FnFormatParser(line, idx, omit_end=True)
+    return lambda: work.playback_text, run
+
+def StageObjectify(work):
+    def setup():
+        return BuildSequences(work.preset), copy.deepcopy(work.raw) # Objectify fills the param lists in place
+    def run(state):
+        sequences_database, raws = state
+        for raw in raws:
+            Objectify(raw, sequences_database)
+    return setup, run
+
+def StageCompile(work): # What ParseFile does instead of Objectify now, lowering to ops and running them
+    def run(_):
+        sequences_database = {}
+        for definition in work.preset.sequences:
+            sequences_database[definition.name] = BuildSequence(definition, sequences_database)
+        for line in work.preset.playback:
+            ObjectifyPlayback(line, sequences_database)
+    return lambda: None, run
+
+def StageAddAction(work):
+    timelines = work.ActionTimelines()
+    def run(timeline):
+        for timestamp, action in timelines:
+            timeline.addAction(timestamp, action)
+    return lambda: SD.Timeline(MAX_APS), run
+
+def StageAddActions(work):
+    timelines = work.ActionTimelines()
+    return lambda: SD.Timeline(MAX_APS), lambda timeline: timeline.addActions(timelines)
+
+def StageMergeTimelines(work): # MergeTimelines alone, the actions are already shifted to where they're played
+    shifted = [{key + timestamp: tdata for key, tdata in action.items()} for timestamp, action in work.ActionTimelines()]
+    step = SD.Timeline(MAX_APS).min_step
+    def run(tmline):
+        for action in shifted:
+            SD.MergeTimelines(tmline, action, step)
+    return dict, run
+
+def StageColorShift(work):
+    shifts = [params for name, params in work.raw if name == "Static" and isinstance(params[1], tuple) and params[1][0] == "ColorShift"]
+    def setup():
+        return [SD.ColorShift(SD.ColorData(*map(int, start[1])), SD.ColorData(*map(int, end[1])), float(duration)) for start, end, duration in (shift[1][1] for shift in shifts)]
+    def run(objects):
+        for shift in objects:
+            shift.ComputeTimeframe()
+    return setup, run
+
+def StageGetFullTimeline(work):
+    return work.Timeline, lambda timeline: timeline.GetFullTimeline()
+
+def StageFrameBuffer(work):
+    return work.Timeline, lambda timeline: timeline.GetFrameBuffer()
+
+def StageRenderSong(work): # The whole thing, its retained memory is what a loaded song costs
+    def run(_):
+        timeline = ParseFile(work.path, SD.Timeline(MAX_APS))
+        return timeline, timeline.GetFrameBuffer()
+    return lambda: None, run
+
+def StagePostProcess(work): # Default chain over every frame of the song, in one batch
+    frame_buffer = work.Timeline().GetFrameBuffer()
+    processor = MakePostProcessor(2.2, 0.8, 5000, SD.MAX_LED * 10)
+    return lambda: frame_buffer, processor.ProcessFrameBuffer
+
+STAGES = {
+    "fn_format_parser": StageFnFormatParser,
+    "objectify": StageObjectify,
+    "compile": StageCompile,
+    "add_action": StageAddAction,
+    "add_actions": StageAddActions,
+    "merge_timelines": StageMergeTimelines,
+    "colorshift_compute_timeframe": StageColorShift,
+    "get_full_timeline": StageGetFullTimeline,
+    "frame_buffer": StageFrameBuffer,
+    "render_song": StageRenderSong,
+    "post_process": StagePostProcess,
+}
+
+
+def Measure(setup, run, repeats):
+    times = []
+    for _ in range(repeats):
+        state = setup()
+        start = time.perf_counter()
+        run(state)
+        times.append(time.perf_counter() - start)
+
+    # Memory in its own run, tracemalloc slows everything down so it can't share the timed ones
+    # Retained is what's still allocated afterwards, while the stage's state and result are alive
+    state = setup()
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = run(state)
+        gc.collect()
+        retained, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+
+    return {
+        "best": min(times),
+        "mean": sum(times) / len(times),
+        "median": float(np.median(times)),
+        "repeats": repeats,
+        "peak_memory": peak,
+        "retained_memory": retained,
+    }
+
+
+def GitRevision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def RunBenchmarks(config, stages, repeats):
+    source = GeneratePreset(**config)
+    work = Workload(source)
+    results = {}
+    for name in stages:
+        setup, run = STAGES[name](work)
+        results[name] = Measure(setup, run, repeats)
+        print(f"{name:30} best {results[name]['best'] * 1000:10.2f} ms   peak {results[name]['peak_memory'] / 1024:10.1f} KiB   retained {results[name]['retained_memory'] / 1024:10.1f} KiB")
+
+    return {
+        "revision": GitRevision(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "config": config,
+        "source_bytes": len(source),
+        "results": results,
+    }
+
+
+def Compare(current, previous):
+    print(f"\nCompared to {previous.get('revision')} ({previous.get('time')}):")
+    if previous.get("config") != current["config"]:
+        print("  (different preset config, ratios are not comparable)")
+    for name, result in current["results"].items():
+        old = previous.get("results", {}).get(name)
+        if old is None:
+            continue
+        print(f"  {name:30} time x{result['best'] / old['best']:6.2f}   memory x{result['peak_memory'] / max(old['peak_memory'], 1):6.2f}   retained x{result['retained_memory'] / max(old.get('retained_memory', 0), 1):6.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the argbex parser and timeline on a synthetic preset")
+    parser.add_argument("--lines", type=int, default=2000, help="Playback lines")
+    parser.add_argument("--depth", type=int, default=2, help="How deep user sequences call each other")
+    parser.add_argument("--sequences", type=int, default=8, help="User defined sequences")
+    parser.add_argument("--shift", type=float, default=2.0, help="ColorShift duration in seconds")
+    parser.add_argument("--selector-size", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--stage", action="append", choices=list(STAGES), help="Only run these stages (can be repeated)")
+    parser.add_argument("--output", type=Path, default=Path("bench_results.json"))
+    parser.add_argument("--compare", type=Path, help="Earlier results file to compare against")
+    args = parser.parse_args()
+
+    config = {
+        "playback_lines": args.lines,
+        "nesting_depth": args.depth,
+        "sequences": args.sequences,
+        "shift_duration": args.shift,
+        "selector_size": args.selector_size,
+        "seed": args.seed,
+    }
+    SD.MAX_APS = MAX_APS
+
+    previous = json.loads(args.compare.read_text()) if args.compare else None # Read first, --compare and --output may be the same file
+    report = RunBenchmarks(config, args.stage or list(STAGES), args.repeats)
+    args.output.write_text(json.dumps(report, indent=2))
+    print(f"Results written to {args.output}")
+
+    if previous:
+        Compare(report, previous)
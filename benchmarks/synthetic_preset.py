@@ -0,0 +1,71 @@
+# Generates synthetic .argbex presets of any size for the benchmarks
+import argparse
+import random
+
+SELECTOR_KINDS = ("range", "checker", "id")
+
+
+def FormatTimestamp(ms): # ms -> minutes:seconds:centiseconds
+    cs = ms // 10
+    return f"{cs // 6000:02d}:{cs // 100 % 60:02d}:{cs % 100:02d}"
+
+
+def RandomColor(rng):
+    return f"Color({rng.randint(0, 255)} {rng.randint(0, 255)} {rng.randint(0, 255)})"
+
+
+def RandomSelector(rng, selector_size, max_led):
+    kind = rng.choice(SELECTOR_KINDS)
+    if kind == "range":
+        start = rng.randint(1, max(max_led - selector_size, 1))
+        return f"Range({start} {start + selector_size - 1})"
+    if kind == "checker":
+        gap = max(max_led // max(selector_size, 1) - 1, 0)
+        return f"Checker({rng.randint(1, 4)} 1 {gap})"
+    return f"ID({rng.randint(1, max_led)})"
+
+
+def GeneratePreset(playback_lines = 1000, nesting_depth = 2, sequences = 4, shift_duration = 2.0, selector_size = 100, max_led = 300, step_ms = 100, seed = 0):
+    rng = random.Random(seed)
+    out = ["<Sequences>"]
+
+    # seq0 .. seqN, each one calls the previous one unless that would go deeper than nesting_depth
+    for i in range(sequences):
+        out.append(f"seq{i}(c) {{")
+        out.append(f"    Static({RandomSelector(rng, selector_size, max_led)} Color(c 0 0))")
+        out.append("    Wait(0.1)")
+        out.append(f"    Static({RandomSelector(rng, selector_size, max_led)} ColorShift({RandomColor(rng)} Color(0 c 0) {shift_duration / 2}))")
+        if nesting_depth > 1 and i % nesting_depth != 0:
+            out.append("    Wait(0.1)")
+            out.append(f"    seq{i - 1}(c)")
+        out.append("}")
+
+    out.append("")
+    out.append("<Playback>")
+    for line in range(playback_lines):
+        timestamp = FormatTimestamp(line * step_ms)
+        roll = rng.random()
+        if sequences and roll < 0.2:
+            action = f"seq{rng.randrange(sequences)}({rng.choice((64, 128, 255))})" # Few distinct arguments, like real presets
+        elif roll < 0.5:
+            action = f"Static({RandomSelector(rng, selector_size, max_led)} ColorShift({RandomColor(rng)} {RandomColor(rng)} {shift_duration}) generated)"
+        else:
+            action = f"Static({RandomSelector(rng, selector_size, max_led)} {RandomColor(rng)})"
+        out.append(f"{timestamp} {action}")
+
+    return "\n".join(out) + "\n"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a synthetic .argbex preset")
+    parser.add_argument("output")
+    parser.add_argument("--lines", type=int, default=1000)
+    parser.add_argument("--depth", type=int, default=2)
+    parser.add_argument("--sequences", type=int, default=4)
+    parser.add_argument("--shift", type=float, default=2.0, help="ColorShift duration in seconds")
+    parser.add_argument("--selector-size", type=int, default=100)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    with open(args.output, "w") as preset:
+        preset.write(GeneratePreset(args.lines, args.depth, args.sequences, args.shift, args.selector_size, seed=args.seed))
@@ -1,124 +1,55 @@
 from pathlib import Path
-from enum import Enum
 import sequence_definitions as SD
-
-SEQUENCE_ALLOWED_CHARS = "qwertyuiopasdfghjklzxcvbnmQWERTYUIOPASDFGHJKLZXCVBNM1234567890"
-
-
-class ParsingMode(Enum):
-    NONE = 1
-    SEQUENCES = 2
-    PLAYBACK = 3
-    SEQ_FN = 4
-    SEQ_AWAIT_BRACKET = 5
-    SEQ_SCH_END = 6
+import instrumentation as Instr
+from argbex_syntax import ArgbexSyntaxError, ParseSource, ParseCallSource, ParseTimestamp, SEQUENCE_ALLOWED_CHARS
+from preset_compiler import CompileCall, CompileSequence, RunOps
 
 
 def ParseFile(path: Path, timeline: SD.Timeline):
     with open(path, "r") as preset:
-        lines = preset.read().splitlines()
-    
-    parsemode = ParsingMode.NONE
-    current_sequence = None
-    sequences_database = {}
-
-    
-
-    line_id = -1
-    loop_recursion = 0
-    for line_ in lines:
-        line = line_
+        source = preset.read()
 
-        # Process the line stripping the comments and whitespaces
-        try:
-            commentid = line.index("//") # Search for comments
-            line = line[:commentid] # Strip comments
-        except ValueError:
-            pass # No comments
-        
-        line = line.strip()
-        # Line processed, we can now proceed to parse
-        line_id += 1
-
-        if line == "": # Skip empty lines
-            continue
-
-        if line.lower() == "<sequences>":
-            parsemode = ParsingMode.SEQUENCES
-            continue
+    with Instr.Span("parse"):
+        preset = ParseSource(source, path) # Whole file to an AST in one pass
 
-        if line.lower() == "<playback>":
-            parsemode = ParsingMode.PLAYBACK
-            continue
-        
-
-        #========================
-        # SEQUENCE PARSING
-        #========================
-        if parsemode == ParsingMode.SEQUENCES: # This means a function declaration, since we are outside one (mode defines this)
-            parsemode = ParsingMode.SEQ_AWAIT_BRACKET
-            name, params, end = FnFormatParser(line, line_id)
-            #print(f"{name}, {str(params)}, {end}")
-            current_sequence = name
-            sequences_database[name] = SD.UserDefinedSequence(name, params, sequences_database)
-
-            if "{" in end:
-                parsemode = ParsingMode.SEQ_FN
-            
-            continue
-        
-        if parsemode == ParsingMode.SEQ_AWAIT_BRACKET:
-            try:
-                br_ind = line.index("{")
-                line = line[br_ind + 1:]
-                parsemode = ParsingMode.SEQ_FN
-            except ValueError:
-                raise(RuntimeError(f"No opening bracket found for function {name}"))
-            #No continue keyword! We are immediatelly processing the line
-        
-        if parsemode == ParsingMode.SEQ_FN:
-            if "loop" in line: # LOOPS ARE NOT CURRENTLY SUPPORTED!
-                loop_recursion += 1
-            if "}" in line:
-                if loop_recursion == 0:
-                    parsemode = ParsingMode.SEQUENCES
-                else:
-                    seq = ("endloop", [])
-                    sequences_database[current_sequence].addAction(seq)
-                    #print(seq)
-                    loop_recursion -= 1
-            else:
-                seq = FnFormatParser(line, line_id, True)
-                sequences_database[current_sequence].addActionRaw(seq)
-            
-            continue
-        
-
-        #========================
-        # PLAYBACK PARSING
-        #========================
-        
-        if parsemode == ParsingMode.PLAYBACK:
-            t, a = ParsePlayback(line, line_id)
-            #print(f"playback t: {t} | a: {a}")
-            a = FnFormatParser(a, line_id, True)
-            if a[0] == "nothing":
-                continue
-            a, params = Objectify(a, sequences_database)
-            #print(a)
+    #========================
+    # SEQUENCE PARSING
+    #========================
+    sequences_database = {}
+    for definition in preset.sequences:
+        sequences_database[definition.name] = BuildSequence(definition, sequences_database, path)
+
+    #========================
+    # PLAYBACK PARSING
+    #========================
+    scheduled = [] # Everything gets added to the timeline in one batch at the end
+    with Instr.Span("objectify"):
+        for line in preset.playback:
+            a = ObjectifyPlayback(line, sequences_database, path)
             if a:
-                if params: #If true we have a user defined sequence
-                    a = a.GetTimeline(params) # Generate the dict of timeline
-
-                timeline.addAction(t, a.GetTimeline()) # Add to timeline whatever we have
-    
-    #print(sequences_database)
-    #print("SEQUENCES============")
-    #print(sequences_database["s1"].actions_raw)
-    #print(sequences_database["s1"].GetTimeline(["20"]))
+                scheduled.append((line.timestamp, a)) # Add to timeline whatever we have
 
+    timeline.ScheduleAll(scheduled)
     return timeline
-        
+
+def BuildSequence(definition, sequences_database, path = None): # SequenceDef -> UserDefinedSequence, calls inside resolve through sequences_database when they run
+    sequence = SD.UserDefinedSequence(definition.name, definition.params, sequences_database)
+    sequence.SetOps(CompileSequence(definition, sequences_database, path))
+    return sequence
+
+def ObjectifyPlayback(line, sequences_database, path = None): # PlaybackLine -> something the timeline can schedule, None for nothing()
+    if line.call.name == "nothing":
+        return None
+    try:
+        parts, _ = RunOps(CompileCall(line.call, sequences_database, path), (), sequences_database)
+    except RuntimeError as e:
+        if isinstance(e, ArgbexSyntaxError):
+            raise
+        raise ArgbexSyntaxError(str(e), line.call.line, line.call.column, path) from e
+    if not parts: # Wait() on its own
+        return None
+    return parts[0][1] # Sequences come back as a SequenceCall, expanded (and cached) when the timeline asks for it
+
 def Objectify(line, user_defined_dict):
     try: # Errors can occur if somehow the data structure is wrong
         if type(line) == tuple: #We're processing a function declaration
@@ -133,7 +64,7 @@ def Objectify(line, user_defined_dict):
                         raise RuntimeError(f"Userdefined Sequences cannot be put inside other functions! Line: {line}")
                     params[i] = tempobj
             
-            if not decl in SD.getglobals().keys():
+            if not decl in SD.getglobals().keys() and not decl in user_defined_dict.keys():
                 print(f"Decl {decl} not found!")
                 return None
 
@@ -191,6 +122,8 @@ def Objectify(line, user_defined_dict):
             if not user_seq:
                 obj = decl_object(*parameters_to_pass)
                 parameters_to_pass = []
+            else:
+                obj = decl_object # Gets expanded by the caller, with parameters_to_pass
 
             return obj, parameters_to_pass
             
@@ -198,119 +131,39 @@ def Objectify(line, user_defined_dict):
                 
 
 
-    except:
-        raise RuntimeError(f"Data structure {line} is invalid!")
+    except (TypeError, ValueError, IndexError, AttributeError) as e: # Wrong types in the data structure, our own RuntimeErrors already say what's wrong
+        raise RuntimeError(f"Data structure {line} is invalid! ({e})") from e
         
 
 
 
 
 
-def ParsePlayback(line_: str, lineidx):
+def ParsePlayback(line_: str, lineidx): # Single playback line -> (ms, action text)
     line = line_.strip()
 
-    res = line.split(" ")
+    res = line.split(maxsplit=1)
     if len(res) < 2:
-        raise RuntimeError(f"Syntax error at line {lineidx}")
-    elif len(res) > 2:
-        timestamp = line[:len(res[0])]
-        action = line[len(res[0]) + 1:]
-    else:
-        timestamp, action = res
-
-    t_res = timestamp.split(":")
-    if len(t_res) != 3:
-        raise RuntimeError(f"Invalid timestamp syntax at line {lineidx}")
-
-    minutes, seconds, cs = map(int, t_res) #technically centiseconds lol
-
-    seconds += minutes * 60
-    cs += seconds * 100
-    ms = cs * 10
-    #Achieved time in ms
-
-    return ms, action
-
-
-
-
-def FnFormatParser(line_: str, lineidx, omit_end = False):
-    line = line_
-    line = line.strip() # Just in case
+        raise ArgbexSyntaxError("Expected a timestamp and an action", lineidx, 1)
+    timestamp, action = res
 
-    class FnParser(Enum):
-        NAME = 1
-        PARAM = 2
-        END = 3
-    
-    fn_name = ""
-    params = []
-    parsermode = FnParser.NAME # First we're parsing the name
-    
-    pidx = None
-    idx = -1
-    r_index = 0
-    param = ""
-    p_helper_len = 0
-    for char in line:
-        idx += 1
+    try:
+        return ParseTimestamp(timestamp), action
+    except ValueError:
+        raise ArgbexSyntaxError(f"Invalid timestamp syntax {timestamp!r}", lineidx, 1)
 
-        if parsermode == FnParser.NAME and not char == "(":
-            if char in SEQUENCE_ALLOWED_CHARS:
-                fn_name += char
-                continue
-            else:
-                raise(RuntimeError(f"Error on line {lineidx}, {char} is not allowed!"))
 
+def FnFormatParser(line_: str, lineidx, omit_end = False): # Single call -> (name, params[, rest of the line]), kept for old callers, ParseFile doesn't need it
+    try:
+        call, rest = ParseCallSource(line_.strip())
+    except ArgbexSyntaxError as e:
+        raise ArgbexSyntaxError(e.message, lineidx, e.column) from None # Only the column is right, the line is ours
+    name, params = call.ToRaw()
 
-        if char == "(":
-            r_index += 1
-            if parsermode == FnParser.NAME:
-                parsermode = FnParser.PARAM
-            
-            if r_index == 2:
-                p_helper_len = len(param)
-                param = ""
-                pidx = idx
-                
-            
-            continue
-        
-        if char == ")":
-            r_index -= 1
-            if r_index == 0:
-                if param != "":
-                    params.append(param)
-                parsermode = FnParser.END
-                break
-
-            elif r_index == 1: # Almost at the end, parse this function
-                param = ""
-                fn = line[pidx - p_helper_len: idx + 1]
-                #print(fn)
-                params.append(FnFormatParser(fn, lineidx, omit_end))
-            
-            continue
-        
-        if char == " " and not r_index != 1:
-            if param != "":
-                params.append(param)
-            param = ""
-            continue
-            
-        #print(f"Char {char}, param {param}")
-        param += char
-
-                
-        
-    if parsermode == FnParser.PARAM or parsermode == FnParser.NAME:
-        raise(RuntimeError(f"Invalid sequence syntax at line {lineidx}"))
-    
-    
     if not omit_end:
-        return fn_name, params, line[idx + 1:]
+        return name, params, rest
     else:
-        return fn_name, params
+        return name, params
         
 
 if __name__ == "__main__":
@@ -0,0 +1,242 @@
+# Tokenizer and recursive-descent parser for .argbex files, the whole file is scanned once and turned into an AST with source positions
+import re
+from dataclasses import dataclass, field
+from typing import NamedTuple
+
+SEQUENCE_ALLOWED_CHARS = "qwertyuiopasdfghjklzxcvbnmQWERTYUIOPASDFGHJKLZXCVBNM1234567890"
+NAME_PATTERN = re.compile(r"[A-Za-z0-9]+")
+TIMESTAMP_PATTERN = re.compile(r"\d+:\d+:\d+")
+
+TOKEN_PATTERN = re.compile(r"""[ \t\r\f\v]*(?:   # Whitespace is eaten together with the next token, no separate matches for it
+    (?P<NEWLINE>\n)
+  | (?P<COMMENT>//[^\n]*)
+  | (?P<SECTION><[A-Za-z]+>)
+  | (?P<LPAREN>\()
+  | (?P<RPAREN>\))
+  | (?P<LBRACE>\{)
+  | (?P<RBRACE>\})
+  | (?P<WORD>[^\s(){}/]+(?:/(?!/)[^\s(){}/]*)*|/(?!/)[^\s(){}/]*)
+)""", re.VERBOSE)
+
+
+class ArgbexSyntaxError(RuntimeError):
+    def __init__(self, message, line = None, column = None, path = None):
+        self.message = message
+        self.line = line
+        self.column = column
+        self.path = path
+        location = f"line {line}, column {column}" if line is not None else "unknown position"
+        if path is not None:
+            location = f"{path}, {location}"
+        super().__init__(f"{message} ({location})")
+
+
+class Token(NamedTuple): # Plain tuple, there can be a lot of them
+    kind: str
+    text: str
+    line: int
+    column: int
+    offset: int
+
+
+@dataclass
+class Word():
+    text: str
+    line: int
+    column: int
+
+    def ToRaw(self): # Format Objectify understands
+        return self.text
+
+
+@dataclass
+class Call():
+    name: str
+    args: list
+    line: int
+    column: int
+
+    def ToRaw(self): # (name, [params]), nested calls become tuples, always freshly built since Objectify edits the params in place
+        return self.name, [arg.ToRaw() for arg in self.args]
+
+
+@dataclass
+class Loop():
+    args: list
+    body: list
+    line: int
+    column: int
+
+    def ToRaw(self): # ("loop", [args], [body statements]), the extra element is how UserDefinedSequence tells loops from calls
+        return "loop", [arg.ToRaw() for arg in self.args], [statement.ToRaw() for statement in self.body]
+
+
+@dataclass
+class SequenceDef():
+    name: str
+    params: list
+    body: list
+    line: int
+    column: int
+
+
+@dataclass
+class PlaybackLine():
+    timestamp: int # ms
+    call: Call
+    line: int
+    column: int
+
+
+@dataclass
+class PresetFile():
+    sequences: list = field(default_factory=list)
+    playback: list = field(default_factory=list)
+
+
+def Tokenize(source: str): # Single pass, comments and whitespace are dropped, newlines only move the position
+    tokens = []
+    line = 1
+    line_start = 0
+    make_token = tuple.__new__ # Skips the NamedTuple constructor, this loop runs for every token of the file
+    for match in TOKEN_PATTERN.finditer(source):
+        kind = match.lastgroup
+        if kind == "NEWLINE":
+            line += 1
+            line_start = match.end()
+            continue
+        if kind == "COMMENT":
+            continue
+        start = match.start(kind)
+        tokens.append(make_token(Token, (kind, match.group(kind), line, start - line_start + 1, start)))
+
+    eof = Token("EOF", "", line, len(source) - line_start + 1, len(source))
+    tokens.extend((eof, eof)) # Parser looks one token ahead, this way it never runs off the end
+    return tokens
+
+
+def ParseTimestamp(text: str): # minutes:seconds:centiseconds -> ms
+    minutes, seconds, cs = map(int, text.split(":"))
+    return ((minutes * 60 + seconds) * 100 + cs) * 10
+
+
+class Parser():
+    tokens = None
+    pos = 0
+    path = None
+
+    def __init__(self, tokens, path = None):
+        self.tokens = tokens
+        self.pos = 0
+        self.path = path
+
+    def Peek(self, offset = 0):
+        return self.tokens[self.pos + offset]
+
+    def Next(self):
+        token = self.tokens[self.pos]
+        if token.kind != "EOF":
+            self.pos += 1
+        return token
+
+    def Error(self, message, token: Token):
+        return ArgbexSyntaxError(message, token.line, token.column, self.path)
+
+    def Expect(self, kind, what):
+        token = self.Next()
+        if token.kind != kind:
+            found = token.text or "end of file"
+            raise self.Error(f"Expected {what}, found {found!r}", token)
+        return token
+
+    def ParseFile(self):
+        preset = PresetFile()
+        while self.Peek().kind != "EOF":
+            header = self.Expect("SECTION", "<Sequences> or <Playback>")
+            section = header.text.lower()
+            if section == "<sequences>":
+                while self.Peek().kind not in ("SECTION", "EOF"):
+                    preset.sequences.append(self.ParseSequenceDef())
+            elif section == "<playback>":
+                while self.Peek().kind not in ("SECTION", "EOF"):
+                    preset.playback.append(self.ParsePlaybackLine())
+            else:
+                raise self.Error(f"Unknown section {header.text}", header)
+        return preset
+
+    def ParseName(self):
+        token = self.Expect("WORD", "a name")
+        if not NAME_PATTERN.fullmatch(token.text):
+            bad = next(char for char in token.text if char not in SEQUENCE_ALLOWED_CHARS)
+            raise self.Error(f"{bad!r} is not allowed in names", token)
+        return token
+
+    def ParseSequenceDef(self):
+        name = self.ParseName()
+        self.Expect("LPAREN", "'(' after the sequence name")
+        params = []
+        while self.Peek().kind == "WORD":
+            params.append(self.Next().text)
+        self.Expect("RPAREN", "')' after the sequence parameters")
+        return SequenceDef(name.text, params, self.ParseBlock(), name.line, name.column)
+
+    def ParseBlock(self): # { statement* }
+        self.Expect("LBRACE", "'{'")
+        body = []
+        while self.Peek().kind != "RBRACE":
+            if self.Peek().kind == "EOF":
+                raise self.Error("Missing '}'", self.Peek())
+            body.append(self.ParseStatement())
+        self.Next()
+        return body
+
+    def ParseStatement(self):
+        token = self.Peek()
+        if token.kind == "WORD" and token.text.lower() == "loop" and self.Peek(1).kind == "LPAREN":
+            self.Next()
+            self.Next()
+            args = self.ParseArgs(token)
+            return Loop(args, self.ParseBlock(), token.line, token.column)
+        return self.ParseCall()
+
+    def ParsePlaybackLine(self):
+        token = self.Expect("WORD", "a timestamp")
+        if not TIMESTAMP_PATTERN.fullmatch(token.text):
+            raise self.Error(f"Invalid timestamp {token.text!r}, expected minutes:seconds:centiseconds", token)
+        return PlaybackLine(ParseTimestamp(token.text), self.ParseCall(), token.line, token.column)
+
+    def ParseCall(self):
+        name = self.ParseName()
+        self.Expect("LPAREN", f"'(' after {name.text}")
+        return Call(name.text, self.ParseArgs(name), name.line, name.column)
+
+    def ParseArgs(self, opener: Token): # Everything up to the closing ')', which gets consumed
+        args = []
+        tokens = self.tokens
+        while True:
+            token = tokens[self.pos]
+            kind = token.kind
+            if kind == "WORD":
+                if tokens[self.pos + 1].kind == "LPAREN":
+                    args.append(self.ParseCall())
+                else:
+                    self.pos += 1
+                    args.append(Word(token.text, token.line, token.column))
+            elif kind == "RPAREN":
+                self.pos += 1
+                return args
+            elif kind == "EOF":
+                raise self.Error(f"Missing ')' for {opener.text} opened at line {opener.line}, column {opener.column}", token)
+            else:
+                raise self.Error(f"Unexpected {token.text!r} inside {opener.text}", token)
+
+
+def ParseSource(source: str, path = None):
+    return Parser(Tokenize(source), path).ParseFile()
+
+
+def ParseCallSource(source: str, path = None): # Single call, returns (Call, rest of the text)
+    tokens = Tokenize(source)
+    parser = Parser(tokens, path)
+    call = parser.ParseCall()
+    return call, source[parser.Peek().offset:]
@@ -0,0 +1,54 @@
+# Layered compositor, everything written to the same timestamp is kept as a separate layer and resolved in one pass
+# Layers with higher priority win, on equal priority the first one added wins (same as the old MergeWith behaviour)
+# A layer is anything with a selector, a color and a priority, normally a TimelineData, they're never changed once added so compositors can share them
+
+
+class LayerCompositor():
+    __slots__ = ("layers", "sorted_")
+
+    def __init__(self):
+        self.layers = []
+        self.sorted_ = True
+
+    def AddLayer(self, layer):
+        if self.layers and layer.priority > self.layers[-1].priority:
+            self.sorted_ = False # Only need to sort if someone jumped the queue
+        self.layers.append(layer)
+
+    def AddLayers(self, other): # Takes over every layer of another compositor (or anything else with GetLayers), they go below ours unless they have a higher priority
+        layers = other.GetLayers()
+        if layers and self.layers and layers[0].priority > self.layers[-1].priority: # layers[0] has the highest priority of them
+            self.sorted_ = False
+        self.layers.extend(layers)
+
+    def Copy(self):
+        copy = LayerCompositor()
+        copy.layers = list(self.layers) # Layers are never changed after they're added, sharing them is fine
+        copy.sorted_ = self.sorted_
+        return copy
+
+    def GetLayers(self): # Winning layer first
+        if not self.sorted_:
+            self.layers.sort(key=lambda layer: -layer.priority) # Stable, equal priorities stay in the order they were added
+            self.sorted_ = True
+        return self.layers
+
+    def Composite(self, frame): # frame is a (MAX_LED, 3) array, gets written in place
+        layers = self.GetLayers()
+        if len(layers) == 1: # Nothing to resolve
+            layer = layers[0]
+            frame[layer.selector.GetWriteKey()] = layer.color.GetRGB()
+            return frame
+
+        for layer in reversed(layers): # Paint the losers first so the winners overwrite them, slices stay slices this way
+            frame[layer.selector.GetWriteKey()] = layer.color.GetRGB()
+        return frame
+
+    def GetDict(self): # {ledID : ColorData}, same thing as Composite but for the dict based API
+        led_dict = {}
+        for layer in reversed(self.GetLayers()): # Paint the losers first so the winners overwrite them
+            led_dict.update(dict.fromkeys(layer.selector.GetIDs(), layer.color))
+        return led_dict
+
+    def __len__(self):
+        return len(self.layers)
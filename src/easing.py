@@ -0,0 +1,92 @@
+# Easing curves used by ColorShift, every curve maps an array of progress values (0 -> 1) to eased progress in one go
+import numpy as np
+
+
+def Linear(t):
+    return t
+
+def EaseIn(t):
+    return t * t
+
+def EaseOut(t):
+    return t * (2 - t)
+
+def EaseInOut(t):
+    return np.where(t < 0.5, 2 * t * t, 1 - (-2 * t + 2) ** 2 / 2)
+
+def Cubic(t):
+    return np.where(t < 0.5, 4 * t ** 3, 1 - (-2 * t + 2) ** 3 / 2)
+
+
+EASINGS = {
+    "linear": Linear,
+    "easein": EaseIn,
+    "easeout": EaseOut,
+    "easeinout": EaseInOut,
+    "cubic": Cubic,
+    "hsv": Linear, # Linear, but interpolated in HSV space, see Gradient()
+}
+HSV_EASINGS = {"hsv"}
+
+
+def RegisterEasing(name: str, curve, hsv = False): # Plug in a custom curve, it has to accept and return numpy arrays
+    name = name.lower()
+    EASINGS[name] = curve
+    if hsv:
+        HSV_EASINGS.add(name)
+    else:
+        HSV_EASINGS.discard(name)
+
+
+def GetEasing(name):
+    if callable(name):
+        return name
+    try:
+        return EASINGS[str(name).lower()]
+    except KeyError:
+        raise RuntimeError(f"Unknown easing {name}, available: {', '.join(EASINGS)}")
+
+
+def RGBToHSV(rgb): # (n, 3) floats 0-255 -> (n, 3) floats, hue in 0-1
+    rgb = rgb / 255
+    maxc = rgb.max(axis=1)
+    minc = rgb.min(axis=1)
+    delta = maxc - minc
+    safe_delta = np.where(delta == 0, 1, delta)
+
+    r, g, b = rgb.T
+    hue = np.select(
+        [delta == 0, maxc == r, maxc == g],
+        [0, ((g - b) / safe_delta) % 6, (b - r) / safe_delta + 2],
+        (r - g) / safe_delta + 4,
+    ) / 6
+    sat = np.where(maxc == 0, 0, delta / np.where(maxc == 0, 1, maxc))
+    return np.stack([hue, sat, maxc], axis=1)
+
+
+def HSVToRGB(hsv): # Inverse of RGBToHSV, returns floats 0-255
+    hue, sat, val = hsv.T
+    h6 = (hue % 1) * 6
+    k = (np.array([5, 3, 1])[None, :] + h6[:, None]) % 6
+    rgb = val[:, None] - val[:, None] * sat[:, None] * np.clip(np.minimum(k, 4 - k), 0, 1)
+    return rgb * 255
+
+
+def Gradient(start, end, steps: int, easing = "linear"): # (steps + 1, 3) uint8, first and last row are exactly start and end
+    steps = max(int(steps), 1)
+    progress = GetEasing(easing)(np.linspace(0.0, 1.0, steps + 1))[:, None]
+    start = np.asarray(start, dtype=np.float64)
+    end = np.asarray(end, dtype=np.float64)
+
+    if not callable(easing) and str(easing).lower() in HSV_EASINGS:
+        hsv_start, hsv_end = RGBToHSV(np.stack([start, end]))
+        hue_delta = (hsv_end[0] - hsv_start[0] + 0.5) % 1 - 0.5 # Go around the color wheel the short way
+        hsv_delta = np.array([hue_delta, hsv_end[1] - hsv_start[1], hsv_end[2] - hsv_start[2]])
+        values = HSVToRGB(hsv_start + hsv_delta * progress)
+    else:
+        values = start + (end - start) * progress
+
+    gradient = np.clip(np.rint(values), 0, 255).astype(np.uint8)
+    gradient[0] = np.clip(start, 0, 255) # Exact endpoints, no matter what the curve or the float math did
+    gradient[-1] = np.clip(end, 0, 255)
+    return gradient
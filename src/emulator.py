@@ -0,0 +1,98 @@
+# Local stand-in for the ESP32, decodes the wire protocol over UDP or TCP and reports fps, throughput and packet loss
+import argparse
+import asyncio
+import struct
+import time
+
+import sequence_definitions as SD
+from wire_protocol import DeltaDecoder
+
+
+class EmulatedDevice():
+    decoder: DeltaDecoder = None
+    bytes_received = 0
+
+    def __init__(self, led_count):
+        self.decoder = DeltaDecoder(led_count)
+        self.bytes_received = 0
+        self.ResetWindow()
+
+    def ResetWindow(self):
+        self.window_start = time.monotonic()
+        self.window_frames = self.decoder.frames
+        self.window_bytes = self.bytes_received
+
+    def Receive(self, packet):
+        self.bytes_received += len(packet)
+        try:
+            self.decoder.Decode(packet)
+        except (ValueError, struct.error):
+            pass # Garbage on the port, a real device would ignore it too
+
+    def GetReport(self): # Stats since the last report
+        elapsed = max(time.monotonic() - self.window_start, 1e-9)
+        report = {
+            "fps": (self.decoder.frames - self.window_frames) / elapsed,
+            "bytes_per_second": (self.bytes_received - self.window_bytes) / elapsed,
+            "packets": self.decoder.packets,
+            "packets_lost": self.decoder.packets_lost,
+            "loss": self.decoder.packets_lost / max(self.decoder.packets + self.decoder.packets_lost, 1),
+        }
+        self.ResetWindow()
+        return report
+
+
+class UdpReceiver(asyncio.DatagramProtocol):
+    def __init__(self, device: EmulatedDevice):
+        self.device = device
+
+    def datagram_received(self, data, addr):
+        self.device.Receive(data)
+
+
+async def HandleTcp(device: EmulatedDevice, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        while True:
+            (length,) = struct.unpack("<H", await reader.readexactly(2))
+            device.Receive(await reader.readexactly(length))
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def StartEmulator(device: EmulatedDevice, host = "127.0.0.1", udp_port = None, tcp_port = None): # Returns whatever has to be closed later
+    loop = asyncio.get_running_loop()
+    handles = []
+    if udp_port is not None:
+        transport, _ = await loop.create_datagram_endpoint(lambda: UdpReceiver(device), local_addr=(host, udp_port))
+        handles.append(transport)
+    if tcp_port is not None:
+        handles.append(await asyncio.start_server(lambda r, w: HandleTcp(device, r, w), host, tcp_port))
+    return handles
+
+
+async def Main(args):
+    device = EmulatedDevice(args.leds)
+    handles = await StartEmulator(device, args.host, args.udp, args.tcp)
+    try:
+        while True:
+            await asyncio.sleep(args.report)
+            report = device.GetReport()
+            print(f"{report['fps']:7.1f} fps | {report['bytes_per_second'] / 1024:8.1f} KiB/s | lost {report['packets_lost']} / {report['packets']} ({report['loss'] * 100:.2f}%)")
+    finally:
+        for handle in handles:
+            handle.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Emulated aRGBeX LED controller")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--udp", type=int, default=7777)
+    parser.add_argument("--tcp", type=int, default=None)
+    parser.add_argument("--leds", type=int, default=SD.MAX_LED)
+    parser.add_argument("--report", type=float, default=1.0, help="Seconds between reports")
+    try:
+        asyncio.run(Main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,63 @@
+# Dense renderer, turns a Timeline into one contiguous uint8 array instead of dicts of ColorData objects
+import numpy as np
+import sequence_definitions as SD
+import instrumentation as Instr
+
+
+class FrameBuffer():
+    timestamps = None # (frames,) int64, in miliseconds, sorted
+    frames = None # (frames, MAX_LED, 3) uint8, full state of the strip at every timestamp
+
+    def __init__(self, timestamps, frames):
+        self.timestamps = timestamps
+        self.frames = frames
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def GetFrame(self, timestamp): # State of the strip at any point in time, it holds until the next timestamp
+        i = int(np.searchsorted(self.timestamps, timestamp, side="right")) - 1
+        if i < 0:
+            return np.zeros(self.frames.shape[1:], dtype=np.uint8) # Nothing happened yet, strip is dark
+        return self.frames[i]
+
+    def GetBytes(self):
+        return self.timestamps.nbytes + self.frames.nbytes
+
+    def __repr__(self):
+        return f"<FrameBuffer {len(self)} frames, {self.frames.shape[1]} LEDs, {self.GetBytes()} bytes>"
+
+    def __str__(self):
+        return self.__repr__()
+
+
+def RenderTimeline(timeline: SD.Timeline):
+    if timeline.sources: # Lazy timeline, nothing was merged into tmline so render it through the stream
+        return RenderStream(timeline.IterFrames())
+
+    with Instr.Span("render"):
+        keys = sorted(timeline.tmline.keys())
+
+        timestamps = np.fromiter(keys, dtype=np.int64, count=len(keys))
+        frames = np.empty((len(keys), SD.MAX_LED, 3), dtype=np.uint8)
+        state = np.zeros((SD.MAX_LED, 3), dtype=np.uint8) # LEDs keep their color until something else writes to them
+
+        for i, key in enumerate(keys):
+            tdata: SD.TimelineData = timeline.tmline[key]
+            tdata.compositor.Composite(state)
+            frames[i] = state
+
+    Instr.Count("frames_rendered", len(keys))
+    return FrameBuffer(timestamps, frames)
+
+
+def RenderStream(frames): # Collects (timestamp, frame) pairs, like the ones frame_stream.py yields, into a FrameBuffer
+    timestamps = []
+    collected = []
+    for timestamp, frame in frames:
+        timestamps.append(timestamp)
+        collected.append(frame.copy())
+
+    if not collected:
+        return FrameBuffer(np.zeros(0, dtype=np.int64), np.zeros((0, SD.MAX_LED, 3), dtype=np.uint8))
+    return FrameBuffer(np.array(timestamps, dtype=np.int64), np.stack(collected))
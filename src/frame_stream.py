@@ -0,0 +1,62 @@
+# Streaming renderer, yields the frames of a lazy Timeline in time order while only keeping the actions around the playhead
+import heapq
+import numpy as np
+import sequence_definitions as SD
+from compositor import LayerCompositor
+import instrumentation as Instr
+
+DEFAULT_LOOKAHEAD = 1000 # ms, how far ahead of the playhead actions get started
+
+
+def StreamEvents(timeline: SD.Timeline, lookahead = None):
+    # Yields (timestamp, LayerCompositor) in time order, every compositor holds everything written at that timestamp
+    if not timeline.sources: # Eager timeline, everything is already in tmline
+        for key in sorted(timeline.tmline.keys()):
+            yield key, timeline.tmline[key].compositor
+        return
+
+    if lookahead is None:
+        lookahead = DEFAULT_LOOKAHEAD
+    lookahead = max(lookahead, timeline.min_step) # Snapping can pull an event half a step back, the window has to cover that
+
+    # Scheduling order is the priority, same as the order addAction would have merged them in
+    pending = sorted(((start, order, source) for order, (start, source) in enumerate(timeline.sources)), key=lambda p: (p[0], p[1]))
+    next_pending = 0
+    heap = [] # (absolute time, priority, tiebreak, TimelineData, start, iterator), one entry per running action
+    tiebreak = 0
+
+    def PushNext(start, order, events):
+        nonlocal tiebreak
+        for key, tdata in events:
+            tiebreak += 1
+            heapq.heappush(heap, (timeline.SnapKey(start + key), order, tiebreak, tdata, start, events))
+            return # Only one event per action lives in the heap
+
+    while heap or next_pending < len(pending):
+        horizon = heap[0][0] + lookahead if heap else pending[next_pending][0]
+        while next_pending < len(pending) and pending[next_pending][0] <= horizon:
+            start, order, source = pending[next_pending]
+            next_pending += 1
+            PushNext(start, order, SD.IterSource(source))
+
+        if not heap:
+            continue
+
+        now = heap[0][0]
+        compositor = LayerCompositor()
+        while heap and heap[0][0] == now: # Pops in priority order, so the first writer wins like in MergeWith
+            _, order, _, tdata, start, events = heapq.heappop(heap)
+            compositor.AddLayers(tdata)
+            PushNext(start, order, events)
+
+        yield now, compositor
+
+
+def StreamFrames(timeline: SD.Timeline, lookahead = None):
+    # Yields (timestamp, frame), frame is the full (MAX_LED, 3) state of the strip and gets reused, copy it if you need to keep it
+    state = np.zeros((SD.MAX_LED, 3), dtype=np.uint8)
+    for timestamp, compositor in StreamEvents(timeline, lookahead):
+        compositor.Composite(state)
+        if Instr.ENABLED:
+            Instr.Count("frames_rendered")
+        yield timestamp, state
@@ -1,44 +1,22 @@
-
-# Credit goes to tameTNT | https://stackoverflow.com/questions/65011660/how-can-i-get-the-title-of-the-currently-playing-media-in-windows-10-with-python
-
+# One-off query of the current song, kept for old callers
+# Anything that runs for longer should use now_playing.NowPlayingWatcher, it keeps one session and gets told about changes
 import asyncio
-import time
-from winsdk.windows.media.control import \
-    GlobalSystemMediaTransportControlsSessionManager as MediaManager
-
-
-async def get_media_info():
-    sessions = await MediaManager.request_async()
-
-    # This source_app_user_model_id check and if statement is optional
-    # Use it if you want to only get a certain player/program's media
-    # (e.g. only chrome.exe's media not any other program's).
 
-    # To get the ID, use a breakpoint() to run sessions.get_current_session()
-    # while the media you want to get is playing.
-    # Then set TARGET_ID to the string this call returns.
+from now_playing import WinsdkBackend
 
-    current_session = sessions.get_current_session()
-    #print(current_session)
-    if current_session:  # there needs to be a media session running
-        if True: # Over the update to winsdk I believe this isn't needed ~Enderek
-            info = await current_session.try_get_media_properties_async()
-
-            # song_attr[0] != '_' ignores system attributes
-            info_dict = {song_attr: info.__getattribute__(song_attr) for song_attr in dir(info) if song_attr[0] != '_'}
-
-            # converts winrt vector to list
-            info_dict['genres'] = list(info_dict['genres'])
-
-            return info_dict
-
-    # It could be possible to select a program from a list of current
-    # available ones. I just haven't implemented this here for my use case.
-    # See references for more information.
-    raise Exception('TARGET_PROGRAM is not the current media session')
 
+async def get_media_info():
+    backend = WinsdkBackend(subscribe=False) # Made on the loop that uses it, every asyncio.run below is a new loop
+    await backend.Open()
+    try:
+        song = await backend.Query()
+    finally:
+        await backend.Close()
+    if song is None:
+        raise Exception('TARGET_PROGRAM is not the current media session')
+    return {"artist": song.artist, "title": song.title, "position": song.position, "playing": song.playing}
 
 
 def GetCurrentlyPlaying():
     info = asyncio.run(get_media_info())
-    return {"author":info["artist"], "title":info["title"]}
\ No newline at end of file
+    return {"author":info["artist"], "title":info["title"]}
@@ -0,0 +1,332 @@
+# Watches a preset while it's being written and swaps the new frames into a running PlaybackScheduler
+# Only sequences and playback lines that changed get objectified and expanded again, only the time ranges they cover get merged and rendered again
+# Rendering carries on past a changed range until the strip ends up in the same state as before, everything after that is copied from the old runs
+# Frames are kept run-length compressed (run_length.py) the whole time, only the frames of a range being rendered are ever held in full
+import argparse
+import asyncio
+import os
+import time
+from pathlib import Path
+
+import numpy as np
+import sequence_definitions as SD
+import instrumentation as Instr
+from argbex_parser import BuildSequence, ObjectifyPlayback
+from argbex_syntax import ArgbexSyntaxError, ParseSource
+from run_length import DEFAULT_KEYFRAME_INTERVAL, STREAM_CHUNK, BuildRunLength, CompressRuns, CopyRuns, RunLengthFrames
+
+
+def StatementSignature(statement): # Comparable form of an AST node that ignores where it is in the file
+    return repr(statement.ToRaw()) if hasattr(statement, "ToRaw") else repr(statement)
+
+def SequenceSignature(definition):
+    return definition.params, tuple(StatementSignature(statement) for statement in definition.body)
+
+def PlaybackSignature(line):
+    return line.timestamp, StatementSignature(line.call)
+
+def CalledNames(raw, names): # Every call name in a raw (name, [params]) tuple, loop bodies included
+    if type(raw) == tuple:
+        names.add(raw[0])
+        for param in raw[1]:
+            CalledNames(param, names)
+        for statement in raw[2] if len(raw) > 2 else ():
+            CalledNames(statement, names)
+    return names
+
+
+class PlaybackEntry(): # One playback line and its expanded relative timeline
+    signature = None
+    timestamp = 0
+    calls: set = None # Names it calls, to know which lines a changed sequence affects
+    timeline: dict = None
+    start = 0 # Snapped time range the line writes to, both ends included
+    end = 0
+
+    def __init__(self, signature, timestamp, calls, timeline, timeline_owner: SD.Timeline):
+        self.signature = signature
+        self.timestamp = timestamp
+        self.calls = calls
+        self.timeline = timeline
+        if timeline:
+            self.start = timeline_owner.SnapKey(timestamp + min(timeline.keys()))
+            self.end = timeline_owner.SnapKey(timestamp + max(timeline.keys()))
+        else:
+            self.start = self.end = None
+
+
+class IncrementalPreset():
+    path: Path = None
+    max_aps = 0
+    timeline: SD.Timeline = None
+    frames: RunLengthFrames = None
+    sequences_database: dict = None
+    sequence_signatures: dict = None
+    entries: list = None # PlaybackEntry per playback line, in file order (which is also the merge priority)
+    stale = False # A reload failed halfway, the next one has to start from scratch
+
+    def __init__(self, path: Path, max_aps = None):
+        self.path = Path(path)
+        self.max_aps = max_aps or SD.MAX_APS
+        self.timeline = SD.Timeline(self.max_aps)
+        self.frames = BuildRunLength([], [], [], SD.MAX_LED, DEFAULT_KEYFRAME_INTERVAL)
+        self.sequences_database = {}
+        self.sequence_signatures = {}
+        self.entries = []
+        self.stale = False
+
+    def Load(self): # Full build, also the fallback when an edit can't be done incrementally
+        return self.Reload(self.path.read_text(), full=True)
+
+    def Reload(self, source, full = False): # Returns the changed (start, end) ranges, the new frames are in self.frames
+        with Instr.Span("reload"):
+            preset = ParseSource(source, self.path)
+            if full or self.stale:
+                full = True
+                self.sequences_database = {}
+                self.sequence_signatures = {}
+                self.entries = []
+
+            self.stale = True # Until this reload went through, self.frames still has the last good version
+            changed_sequences = self.UpdateSequences(preset.sequences)
+            entries, removed, added, reordered = self.UpdatePlayback(preset.playback, changed_sequences)
+            self.entries = entries
+            if full or reordered: # Same lines in a different order change priorities everywhere, just start over
+                self.timeline.tmline = {}
+                self.timeline.addActions([(entry.timestamp, entry.timeline) for entry in entries if entry.timeline])
+                self.frames = RenderFrom(self.timeline, None, [])
+                self.stale = False
+                return [(0, max(self.timeline.tmline))] if self.timeline.tmline else []
+
+            ranges = MergeRanges([(entry.start, entry.end) for entry in removed + added if entry.start is not None])
+            for start, end in ranges:
+                self.MergeRange(start, end)
+            self.frames = RenderFrom(self.timeline, self.frames, ranges)
+            self.stale = False
+            return ranges
+
+    def UpdateSequences(self, definitions): # Rebuilds the sequences that changed, returns the names whose expansion may now be different
+        signatures = {definition.name: SequenceSignature(definition) for definition in definitions}
+        changed = {name for name in signatures.keys() | self.sequence_signatures.keys() if signatures.get(name) != self.sequence_signatures.get(name)}
+
+        # Sequences calling a changed sequence change too, and so on
+        calls = {definition.name: set().union(*(CalledNames(statement.ToRaw(), set()) for statement in definition.body if hasattr(statement, "ToRaw"))) for definition in definitions}
+        grown = True
+        while grown:
+            grown = False
+            for name, called in calls.items():
+                if name not in changed and called & changed:
+                    changed.add(name)
+                    grown = True
+
+        for name in self.sequence_signatures.keys() - signatures.keys():
+            del self.sequences_database[name] # The same dict object stays, unchanged sequences resolve their calls through it
+        for definition in definitions:
+            if definition.name in changed:
+                self.sequences_database[definition.name] = BuildSequence(definition, self.sequences_database, self.path)
+        self.sequence_signatures = signatures
+        return changed
+
+    def UpdatePlayback(self, lines, changed_sequences):
+        unused = {} # Signature -> old entries still up for reuse, in file order
+        for entry in self.entries:
+            if not entry.calls & changed_sequences:
+                unused.setdefault(entry.signature, []).append(entry)
+
+        entries = []
+        added = []
+        reused = []
+        for line in lines:
+            signature = PlaybackSignature(line)
+            candidates = unused.get(signature)
+            if candidates:
+                entry = candidates.pop(0)
+                reused.append(entry)
+            else:
+                action = ObjectifyPlayback(line, self.sequences_database, self.path)
+                timeline = action.GetTimeline() if action else {}
+                entry = PlaybackEntry(signature, line.timestamp, CalledNames(line.call.ToRaw(), set()), timeline, self.timeline)
+                added.append(entry)
+            entries.append(entry)
+
+        kept = {id(entry) for entry in reused}
+        removed = [entry for entry in self.entries if id(entry) not in kept]
+        old_order = {id(entry): i for i, entry in enumerate(self.entries)}
+        reordered = any(old_order[id(a)] > old_order[id(b)] for a, b in zip(reused, reused[1:]))
+        return entries, removed, added, reordered
+
+    def MergeRange(self, start, end): # Re-merges every key in [start, end] from all the lines that write there
+        tmline = self.timeline.tmline
+        for key in [key for key in tmline.keys() if start <= key <= end]:
+            del tmline[key]
+
+        half_step = self.timeline.min_step / 2 # Raw keys this close outside the range can still snap into it
+        actions = []
+        for entry in self.entries:
+            if entry.start is None or entry.end < start or entry.start > end:
+                continue
+            clipped = {key: tdata for key, tdata in entry.timeline.items() if start - half_step <= key + entry.timestamp <= end + half_step}
+            actions.append((entry.timestamp, clipped))
+
+        partial = SD.Timeline(self.max_aps)
+        partial.addActions(actions)
+        for key, tdata in partial.tmline.items():
+            if start <= key <= end:
+                tmline[key] = tdata
+
+
+def MergeRanges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1]:
+            merged[-1][1] = max(merged[-1][1], end)
+        else:
+            merged.append([start, end])
+    return [tuple(r) for r in merged]
+
+
+def RenderFrom(timeline: SD.Timeline, old: RunLengthFrames, ranges, keyframe_interval = DEFAULT_KEYFRAME_INTERVAL):
+    # Same result as CompressFrameBuffer(RenderTimeline(timeline)), but only ranges (and what comes after them until the state converges again) get rendered
+    # Everywhere else the keys are the same as before, so their runs are copied from old as they are
+    keys = sorted(timeline.tmline.keys())
+    if old is None:
+        ranges = [(keys[0], keys[-1])] if keys else []
+        old = BuildRunLength([], [], [], SD.MAX_LED, keyframe_interval)
+    reader = old.View() # The scheduler may be playing old right now, its cursor isn't ours to move
+
+    parts = ([], [], [])
+    run_count = 0
+    state = np.zeros((SD.MAX_LED, 3), dtype=np.uint8)
+    chunk = np.empty((STREAM_CHUNK, SD.MAX_LED, 3), dtype=np.uint8) # Rendered frames waiting to be compressed
+    chunk_keys = []
+    previous = state.copy() # State before the first frame in chunk
+
+    def AddPiece(piece):
+        nonlocal run_count
+        for part, value in zip(parts, piece):
+            part.append(value)
+        run_count += len(piece[0])
+
+    def Flush():
+        if chunk_keys:
+            AddPiece(CompressRuns(chunk_keys, chunk[:len(chunk_keys)], previous, run_count, keyframe_interval))
+            previous[:] = chunk[len(chunk_keys) - 1]
+            chunk_keys.clear()
+
+    def CopyOld(begin, end): # keys[begin:end] didn't change
+        if begin >= end:
+            return
+        first = old.Locate(keys[begin - 1]) + 1 if begin > 0 else 0
+        last = old.Locate(keys[end - 1]) + 1
+        if last > first:
+            AddPiece(CopyRuns(old, first, last, run_count, keyframe_interval))
+            old.StateAfter(last - 1, state)
+            previous[:] = state
+
+    rendered = 0
+    i = 0 # Next key that hasn't been filled
+    for range_index, (start, end) in enumerate(ranges):
+        first = max(int(np.searchsorted(keys, start, side="left")), i) # Can be behind i if converging the previous range already rendered into this one
+        CopyOld(i, first)
+
+        next_start = ranges[range_index + 1][0] if range_index + 1 < len(ranges) else None
+        j = first
+        while j < len(keys):
+            key = keys[j]
+            if next_start is not None and key >= next_start: # Ran into the next range, it picks up from here
+                break
+            timeline.tmline[key].compositor.Composite(state)
+            chunk[len(chunk_keys)] = state
+            chunk_keys.append(key)
+            if len(chunk_keys) == STREAM_CHUNK:
+                Flush()
+            rendered += 1
+            j += 1
+            if key > end and np.array_equal(reader.GetFrame(key), state):
+                break # Converged, from here on the old runs are right again
+        Flush()
+        i = j
+
+    CopyOld(i, len(keys))
+    Instr.Count("frames_rendered", rendered)
+    return BuildRunLength(*parts, SD.MAX_LED, keyframe_interval)
+
+
+class HotReloader():
+    preset: IncrementalPreset = None
+    scheduler = None # Optional PlaybackScheduler that gets the new frames
+    poll_interval = 0.1
+    on_reload = None # Called with (ranges, seconds) after every successful reload
+
+    def __init__(self, path: Path, scheduler = None, max_aps = None, poll_interval = 0.1, on_reload = None):
+        self.preset = IncrementalPreset(path, max_aps)
+        self.scheduler = scheduler
+        self.poll_interval = poll_interval
+        self.on_reload = on_reload
+        self.stopped = False
+        self.mtime = None
+
+    def GetFrames(self):
+        return self.preset.frames
+
+    def Load(self):
+        self.mtime = os.stat(self.preset.path).st_mtime_ns
+        self.preset.Load()
+        return self.preset.frames
+
+    async def Run(self):
+        loop = asyncio.get_running_loop()
+        if self.mtime is None:
+            await loop.run_in_executor(None, self.Load)
+            self.Swap()
+
+        while not self.stopped:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                mtime = os.stat(self.preset.path).st_mtime_ns
+            except OSError: # Editors sometimes delete and recreate the file when saving
+                continue
+            if mtime == self.mtime:
+                continue
+            self.mtime = mtime
+
+            started = time.perf_counter()
+            try:
+                source = self.preset.path.read_text()
+                ranges = await loop.run_in_executor(None, self.preset.Reload, source) # Off the loop, so playback keeps its ticks
+            except ArgbexSyntaxError as e: # Half written file, keep playing the last good version
+                print(f"Reload failed: {e}")
+                continue
+            except Exception as e: # File gone mid-save, bad encoding, half typed values... none of it should stop the watcher, a failed reload leaves the preset stale so the next one starts over
+                print(f"Reload failed: {type(e).__name__}: {e}")
+                continue
+            self.Swap()
+            if self.on_reload is not None:
+                self.on_reload(ranges, time.perf_counter() - started)
+
+    def Swap(self):
+        if self.scheduler is not None:
+            self.scheduler.SwapSource(self.preset.frames)
+
+    def Stop(self):
+        self.stopped = True
+
+
+if __name__ == "__main__":
+    from playback import PlaybackScheduler
+
+    parser = argparse.ArgumentParser(description="Play a preset and reload it every time it's saved")
+    parser.add_argument("preset", type=Path)
+    parser.add_argument("--loop", action="store_true", help="Start over at the end of the song")
+    args = parser.parse_args()
+
+    async def Main():
+        reloader = HotReloader(args.preset, on_reload=lambda ranges, seconds: print(f"Reloaded {len(ranges)} ranges in {seconds * 1000:.1f}ms"))
+        scheduler = PlaybackScheduler(reloader.Load(), lambda position, frame: None)
+        reloader.scheduler = scheduler
+        task = asyncio.get_running_loop().create_task(reloader.Run())
+        print(await scheduler.Run(loop_song=args.loop))
+        reloader.Stop()
+        await task
+
+    asyncio.run(Main())
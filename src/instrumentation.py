@@ -0,0 +1,174 @@
+# Timed spans, counters and histograms for finding out which stage (parse, objectify, merge, render, emit) makes a show stutter
+# Off by default, turn it on with Enable() or ARGBEX_INSTRUMENT=1
+# Hot loops check ENABLED themselves before calling in here, so a disabled build only pays for one attribute lookup
+import bisect
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+ENABLED = os.environ.get("ARGBEX_INSTRUMENT", "") not in ("", "0")
+
+LATENESS_BUCKETS = (0.5, 1, 2, 5, 10, 20, 50, 100, 250) # Upper bounds in ms, anything later goes in the last (overflow) bucket
+
+_NULL_SPAN = nullcontext() # Reusable, so a disabled Span() doesn't allocate anything
+
+
+class SpanStats():
+    count = 0
+    total = 0.0 # Seconds
+    max = 0.0
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def Record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def ToDict(self):
+        return {
+            "count": self.count,
+            "total_ms": self.total * 1000,
+            "mean_ms": self.total * 1000 / self.count if self.count else 0.0,
+            "max_ms": self.max * 1000,
+        }
+
+
+class Histogram():
+    bounds = LATENESS_BUCKETS
+    counts = None # One more than bounds, the last one is everything above bounds[-1]
+    count = 0
+    total = 0.0
+    max = 0.0
+
+    def __init__(self, bounds = LATENESS_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def Record(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def GetPercentile(self, percentile): # Upper bound of the bucket the percentile falls into, good enough to spot a tail
+        if not self.count:
+            return 0.0
+        target = self.count * percentile / 100
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return self.max
+
+    def ToDict(self):
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0.0,
+            "max": self.max,
+            "p50": self.GetPercentile(50),
+            "p99": self.GetPercentile(99),
+            "buckets": {f"<={bound}": count for bound, count in zip(self.bounds, self.counts)} | {f">{self.bounds[-1]}": self.counts[-1]},
+        }
+
+
+spans: dict[str, SpanStats] = {}
+counters: dict[str, int] = {}
+histograms: dict[str, Histogram] = {}
+_lock = threading.Lock() # Only guards creating new entries and Snapshot/Reset, updates are plain Python ops
+
+_dumper = None
+
+
+def Enable():
+    global ENABLED
+    ENABLED = True
+
+def Disable():
+    global ENABLED
+    ENABLED = False
+
+def Reset():
+    with _lock:
+        spans.clear()
+        counters.clear()
+        histograms.clear()
+
+
+def RecordSpan(name, seconds):
+    stats = spans.get(name)
+    if stats is None:
+        with _lock:
+            stats = spans.setdefault(name, SpanStats())
+    stats.Record(seconds)
+
+@contextmanager
+def _TimedSpan(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        RecordSpan(name, time.perf_counter() - start)
+
+def Span(name): # with Span("render"): ...
+    if not ENABLED:
+        return _NULL_SPAN
+    return _TimedSpan(name)
+
+def Count(name, amount = 1):
+    if ENABLED:
+        counters[name] = counters.get(name, 0) + amount
+
+def Observe(name, value, bounds = LATENESS_BUCKETS): # Adds value to the histogram called name
+    if not ENABLED:
+        return
+    histogram = histograms.get(name)
+    if histogram is None:
+        with _lock:
+            histogram = histograms.setdefault(name, Histogram(bounds))
+    histogram.Record(value)
+
+
+def Snapshot(): # Plain dicts, safe to json.dumps or keep around
+    with _lock:
+        return {
+            "time": time.time(),
+            "enabled": ENABLED,
+            "spans": {name: stats.ToDict() for name, stats in spans.items()},
+            "counters": dict(counters),
+            "histograms": {name: histogram.ToDict() for name, histogram in histograms.items()},
+        }
+
+
+def _DumpLoop(interval, stream, stop):
+    while not stop.wait(interval):
+        stream.write(json.dumps(Snapshot()) + "\n")
+        stream.flush()
+
+def StartDump(interval = 5.0, stream = None): # Writes a Snapshot as one JSON line every interval seconds, from a daemon thread
+    global _dumper
+    StopDump()
+    stop = threading.Event()
+    thread = threading.Thread(target=_DumpLoop, args=(interval, stream or sys.stderr, stop), name="instrumentation-dump", daemon=True)
+    thread.start()
+    _dumper = (thread, stop)
+
+def StopDump():
+    global _dumper
+    if _dumper is not None:
+        thread, stop = _dumper
+        stop.set()
+        thread.join()
+        _dumper = None
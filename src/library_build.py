@@ -0,0 +1,87 @@
+# Compiles a whole directory of presets into the preset cache, spread over every core
+# Workers only send back a small summary, the frames go straight from the worker to the cache file
+import argparse
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+import sequence_definitions as SD
+import preset_cache as PC
+
+PRESET_PATTERN = "*.argbex"
+
+
+def InitWorker(max_led, max_aps): # Every worker needs the same settings as the parent, they're module globals
+    SD.MAX_LED = max_led
+    SD.MAX_APS = max_aps
+
+
+def CompileWorker(preset_path: str, cache_path: str, preset_hash: str):
+    started = time.perf_counter()
+    try:
+        frames = PC.CompilePreset(Path(preset_path), Path(cache_path), preset_hash=preset_hash)
+    except Exception as e: # One broken preset shouldn't take the whole build down, it gets reported in the summary
+        return {"path": preset_path, "status": "error", "seconds": time.perf_counter() - started, "frames": 0, "error": f"{type(e).__name__}: {e}"}
+    return {"path": preset_path, "status": "compiled", "seconds": time.perf_counter() - started, "frames": len(frames), "error": None}
+
+
+def FindPresets(directory: Path):
+    return sorted(path for path in Path(directory).rglob(PRESET_PATTERN) if path.is_file())
+
+
+def BuildLibrary(directory: Path, cache_dir: Path = None, jobs = None, force = False, max_led = None, max_aps = None):
+    max_led = SD.MAX_LED if max_led is None else max_led
+    max_aps = SD.MAX_APS if max_aps is None else max_aps
+
+    results = []
+    stale = []
+    for preset_path in FindPresets(directory): # Hashing is cheap, only presets that actually changed go to the pool
+        preset_hash = PC.PresetHash(preset_path.read_bytes(), max_led, max_aps)
+        cache_path = PC.GetCachePath(preset_path, preset_hash, cache_dir)
+        if not force and PC.IsCacheFresh(cache_path, preset_hash):
+            results.append({"path": str(preset_path), "status": "unchanged", "seconds": 0.0, "frames": None, "error": None})
+        else:
+            stale.append((str(preset_path), str(cache_path), preset_hash))
+
+    if stale:
+        workers = min(jobs or os.cpu_count() or 1, len(stale))
+        with ProcessPoolExecutor(max_workers=workers, initializer=InitWorker, initargs=(max_led, max_aps)) as pool:
+            futures = [pool.submit(CompileWorker, *job) for job in stale]
+            for future in as_completed(futures):
+                results.append(future.result())
+
+    return sorted(results, key=lambda result: result["path"])
+
+
+def PrintSummary(results, elapsed):
+    width = max([len(result["path"]) for result in results] + [6])
+    print(f"{'Preset':<{width}}  {'Status':<10} {'Time':>9} {'Frames':>8}")
+    for result in results:
+        frames = "" if result["frames"] is None else result["frames"]
+        print(f"{result['path']:<{width}}  {result['status']:<10} {result['seconds'] * 1000:7.1f}ms {frames:>8}")
+        if result["error"]:
+            print(f"    {result['error']}")
+
+    counts = {}
+    for result in results:
+        counts[result["status"]] = counts.get(result["status"], 0) + 1
+    worked = sum(result["seconds"] for result in results)
+    print(f"{len(results)} presets ({', '.join(f'{count} {status}' for status, count in sorted(counts.items()))}) in {elapsed:.2f}s, {worked:.2f}s of compile time")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile every preset of a library into the preset cache")
+    parser.add_argument("directory", nargs="?", default="presets")
+    parser.add_argument("--cache-dir", type=Path, default=None, help="Defaults to .argbex_cache next to each preset")
+    parser.add_argument("--jobs", type=int, default=None, help="Worker processes, defaults to every core")
+    parser.add_argument("--force", action="store_true", help="Recompile even if the cache is up to date")
+    parser.add_argument("--max-led", type=int, default=SD.MAX_LED)
+    parser.add_argument("--max-aps", type=int, default=SD.MAX_APS)
+    args = parser.parse_args()
+
+    started = time.perf_counter()
+    results = BuildLibrary(Path(args.directory), args.cache_dir, args.jobs, args.force, args.max_led, args.max_aps)
+    PrintSummary(results, time.perf_counter() - started)
+    if any(result["status"] == "error" for result in results):
+        raise SystemExit(1)
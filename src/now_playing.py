@@ -0,0 +1,302 @@
+# Long lived now playing watcher, one backend session for the whole run and song changes pushed as they happen
+# Backends: WinsdkBackend (Windows media controls) and FakeBackend (lines from a file / named pipe, or Push() calls) for testing on Linux
+import argparse
+import asyncio
+import inspect
+import json
+import os
+import stat
+import threading
+import time
+from datetime import datetime, timezone
+from typing import NamedTuple
+
+
+class NowPlaying(NamedTuple):
+    artist: str
+    title: str
+    position: float = 0.0 # Song position in ms at the moment it was sampled
+    playing: bool = True
+    sampled: float = 0.0 # time.monotonic() of the sample
+
+    def Key(self): # What counts as "the same song"
+        return self.artist, self.title
+
+    def GetPosition(self, now = None): # Position extrapolated to now, it only moves while playing
+        if not self.playing:
+            return self.position
+        return self.position + ((now if now is not None else time.monotonic()) - self.sampled) * 1000
+
+
+class MediaBackend(): # Interface for everything the watcher can listen to
+    loop = None
+    changed: asyncio.Event = None
+
+    async def Open(self):
+        self.loop = asyncio.get_running_loop()
+        self.changed = asyncio.Event()
+
+    async def Close(self):
+        pass
+
+    async def Query(self): # Returns a NowPlaying, or None if nothing is playing
+        raise NotImplementedError
+
+    def Notify(self): # Something changed, safe to call from any thread (backend callbacks usually aren't on our loop)
+        if self.loop is None:
+            return
+        try:
+            self.loop.call_soon_threadsafe(self.changed.set)
+        except RuntimeError: # Loop already closed
+            pass
+
+    async def WaitForChange(self, timeout): # True if the backend pushed a change, False if we just timed out (backends that can't push get polled)
+        try:
+            await asyncio.wait_for(self.changed.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        self.changed.clear()
+        return True
+
+
+class WinsdkBackend(MediaBackend):
+    # Credit goes to tameTNT | https://stackoverflow.com/questions/65011660/how-can-i-get-the-title-of-the-currently-playing-media-in-windows-10-with-python
+    PLAYING = 4 # GlobalSystemMediaTransportControlsSessionPlaybackStatus.PLAYING
+
+    manager = None
+    session = None
+    subscribe = True
+
+    def __init__(self, subscribe = True):
+        self.subscribe = subscribe # Without it Query still works, the watcher just falls back to polling
+        self.session = None
+        self.tokens = []
+        self.manager_token = None
+
+    async def Open(self):
+        await super().Open()
+        if self.manager is None: # Imported here so the rest of the program doesn't need winsdk
+            from winsdk.windows.media.control import GlobalSystemMediaTransportControlsSessionManager as MediaManager
+            self.manager = await MediaManager.request_async() # One session manager for as long as we run
+
+        if self.subscribe:
+            self.manager_token = self.manager.add_current_session_changed(lambda sender, args: self.OnSessionChanged())
+            self.Watch(self.manager.get_current_session())
+
+    async def Close(self):
+        self.Unwatch()
+        if self.manager_token is not None:
+            self.manager.remove_current_session_changed(self.manager_token)
+            self.manager_token = None
+
+    def Watch(self, session): # Media, playback and timeline events of the current session all end up in Notify()
+        self.Unwatch()
+        self.session = session
+        if session is None:
+            return
+        self.tokens = [
+            (session.remove_media_properties_changed, session.add_media_properties_changed(lambda sender, args: self.Notify())),
+            (session.remove_playback_info_changed, session.add_playback_info_changed(lambda sender, args: self.Notify())),
+            (session.remove_timeline_properties_changed, session.add_timeline_properties_changed(lambda sender, args: self.Notify())),
+        ]
+
+    def Unwatch(self):
+        for remove, token in self.tokens:
+            remove(token)
+        self.tokens = []
+        self.session = None
+
+    def OnSessionChanged(self): # Player switched, follow the new one
+        self.Watch(self.manager.get_current_session())
+        self.Notify()
+
+    async def Query(self):
+        session = self.manager.get_current_session()
+        if session is None: # There needs to be a media session running
+            return None
+
+        info = await session.try_get_media_properties_async()
+        playing = session.get_playback_info().playback_status == self.PLAYING
+        position = 0.0
+        timeline = session.get_timeline_properties()
+        if timeline is not None:
+            position = timeline.position.total_seconds() * 1000
+            if playing and timeline.last_updated_time is not None: # Windows only updates the position now and then
+                position += (datetime.now(timezone.utc) - timeline.last_updated_time).total_seconds() * 1000
+
+        return NowPlaying(info.artist, info.title, position, playing, time.monotonic())
+
+
+class FakeBackend(MediaBackend):
+    # Every line is a new state, either JSON ({"artist": .., "title": .., "position": ms, "playing": true}) or "Artist - Title"
+    # An empty line or "-" means nothing is playing
+    # The path can be a regular file (read, then followed like tail -f) or a named pipe (reopened when the writer closes it)
+    path = None
+    poll_interval = 0.05 # How often a followed regular file is checked for new lines
+    current: NowPlaying = None
+
+    def __init__(self, path = None, poll_interval = 0.05):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.current = None
+        self.closed = threading.Event()
+        self.reader = None
+
+    async def Open(self):
+        await super().Open()
+        if self.path is not None and self.reader is None:
+            self.reader = threading.Thread(target=self.ReadLoop, name="fake-now-playing", daemon=True) # Opening a pipe blocks, so it can't live on the loop
+            self.reader.start()
+
+    async def Close(self):
+        self.closed.set()
+
+    async def Query(self):
+        return self.current
+
+    def Push(self, artist, title, position = 0.0, playing = True): # Programmatic version of writing a line
+        self.current = NowPlaying(artist, title, float(position), playing, time.monotonic())
+        self.Notify()
+
+    def Clear(self):
+        self.current = None
+        self.Notify()
+
+    def PushLine(self, line):
+        line = line.strip()
+        if not line or line == "-":
+            self.Clear()
+        elif line.startswith("{"):
+            state = json.loads(line)
+            self.Push(state.get("artist", ""), state.get("title", ""), state.get("position", 0.0), state.get("playing", True))
+        else:
+            artist, _, title = line.partition(" - ")
+            self.Push(artist.strip(), title.strip())
+
+    def ReadLoop(self):
+        last_error = None # Only printed when it changes, the file can be missing for a long time
+        while not self.closed.is_set():
+            try:
+                is_pipe = stat.S_ISFIFO(os.stat(self.path).st_mode)
+                with open(self.path, "r") as source:
+                    if last_error is not None:
+                        print(f"Fake backend: reading {self.path} again")
+                        last_error = None
+                    partial = "" # A line the writer hasn't finished yet
+                    while not self.closed.is_set():
+                        line = partial + source.readline()
+                        partial = ""
+                        if line.endswith("\n"):
+                            self.ReadLine(line)
+                        elif is_pipe: # Writer went away, take what it left and wait for the next one
+                            if line:
+                                self.ReadLine(line)
+                            break
+                        else: # End of a regular file, wait for more to be appended
+                            partial = line
+                            time.sleep(self.poll_interval)
+            except OSError as e: # File isn't there (yet), keep trying
+                if str(e) != last_error:
+                    print(f"Fake backend: {e}")
+                    last_error = str(e)
+                self.closed.wait(self.poll_interval)
+
+    def ReadLine(self, line):
+        try:
+            self.PushLine(line)
+        except ValueError as e: # Broken JSON, skip the line
+            print(f"Fake backend: {e} in {line.strip()!r}")
+
+
+class NowPlayingWatcher():
+    backend: MediaBackend = None
+    debounce = 0.1 # Seconds a new song has to stay put before it's announced (skipping through tracks only announces the last one)
+    poll_interval = 1.0 # Upper bound between queries, backends that push changes get queried right away
+    current: NowPlaying = None # Latest sample, also updated when only the position moved
+    announced: NowPlaying = None # Song the subscribers were last told about
+
+    def __init__(self, backend: MediaBackend, debounce = 0.1, poll_interval = 1.0):
+        self.backend = backend
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.current = None
+        self.announced = None
+        self.subscribers = []
+        self.stopped = False
+        self.task = None
+
+    def Subscribe(self, callback): # Called with a NowPlaying (or None when playback stops) on every song change, can be a coroutine function
+        self.subscribers.append(callback)
+
+    def GetCurrent(self):
+        return self.current
+
+    def GetPosition(self): # Song position in ms right now, None if nothing is playing
+        if self.current is None:
+            return None
+        return self.current.GetPosition()
+
+    async def Announce(self, song):
+        self.announced = song
+        for callback in self.subscribers:
+            result = callback(song)
+            if inspect.isawaitable(result):
+                await result
+
+    async def Settle(self, song): # Keeps querying while changes keep coming in, returns once nothing changed for a whole debounce
+        while self.debounce > 0 and await self.backend.WaitForChange(self.debounce):
+            song = await self.backend.Query()
+            self.current = song
+        return song
+
+    async def Run(self):
+        await self.backend.Open()
+        try:
+            song = await self.backend.Query() # Whatever is playing when we start gets announced without debouncing
+            self.current = song
+            if song is not None:
+                await self.Announce(song)
+
+            while not self.stopped:
+                await self.backend.WaitForChange(self.poll_interval)
+                if self.stopped:
+                    break
+                song = await self.backend.Query()
+                self.current = song
+                if self.IsNewSong(song):
+                    song = await self.Settle(song)
+                    if self.IsNewSong(song):
+                        await self.Announce(song)
+        finally:
+            await self.backend.Close()
+
+    def IsNewSong(self, song):
+        if song is None or self.announced is None:
+            return (song is None) != (self.announced is None)
+        return song.Key() != self.announced.Key()
+
+    def Start(self): # Runs the watcher as a task on the current loop
+        self.task = asyncio.get_running_loop().create_task(self.Run())
+        return self.task
+
+    async def Stop(self):
+        self.stopped = True
+        if self.backend.changed is not None:
+            self.backend.changed.set() # Wake the loop up
+        if self.task is not None:
+            await self.task
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print song changes as they happen")
+    parser.add_argument("--fake", metavar="PATH", help="Read states from a file or named pipe instead of the Windows media controls")
+    parser.add_argument("--debounce", type=float, default=0.1)
+    args = parser.parse_args()
+
+    backend = FakeBackend(args.fake) if args.fake else WinsdkBackend()
+    watcher = NowPlayingWatcher(backend, args.debounce)
+    watcher.Subscribe(lambda song: print(f"Now playing: {song.artist} - {song.title} at {song.GetPosition() / 1000:.1f}s" if song else "Nothing playing"))
+    try:
+        asyncio.run(watcher.Run())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,201 @@
+# Real time playback, emits frames at the MAX_APS cadence against a monotonic clock
+# Every tick has an absolute deadline (start + n * period) so errors never add up, late ticks are coalesced into the newest due frame
+# Heavy work (ParseFile, rendering) should go through loop.run_in_executor so it doesn't steal ticks from the scheduler
+import asyncio
+import inspect
+import time
+from collections import deque
+from pathlib import Path
+
+import sequence_definitions as SD
+import instrumentation as Instr
+from frame_buffer import FrameBuffer
+
+
+class PlaybackStats():
+    frames_emitted = 0
+    frames_dropped = 0 # Ticks that were skipped because we were late
+    max_lateness = 0.0
+    total_lateness = 0.0
+    recent = None # Lateness of the last frames, in seconds
+
+    def __init__(self, history = 1000):
+        self.frames_emitted = 0
+        self.frames_dropped = 0
+        self.max_lateness = 0.0
+        self.total_lateness = 0.0
+        self.recent = deque(maxlen=history)
+
+    def Record(self, lateness):
+        self.frames_emitted += 1
+        self.total_lateness += lateness
+        self.max_lateness = max(self.max_lateness, lateness)
+        self.recent.append(lateness)
+
+    def GetMeanLateness(self):
+        if not self.frames_emitted:
+            return 0.0
+        return self.total_lateness / self.frames_emitted
+
+    def __repr__(self):
+        return f"<PlaybackStats emitted: {self.frames_emitted}, dropped: {self.frames_dropped}, mean late: {self.GetMeanLateness() * 1000:.3f}ms, max late: {self.max_lateness * 1000:.3f}ms>"
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class PlaybackScheduler():
+    frames: FrameBuffer = None # Or anything else with timestamps and GetFrame(ms), eg. RunLengthFrames or a TimelineIndex
+    sink = None # Called with (position in ms, frame), can be a coroutine function
+    period = 0.0 # Seconds between frames
+    on_lateness = None # Optional, called with (position in ms, lateness in s) after every frame
+    stats: PlaybackStats = None
+
+    def __init__(self, source, sink, max_aps = None, on_lateness = None, clock = time.monotonic):
+        if isinstance(source, SD.Timeline):
+            self.period = source.min_step / 1000 # The timeline already knows its step
+            source = source.GetRunLengthFrames() # Memory goes with the number of changes, not the length of the song
+        else:
+            self.period = 1 / (max_aps or SD.MAX_APS)
+        if max_aps: # Explicit rate always wins
+            self.period = 1 / max_aps
+
+        self.frames = source
+        self.sink = sink
+        self.on_lateness = on_lateness
+        self.clock = clock
+        self.stats = PlaybackStats()
+
+        self.position = 0.0 # Song position in ms of the next tick
+        self.last_emitted = None # Position of the last frame the sink got, a resume doesn't send it again
+        self.seeks = 0 # Bumped by every Seek, an emit that was still in flight across one doesn't count as sent
+        self.anchor = None # (clock time, song position) everything is scheduled from
+        self.tick = 0
+        self.running = asyncio.Event()
+        self.running.set()
+        self.stopped = False
+        self.wakeup = None
+
+    def GetEnd(self): # Song position after which there's nothing new to show
+        if not len(self.frames):
+            return 0.0
+        return float(self.frames.timestamps[-1])
+
+    def SwapSource(self, frames): # New frames for the same song (eg. the preset was edited), playback carries on from where it is
+        self.frames = frames
+        self.Interrupt()
+
+    def Reanchor(self):
+        self.anchor = (self.clock(), self.position)
+        self.tick = 0
+
+    def Interrupt(self): # Wakes the loop up if it's sleeping until the next tick
+        if self.wakeup is not None and not self.wakeup.done():
+            self.wakeup.set_result(None)
+
+    def Pause(self):
+        self.running.clear()
+        self.Interrupt()
+
+    def Resume(self):
+        if not self.running.is_set():
+            self.anchor = None # Re-anchor when the loop picks up again, the pause shouldn't count as lateness
+            self.running.set()
+
+    def Seek(self, position_ms):
+        self.position = max(0.0, float(position_ms))
+        self.anchor = None
+        self.last_emitted = None # A seek always shows the frame it lands on
+        self.seeks += 1
+        self.Interrupt()
+
+    def Stop(self):
+        self.stopped = True
+        self.running.set()
+        self.Interrupt()
+
+    def IsPaused(self):
+        return not self.running.is_set()
+
+    async def Emit(self, position, frame):
+        result = self.sink(position, frame)
+        if inspect.isawaitable(result):
+            await result
+
+    async def Sleep(self, seconds):
+        self.wakeup = asyncio.get_running_loop().create_future()
+        try:
+            await asyncio.wait_for(self.wakeup, seconds)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.wakeup = None
+
+    async def Run(self, loop_song = False):
+        period_ms = self.period * 1000
+        self.anchor = None
+
+        while not self.stopped:
+            if not self.running.is_set():
+                await self.running.wait()
+                continue
+
+            if self.anchor is None:
+                self.Reanchor()
+
+            anchor_time, anchor_position = self.anchor
+            due = anchor_time + self.tick * self.period
+            now = self.clock()
+            if now < due:
+                await self.Sleep(due - now)
+                if self.anchor is None or self.stopped or not self.running.is_set(): # Seek, pause or stop while sleeping
+                    continue
+                now = self.clock()
+
+            lateness = now - due
+            if lateness >= self.period: # Missed whole ticks, jump straight to the newest one instead of playing catch up
+                skipped = int(lateness // self.period)
+                self.tick += skipped
+                self.stats.frames_dropped += skipped
+                if Instr.ENABLED:
+                    Instr.Count("frames_dropped", skipped)
+                due = anchor_time + self.tick * self.period
+                lateness = now - due
+
+            self.position = anchor_position + self.tick * period_ms
+            if self.position > self.GetEnd() + period_ms:
+                if not loop_song:
+                    break
+                self.Seek(0)
+                continue
+
+            if self.position == self.last_emitted: # Resumed on the frame we paused on, the sink already has it
+                self.tick += 1
+                continue
+
+            position = self.position # Seek can move self.position while the emit is awaited
+            seeks = self.seeks
+            if Instr.ENABLED:
+                emit_start = time.perf_counter()
+                await self.Emit(position, self.frames.GetFrame(position))
+                Instr.RecordSpan("emit", time.perf_counter() - emit_start)
+                Instr.Count("frames_emitted")
+                Instr.Observe("frame_lateness_ms", lateness * 1000)
+            else:
+                await self.Emit(position, self.frames.GetFrame(position))
+            if seeks == self.seeks: # Otherwise the sink hasn't seen the frame we seeked to yet
+                self.last_emitted = position
+            self.stats.Record(lateness)
+            if self.on_lateness is not None:
+                self.on_lateness(position, lateness)
+            self.tick += 1
+
+        return self.stats
+
+
+if __name__ == "__main__":
+    from argbex_parser import ParseFile
+
+    timeline = ParseFile(Path("presets/test.argbex"), SD.Timeline(SD.MAX_APS))
+    scheduler = PlaybackScheduler(timeline, lambda position, frame: None)
+    print(asyncio.run(scheduler.Run()))
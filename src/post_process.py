@@ -0,0 +1,259 @@
+# Post-processing of rendered frames before they go out to the LEDs, gamma, brightness, color temperature and a power limit
+# Every stage works on (..., leds, 3) uint8 arrays, so a single frame and a whole FrameBuffer go through the same code
+# Stages that only remap channel values (gamma, brightness, temperature) get fused into one (3, 256) lookup table, the whole chain of them costs one table lookup per value
+import argparse
+import time
+
+import numpy as np
+import sequence_definitions as SD
+import instrumentation as Instr
+from frame_buffer import FrameBuffer
+
+
+class LutStage(): # Base for stages that map every channel value on its own, subclasses fill lut
+    lut = None # (3, 256) uint8, new value of every old value, per channel
+
+    def Apply(self, frames, out = None):
+        return ApplyLut(self.lut, frames, out)
+
+    def __repr__(self):
+        return f"<{type(self).__name__}>"
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class GammaStage(LutStage): # LEDs are linear, eyes aren't, without this dim colors look way too bright
+    gamma = 2.2
+
+    def __init__(self, gamma = 2.2):
+        gammas = np.broadcast_to(np.asarray(gamma, dtype=np.float64), (3,)) # One gamma for all channels, or one per channel
+        if np.any(gammas <= 0):
+            raise ValueError(f"Gamma has to be positive, got {gamma}")
+        self.gamma = gamma
+        self.lut = np.round(255 * (np.arange(256) / 255)[np.newaxis] ** gammas[:, np.newaxis]).astype(np.uint8)
+
+    def __repr__(self):
+        return f"<GammaStage {self.gamma}>"
+
+
+class BrightnessStage(LutStage):
+    brightness = 1.0 # 0..1
+
+    def __init__(self, brightness = 1.0):
+        if not 0 <= brightness <= 1:
+            raise ValueError(f"Brightness has to be between 0 and 1, got {brightness}")
+        self.brightness = brightness
+        self.lut = np.tile(np.round(np.arange(256) * brightness).astype(np.uint8), (3, 1))
+
+    def __repr__(self):
+        return f"<BrightnessStage {self.brightness}>"
+
+
+class ColorTemperatureStage(LutStage): # White point correction, scales the channels like a light of that temperature would
+    kelvin = 6600 # About neutral white, lower is warmer
+
+    def __init__(self, kelvin = 6600):
+        self.kelvin = kelvin
+        gains = KelvinToGains(kelvin)
+        self.lut = np.round(np.arange(256)[np.newaxis] * gains[:, np.newaxis]).astype(np.uint8)
+
+    def __repr__(self):
+        return f"<ColorTemperatureStage {self.kelvin}K>"
+
+
+def KelvinToGains(kelvin): # (3,) channel gains 0..1 of a blackbody at kelvin, Tanner Helland's fit, good from 1000K to 40000K
+    if not 1000 <= kelvin <= 40000:
+        raise ValueError(f"Color temperature has to be between 1000K and 40000K, got {kelvin}")
+    t = kelvin / 100
+    if t <= 66:
+        red = 255.0
+        green = 99.4708025861 * np.log(t) - 161.1195681661
+        blue = 0.0 if t <= 19 else 138.5177312231 * np.log(t - 10) - 305.0447927307
+    else:
+        red = 329.698727446 * (t - 60) ** -0.1332047592
+        green = 288.1221695283 * (t - 60) ** -0.0755148492
+        blue = 255.0
+    return np.clip(np.array([red, green, blue]), 0, 255) / 255
+
+
+POWER_CHUNK = 256 # Frames PowerLimitStage scales at once in a batch
+
+
+class PowerLimitStage(): # Scales down whole frames that would draw more current than the power supply can give
+    max_milliamps = 0
+    milliamps_per_channel = 20.0 # Current of one channel at 255, WS2812B is about 20mA
+    idle_milliamps = 1.0 # Per LED, drawn even when it's dark
+
+    def __init__(self, max_milliamps, milliamps_per_channel = 20.0, idle_milliamps = 1.0):
+        if max_milliamps <= 0:
+            raise ValueError(f"Power limit has to be positive, got {max_milliamps}mA")
+        self.max_milliamps = max_milliamps
+        self.milliamps_per_channel = milliamps_per_channel
+        self.idle_milliamps = idle_milliamps
+        self.frames_limited = 0
+
+    def GetMilliamps(self, frames): # Estimated draw of every frame, (...) float64
+        leds = frames.shape[-2]
+        levels = frames.reshape(frames.shape[:-2] + (-1,)).sum(axis=-1, dtype=np.uint64) # Up to 765 per LED, fine for any strip
+        return levels * (self.milliamps_per_channel / 255) + leds * self.idle_milliamps
+
+    def Apply(self, frames, out = None):
+        if out is None:
+            out = frames.copy()
+        elif out is not frames:
+            out[...] = frames
+
+        budget = self.max_milliamps - frames.shape[-2] * self.idle_milliamps # What's left for the colors
+        draw = self.GetMilliamps(frames) - frames.shape[-2] * self.idle_milliamps
+        over = draw > budget
+        if np.any(over):
+            scales = (max(budget, 0) / draw[over]).astype(np.float32) # Rounding down below keeps it under the budget
+            if out.ndim == 2: # Single frame
+                np.multiply(out, scales[0], out=out, casting="unsafe")
+            else:
+                indices = np.flatnonzero(over)
+                for begin in range(0, len(indices), POWER_CHUNK): # The float copy of a whole song would be huge
+                    chunk = indices[begin:begin + POWER_CHUNK]
+                    out[chunk] = out[chunk] * scales[begin:begin + POWER_CHUNK, np.newaxis, np.newaxis]
+            limited = int(np.count_nonzero(over))
+            self.frames_limited += limited
+            if Instr.ENABLED:
+                Instr.Count("frames_power_limited", limited)
+        return out
+
+    def __repr__(self):
+        return f"<PowerLimitStage {self.max_milliamps}mA>"
+
+    def __str__(self):
+        return self.__repr__()
+
+
+def ApplyLut(lut, frames, out = None): # lut (3, 256) onto (..., leds, 3) uint8 frames
+    if out is None:
+        out = np.empty_like(frames)
+    if np.all(lut == lut[0]): # Same table for every channel, one lookup for the whole array
+        np.take(lut[0], frames, out=out)
+    else:
+        for channel in range(3):
+            out[..., channel] = lut[channel][frames[..., channel]]
+    return out
+
+
+def FuseLuts(luts): # Several tables applied one after the other -> one table
+    fused = np.tile(np.arange(256, dtype=np.uint8), (3, 1))
+    for lut in luts:
+        fused = np.take_along_axis(lut, fused.astype(np.intp), axis=1)
+    return fused
+
+
+class PostProcessor(): # Stages in the order they're applied, neighbouring lookup table stages are fused once here
+    stages: list = None
+    steps: list = None # What actually runs, a fused (3, 256) table or a stage
+
+    def __init__(self, stages = ()):
+        self.stages = list(stages)
+        self.steps = []
+        luts = []
+        for stage in self.stages:
+            if isinstance(stage, LutStage):
+                luts.append(stage.lut)
+                continue
+            if luts:
+                self.steps.append(FuseLuts(luts))
+                luts = []
+            self.steps.append(stage)
+        if luts:
+            self.steps.append(FuseLuts(luts))
+
+    def Apply(self, frames, out = None): # One (leds, 3) frame or a (frames, leds, 3) batch, frames itself is never changed (it may be a cache mmap)
+        if not self.steps:
+            if out is None:
+                return frames.copy()
+            out[...] = frames
+            return out
+
+        current = frames
+        for step in self.steps:
+            if type(step) == np.ndarray:
+                current = ApplyLut(step, current, out)
+            else:
+                current = step.Apply(current, out)
+            out = current # Everything after the first step works in place
+        return current
+
+    def ProcessFrameBuffer(self, frame_buffer: FrameBuffer):
+        with Instr.Span("post_process"):
+            return FrameBuffer(frame_buffer.timestamps, self.Apply(frame_buffer.frames))
+
+    def __len__(self):
+        return len(self.stages)
+
+    def __repr__(self):
+        return f"<PostProcessor {' -> '.join(map(repr, self.stages)) or 'nothing'}>"
+
+    def __str__(self):
+        return self.__repr__()
+
+
+def MakePostProcessor(gamma = None, brightness = None, kelvin = None, max_milliamps = None): # Usual order, the power limit sees what the LEDs will really get
+    stages = []
+    if kelvin is not None:
+        stages.append(ColorTemperatureStage(kelvin))
+    if brightness is not None:
+        stages.append(BrightnessStage(brightness))
+    if gamma is not None:
+        stages.append(GammaStage(gamma))
+    if max_milliamps is not None:
+        stages.append(PowerLimitStage(max_milliamps))
+    return PostProcessor(stages)
+
+
+class ProcessedSink(): # Puts a PostProcessor in front of a PlaybackScheduler sink, eg. OutputStage or ShardedOutput
+    processor: PostProcessor = None
+    sink = None
+
+    def __init__(self, processor: PostProcessor, sink):
+        self.processor = processor
+        self.sink = sink
+        self.buffer = None # Reused, sinks already copy what they keep
+
+    def __call__(self, position, frame):
+        if self.buffer is None or self.buffer.shape != frame.shape:
+            self.buffer = np.empty_like(frame)
+        return self.sink(position, self.processor.Apply(frame, self.buffer)) # The sink's awaitable (if any) goes back to the scheduler
+
+
+def AddPostProcessArguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--gamma", type=float, default=None)
+    parser.add_argument("--brightness", type=float, default=None, help="0..1")
+    parser.add_argument("--temperature", type=float, default=None, help="Color temperature in kelvin")
+    parser.add_argument("--max-milliamps", type=float, default=None, help="Power supply limit for the whole strip")
+
+def PostProcessorFromArguments(args):
+    return MakePostProcessor(args.gamma, args.brightness, args.temperature, args.max_milliamps)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the post-processing chain on random frames")
+    parser.add_argument("--leds", type=int, default=SD.MAX_LED * 10)
+    parser.add_argument("--frames", type=int, default=1000)
+    AddPostProcessArguments(parser)
+    args = parser.parse_args()
+
+    processor = PostProcessorFromArguments(args)
+    if not len(processor):
+        processor = MakePostProcessor(2.2, 0.8, 5000, args.leds * 10)
+    print(processor)
+    frames = np.random.default_rng(0).integers(0, 256, (args.frames, args.leds, 3), dtype=np.uint8)
+
+    start = time.perf_counter()
+    processor.Apply(frames)
+    batch = time.perf_counter() - start
+
+    out = np.empty_like(frames[0])
+    start = time.perf_counter()
+    for frame in frames:
+        processor.Apply(frame, out)
+    single = time.perf_counter() - start
+    print(f"{args.frames} frames of {args.leds} LEDs | batch {batch * 1000:.1f} ms | frame by frame {single * 1000 / args.frames:.3f} ms per frame ({args.frames / single:.0f} fps)")
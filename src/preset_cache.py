@@ -0,0 +1,191 @@
+# Compiled preset cache, stores the rendered frames of a preset (run-length compressed, see run_length.py) so playback can start without parsing or rendering
+# File layout (little endian):
+#   MAGIC | version u32 | metadata length u32 | metadata json | then every array listed in metadata["arrays"], each padded to 8 bytes
+import hashlib
+import json
+import mmap
+import os
+import re
+import struct
+import time
+from pathlib import Path
+
+import numpy as np
+
+import sequence_definitions as SD
+import instrumentation as Instr
+from frame_buffer import FrameBuffer
+from run_length import RunLengthFrames, CompressFrameBuffer, CompressStream
+
+MAGIC = b"ARGBEXC\0"
+FORMAT_VERSION = 2 # 2: run-length compressed frames instead of one full frame per timestamp
+CACHE_SUFFIX = ".argbexc"
+CACHE_DIR_NAME = ".argbex_cache"
+HEADER = struct.Struct("<8sII")
+VERSION_LENGTH = 16 # Hex digits of the preset hash in the cache file name
+
+
+def PresetHash(source: bytes, max_led = None, max_aps = None): # Anything that changes the rendered frames has to be in here
+    max_led = SD.MAX_LED if max_led is None else max_led
+    max_aps = SD.MAX_APS if max_aps is None else max_aps
+    digest = hashlib.sha256(source)
+    digest.update(f"|{FORMAT_VERSION}|{max_led}|{max_aps}".encode())
+    return digest.hexdigest()
+
+
+# Every version of a preset gets its own cache file (its hash is in the name), so a rebuild never has to replace a file
+# Windows can't replace or delete a file while it's mapped, and the frames of the old version may still be playing
+def GetCacheBase(preset_path: Path, cache_dir: Path = None): # Cache file name without the version
+    preset_path = Path(preset_path)
+    if cache_dir is None: # Next to the preset, names in one directory are already unique
+        return preset_path.parent / CACHE_DIR_NAME / preset_path.stem
+    # One shared directory for presets from anywhere, a/intro.argbex and b/intro.argbex need different files
+    location = hashlib.sha1(str(preset_path.resolve()).encode()).hexdigest()[:12]
+    return Path(cache_dir) / f"{preset_path.stem}-{location}"
+
+def GetCachePath(preset_path: Path, preset_hash: str, cache_dir: Path = None):
+    base = GetCacheBase(preset_path, cache_dir)
+    return base.with_name(f"{base.name}.{preset_hash[:VERSION_LENGTH]}{CACHE_SUFFIX}")
+
+def RemoveOldVersions(cache_path: Path): # Other versions of the same preset, the ones still mapped somewhere stay until a later write
+    base = cache_path.name[:-len(CACHE_SUFFIX) - VERSION_LENGTH - 1]
+    version = re.compile(re.escape(base) + rf"\.[0-9a-f]{{{VERSION_LENGTH}}}" + re.escape(CACHE_SUFFIX))
+    for old in cache_path.parent.iterdir():
+        if old.name != cache_path.name and version.fullmatch(old.name):
+            try:
+                old.unlink()
+            except OSError:
+                pass
+
+
+CACHE_ARRAYS = ( # (attribute of RunLengthFrames, dtype on disk), in file order
+    ("timestamps", "<i8"),
+    ("span_offsets", "<i8"),
+    ("keyframes", "u1"),
+    ("span_starts", "<u2"),
+    ("span_lengths", "<u2"),
+    ("span_colors", "u1"),
+)
+
+
+def WriteCache(cache_path: Path, frames, metadata: dict): # frames is RunLengthFrames, a FrameBuffer gets compressed first
+    cache_path = Path(cache_path)
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+    if isinstance(frames, FrameBuffer):
+        frames = CompressFrameBuffer(frames)
+
+    arrays = [np.ascontiguousarray(getattr(frames, name), dtype=dtype) for name, dtype in CACHE_ARRAYS]
+    metadata = dict(metadata,
+        frames=len(frames),
+        leds=int(frames.keyframes.shape[1]),
+        keyframe_interval=frames.keyframe_interval,
+        arrays=[[name, dtype, list(array.shape)] for (name, dtype), array in zip(CACHE_ARRAYS, arrays)],
+    )
+    meta_bytes = json.dumps(metadata).encode()
+
+    tmp_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.tmp") # Two processes writing the same cache don't share a tmp file
+    try:
+        with open(tmp_path, "wb") as cache:
+            cache.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(meta_bytes)))
+            cache.write(meta_bytes)
+            written = HEADER.size + len(meta_bytes)
+            for array in arrays:
+                cache.write(b"\0" * (-written % 8)) # Every array starts aligned, for the mmap views
+                written += -written % 8
+                cache.write(array.tobytes())
+                written += array.nbytes
+        os.replace(tmp_path, cache_path) # Readers never see a half written cache, only fails for the same version still mapped (a forced rebuild)
+    except OSError:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    RemoveOldVersions(cache_path)
+
+
+def ReadMetadata(cache_path: Path): # Only reads the header, used to check if the cache is stale
+    with open(cache_path, "rb") as cache:
+        magic, version, meta_len = HEADER.unpack(cache.read(HEADER.size))
+        if magic != MAGIC or version != FORMAT_VERSION:
+            return None
+        return json.loads(cache.read(meta_len))
+
+
+def ReadCache(cache_path: Path): # Returns (metadata, RunLengthFrames), the arrays are views straight into the mmap, nothing gets copied
+    with open(cache_path, "rb") as cache:
+        mapped = mmap.mmap(cache.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, version, meta_len = HEADER.unpack_from(mapped, 0)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise RuntimeError(f"{cache_path} is not a compatible preset cache")
+    metadata = json.loads(mapped[HEADER.size:HEADER.size + meta_len])
+
+    arrays = {}
+    offset = HEADER.size + meta_len
+    for name, dtype, shape in metadata["arrays"]:
+        offset += -offset % 8
+        array = np.frombuffer(mapped, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+        offset += array.nbytes
+        arrays[name] = array
+
+    return metadata, RunLengthFrames(keyframe_interval=metadata["keyframe_interval"], **arrays)
+
+
+def CompilePreset(preset_path: Path, cache_path: Path, source: bytes = None, preset_hash: str = None, required = True): # required = False only warns when the cache can't be written
+    from argbex_parser import ParseFile # Parser imports are only needed when we actually have to compile
+
+    preset_path = Path(preset_path)
+    if source is None:
+        source = preset_path.read_bytes()
+    if preset_hash is None:
+        preset_hash = PresetHash(source)
+
+    started = time.perf_counter()
+    timeline = ParseFile(preset_path, SD.Timeline(SD.MAX_APS, lazy=True)) # Lazy, so sequences and loops are only written out as they're rendered
+    frames = CompressStream(timeline.IterFrames()) # Rendered straight into runs, the uncompressed song never exists
+
+    try:
+        WriteCache(cache_path, frames, {
+            "hash": preset_hash,
+            "source": str(preset_path),
+            "max_led": SD.MAX_LED,
+            "max_aps": SD.MAX_APS,
+            "compile_time": time.perf_counter() - started,
+        })
+    except OSError as e: # Read only library, or Windows refusing to replace a cache that's mapped
+        if required:
+            raise
+        print(f"Couldn't write {cache_path}, playing from memory: {e}")
+    return frames
+
+
+def IsCacheFresh(cache_path: Path, preset_hash: str):
+    try:
+        metadata = ReadMetadata(cache_path)
+    except (OSError, ValueError, struct.error):
+        return False
+    return metadata is not None and metadata.get("hash") == preset_hash
+
+
+def LoadPreset(preset_path: Path, cache_dir: Path = None): # Rebuilds the cache if it's missing or stale, then mmaps it
+    preset_path = Path(preset_path)
+    source = preset_path.read_bytes()
+    preset_hash = PresetHash(source)
+    cache_path = GetCachePath(preset_path, preset_hash, cache_dir)
+
+    compiled = None
+    if not IsCacheFresh(cache_path, preset_hash):
+        Instr.Count("preset_cache_misses")
+        with Instr.Span("compile"):
+            compiled = CompilePreset(preset_path, cache_path, source, preset_hash, required=False)
+    else:
+        Instr.Count("preset_cache_hits")
+
+    try:
+        _, frames = ReadCache(cache_path)
+    except OSError: # Never got written, the frames we just compiled are all there is
+        if compiled is None:
+            raise
+        return compiled
+    return frames
@@ -0,0 +1,276 @@
+# Lowers parsed presets into flat lists of ops, constructors and type converters are resolved once here instead of on every call like Objectify does
+# Anything without sequence parameters in it is built right away, so most ops just carry a finished Action that every run shares
+# RunOps is the interpreter, it turns ops into the (local offset, source) parts a sequence expands to, see UserDefinedSequence.Expand
+import argparse
+from operator import itemgetter
+from pathlib import Path
+
+import sequence_definitions as SD
+from argbex_syntax import ArgbexSyntaxError, Loop, ParseSource, Word
+
+# Opcodes, an op is a tuple starting with one of them
+EMIT = 0 # (EMIT, action), built at compile time
+BUILD = 1 # (BUILD, build), build(args) makes the action, some of its arguments are sequence parameters
+WAIT = 2 # (WAIT, ms)
+WAIT_PARAM = 3 # (WAIT_PARAM, build), build(args) makes the Wait
+CALL = 4 # (CALL, name, getters), the sequence is looked up when the op runs, it may be defined later in the file or swapped by hot reload
+LOOP = 5 # (LOOP, kind, getter, force, end, where), the body runs until ops[end], which is the matching END_LOOP, where is (line, column, path) for errors
+END_LOOP = 6
+
+OP_NAMES = {EMIT: "EMIT", BUILD: "BUILD", WAIT: "WAIT", WAIT_PARAM: "WAIT_PARAM", CALL: "CALL", LOOP: "LOOP", END_LOOP: "END_LOOP"}
+
+
+BUILTIN_TYPES = {"int": int, "float": float, "str": str, "list": list} # construction_types names that aren't classes of sequence_definitions
+
+
+class Constructor(): # A class the presets can call, with the converter for every parameter looked up ahead of time
+    cls = None
+    converters = None
+    takes_tags = False # Extra arguments become a list of strings
+
+    def __init__(self, cls):
+        self.cls = cls
+        types = list(cls.construction_types)
+        self.takes_tags = "Tags" in types
+        if self.takes_tags:
+            if types.count("Tags") > 1 or types[-1] != "Tags":
+                raise RuntimeError(f"Internal Error, class {cls.__name__} has wrongly defined construction_types (Tags)")
+            types.pop()
+        self.converters = [MakeConverter(ResolveType(name, cls)) for name in types]
+
+    def CheckCount(self, count):
+        required = len(self.converters)
+        if count < required or (count > required and not self.takes_tags):
+            raise RuntimeError(f"{self.cls.__name__} takes {required} parameters{' and tags' if self.takes_tags else ''}, got {count}")
+
+    def Build(self, values):
+        try:
+            params = [convert(value) for convert, value in zip(self.converters, values)]
+            if self.takes_tags:
+                params.append([str(value) for value in values[len(self.converters):]])
+            return self.cls(*params)
+        except (TypeError, ValueError) as e: # Wrong kind of value for a parameter
+            raise RuntimeError(f"Invalid parameters for {self.cls.__name__}: {e}") from e
+
+
+def ResolveType(name, owner):
+    cls = BUILTIN_TYPES.get(name) or SD.getglobals().get(name)
+    if not isinstance(cls, type):
+        raise RuntimeError(f"Internal Error, class {owner.__name__} has an unknown type {name!r} in construction_types")
+    return cls
+
+def MakeConverter(cls):
+    def Convert(value): # Same rule as Objectify, values that already are the right thing are passed as they are
+        if isinstance(value, cls):
+            return value
+        if cls is list: # A single word, not its characters
+            return [value]
+        return cls(value)
+    return Convert
+
+
+constructors = {} # Name -> Constructor, None for names that aren't classes presets can call
+
+def IsCallable(cls): # Concrete classes only, bases like Selector or MovingAction only fail once they're used
+    return isinstance(cls, type) and issubclass(cls, SD.ARGBEX_BASE) and not cls.__dict__.get("abstract", False)
+
+def GetConstructor(name): # RuntimeError for classes with broken construction_types
+    try:
+        return constructors[name]
+    except KeyError:
+        pass
+    cls = SD.getglobals().get(name)
+    constructor = Constructor(cls) if IsCallable(cls) else None
+    constructors[name] = constructor
+    return constructor
+
+
+class Constant(): # Getter for a value that doesn't depend on the sequence arguments
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __call__(self, args):
+        return self.value
+
+    def __repr__(self):
+        return repr(self.value)
+
+
+class Compiler():
+    path = None
+    params: list = None # Parameter names of the sequence being compiled
+    sequences: dict = None # Only used for better errors, calls are resolved when they run
+
+    def __init__(self, params = (), sequences = None, path = None):
+        self.params = [str(param) for param in params]
+        self.sequences = sequences if sequences is not None else {}
+        self.path = path
+
+    def Error(self, message, node):
+        return ArgbexSyntaxError(message, node.line, node.column, self.path)
+
+    def GetConstructor(self, node):
+        try:
+            return GetConstructor(node.name)
+        except RuntimeError as e:
+            raise self.Error(str(e), node) from e
+
+    def CompileValue(self, node): # -> (constant, value), value is a getter taking the sequence arguments when it's not constant
+        if type(node) is Word:
+            if node.text in self.params:
+                return False, itemgetter(self.params.index(node.text))
+            return True, node.text
+
+        constructor = constructors.get(node.name) or self.GetConstructor(node)
+        if constructor is None:
+            if node.name in self.sequences:
+                raise self.Error(f"Userdefined Sequences cannot be put inside other functions! ({node.name})", node)
+            raise self.Error(f"Decl {node.name} not found!", node)
+
+        constant = True
+        values = []
+        for arg in node.args:
+            arg_constant, value = self.CompileValue(arg)
+            constant &= arg_constant
+            values.append((arg_constant, value))
+        try:
+            constructor.CheckCount(len(values))
+            if constant:
+                return True, constructor.Build([value for _, value in values])
+        except RuntimeError as e:
+            raise self.Error(str(e), node) from e
+
+        getters = [Constant(value) if arg_constant else value for arg_constant, value in values]
+        build = constructor.Build
+        line, column, path = node.line, node.column, self.path
+
+        def Build(args): # Runs on every expansion, bad arguments only show up here
+            try:
+                return build([get(args) for get in getters])
+            except RuntimeError as e:
+                if isinstance(e, ArgbexSyntaxError): # An inner call already has its position
+                    raise
+                raise ArgbexSyntaxError(str(e), line, column, path) from e
+        return False, Build
+
+    def CompileBody(self, statements, ops = None):
+        ops = [] if ops is None else ops
+        for statement in statements:
+            self.CompileStatement(statement, ops)
+        return ops
+
+    def CompileStatement(self, node, ops):
+        if isinstance(node, Loop):
+            where = (node.line, node.column, self.path)
+            kind, _, force = SD.ParseLoopArgs([arg.ToRaw() for arg in node.args], where)
+            constant, value = self.CompileValue(node.args[1 if kind == "for" else 0])
+            start = len(ops)
+            ops.append(None) # Filled in once we know where the body ends
+            self.CompileBody(node.body, ops)
+            ops[start] = (LOOP, kind, Constant(value) if constant else value, force, len(ops), where)
+            ops.append((END_LOOP,))
+            return
+
+        constructor = self.GetConstructor(node)
+        if constructor is None: # Sequence call
+            getters = []
+            for arg in node.args:
+                constant, value = self.CompileValue(arg)
+                getters.append(Constant(value) if constant else value)
+            ops.append((CALL, node.name, getters))
+            return
+
+        if not issubclass(constructor.cls, (SD.Action, SD.Wait)):
+            raise self.Error(f"{node.name} isn't an action, it can only be passed to one", node)
+        constant, value = self.CompileValue(node)
+        if issubclass(constructor.cls, SD.Wait):
+            ops.append((WAIT, WaitTime(value)) if constant else (WAIT_PARAM, value))
+        else:
+            ops.append((EMIT, value) if constant else (BUILD, value))
+
+
+def WaitTime(wait): # ms
+    return int(round(wait.wait * 1000))
+
+
+def CompileSequence(definition, sequences = None, path = None): # SequenceDef -> ops
+    return Compiler(definition.params, sequences, path).CompileBody(definition.body)
+
+def CompileCall(call, sequences = None, path = None): # Single call without parameters (a playback line) -> ops
+    return Compiler((), sequences, path).CompileBody([call])
+
+
+def RunOps(ops, args, sequences, begin = 0, end = None): # -> ((local offset, source) parts, local time after the last op)
+    end = len(ops) if end is None else end
+    parts = []
+    offset = 0
+    i = begin
+    while i < end:
+        op = ops[i]
+        code = op[0]
+        if code == EMIT:
+            parts.append((offset, op[1]))
+        elif code == BUILD:
+            parts.append((offset, op[1](args)))
+        elif code == WAIT:
+            offset += op[1]
+        elif code == CALL:
+            parts.append((offset, CallSequence(op[1], [get(args) for get in op[2]], sequences)))
+        elif code == WAIT_PARAM:
+            offset += WaitTime(op[1](args))
+        elif code == LOOP:
+            _, kind, value, force, loop_end, where = op
+            body, period = RunOps(ops, args, sequences, i + 1, loop_end)
+            loop = SD.MakeLoop(kind, value(args), force, body, period, offset, where)
+            parts.append((offset, loop))
+            offset += loop.GetDuration()
+            i = loop_end # Lands on the END_LOOP, skipped below
+        i += 1
+    return parts, offset
+
+
+def CallSequence(name, values, sequences):
+    sequence = sequences.get(name)
+    if sequence is None:
+        raise RuntimeError(f"Decl {name} not found!")
+    if len(values) != len(sequence.ud_parameters):
+        raise RuntimeError(f"Wrong amount of numbers passed to {name} {values}, {sequence.ud_parameters}")
+    return SD.SequenceCall(sequence, values)
+
+
+def FormatOperand(operand):
+    if type(operand) == list:
+        return "[" + ", ".join(map(FormatOperand, operand)) + "]"
+    if callable(operand) and not isinstance(operand, (Constant, SD.ARGBEX_BASE, type)): # Depends on the sequence arguments
+        return "<param>"
+    return repr(operand)
+
+def FormatOps(ops): # Readable listing, loop bodies indented
+    lines = []
+    depth = 0
+    for i, op in enumerate(ops):
+        if op[0] == END_LOOP:
+            depth -= 1
+        operands = op[1:-1] if op[0] == LOOP else op[1:] # Loop positions are only for errors
+        lines.append(f"{i:4} {'  ' * depth}{OP_NAMES[op[0]]} {' '.join(map(FormatOperand, operands))}".rstrip())
+        if op[0] == LOOP:
+            depth += 1
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Print the ops a preset compiles to")
+    parser.add_argument("preset", type=Path)
+    args = parser.parse_args()
+
+    preset = ParseSource(args.preset.read_text(), args.preset)
+    names = {definition.name: None for definition in preset.sequences}
+    for definition in preset.sequences:
+        print(f"{definition.name}({' '.join(definition.params)}):")
+        print(FormatOps(CompileSequence(definition, names, args.preset)))
+    print("<Playback>")
+    for line in preset.playback:
+        if line.call.name != "nothing":
+            print(f"{line.timestamp}ms: " + FormatOps(CompileCall(line.call, names, args.preset)).strip())
@@ -0,0 +1,237 @@
+# Maps songs to presets, so a song change is one dict lookup instead of a walk through the library
+# A preset is found by its file name ("Artist - Title.argbex") and by any "// song: Artist - Title" lines at the top of it (aliases)
+# The index is kept in <library>/.argbex_cache/preset_index.json and only files that changed since the last build get read again
+import argparse
+import asyncio
+import difflib
+import json
+import re
+import unicodedata
+from collections import OrderedDict
+from pathlib import Path
+
+import preset_cache as PC
+from library_build import FindPresets
+
+INDEX_VERSION = 1
+INDEX_NAME = "preset_index.json"
+SONG_DIRECTIVE = re.compile(r"^\s*//\s*song\s*:\s*(.+?)\s*$", re.IGNORECASE)
+HEADER_LINES = 20 # Song directives have to be in the first lines of the file, we don't read whole presets to index them
+FUZZY_CUTOFF = 0.85 # difflib ratio a fuzzy match needs, lower finds more but also picks wrong presets
+
+NOISE_PATTERN = re.compile(r"[\(\[][^\)\]]*[\)\]]") # (Remastered 2011), [Official Video] ...
+VERSION_TAGS = r"remaster(ed)?|live|mono|stereo|acoustic|demo|instrumental|radio edit|single edit|single version|album version|extended mix|original mix"
+SUFFIX_PATTERN = re.compile(rf"\s+-\s*(\d{{4}}\s+)?({VERSION_TAGS})(\s+(version|edit|mix))?(\s+\d{{4}})?\s*$") # Title - 2011 Remaster, only when all that's after the dash is a known tag
+FEATURING_PATTERN = re.compile(r"\s+(feat\.?|ft\.?|featuring)\s+.*$")
+ARTIST_SEPARATOR = re.compile(r"\s*(,|&|\bx\b|\band\b|;)\s*") # First artist is enough to tell songs apart
+
+
+def Normalize(text, title = True): # Version suffixes are only cut from titles, an artist can have " - " in the name
+    text = re.sub(r"['\u2019`]", "", str(text)) # Straight and curly apostrophes both get dropped
+    text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode("ascii").lower()
+    text = NOISE_PATTERN.sub(" ", text)
+    if title:
+        text = SUFFIX_PATTERN.sub("", text.rstrip())
+    text = FEATURING_PATTERN.sub("", text)
+    text = re.sub(r"[^a-z0-9&,;]+", " ", text)
+    return " ".join(text.split())
+
+def NormalizeArtist(artist):
+    artist = Normalize(artist, title=False)
+    return ARTIST_SEPARATOR.split(artist, maxsplit=1)[0].strip()
+
+def SongKey(artist, title):
+    return f"{NormalizeArtist(artist)} - {Normalize(title)}"
+
+def SplitSong(text): # "Artist - Title" -> (artist, title), no artist if there's no separator
+    artist, separator, title = text.partition(" - ")
+    if not separator:
+        return "", text.strip()
+    return artist.strip(), title.strip()
+
+
+def ReadSongs(preset_path: Path): # Every (artist, title) a preset is meant for, file name first
+    songs = [SplitSong(preset_path.stem)]
+    with open(preset_path, "r", errors="replace") as preset:
+        for _, line in zip(range(HEADER_LINES), preset):
+            match = SONG_DIRECTIVE.match(line)
+            if match:
+                songs.append(SplitSong(match.group(1)))
+    return songs
+
+
+class PresetIndex():
+    directory: Path = None
+    index_path: Path = None
+    files: dict = None # Relative path -> {"mtime": .., "songs": [[artist, title], ..]}, this is what gets saved
+    aliases: dict = None # Song key -> relative path, added by hand with AddAlias, also saved
+    songs: dict = None # Song key -> relative path, the in memory lookup
+    titles: dict = None # Normalized title -> song keys, for lookups without a usable artist
+    fuzzy_cache: dict = None # Results of fuzzy lookups, they're the expensive ones
+
+    def __init__(self, directory: Path, index_path: Path = None):
+        self.directory = Path(directory)
+        self.index_path = Path(index_path) if index_path else self.directory / PC.CACHE_DIR_NAME / INDEX_NAME
+        self.files = {}
+        self.aliases = {}
+        self.Load()
+        self.Rehash()
+
+    def Load(self):
+        try:
+            data = json.loads(self.index_path.read_text())
+        except (OSError, ValueError):
+            return
+        if data.get("version") != INDEX_VERSION:
+            return
+        self.files = data.get("files", {})
+        self.aliases = data.get("aliases", {})
+
+    def Save(self):
+        self.index_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.index_path.with_suffix(".tmp")
+        tmp_path.write_text(json.dumps({"version": INDEX_VERSION, "files": self.files, "aliases": self.aliases}, indent=1))
+        tmp_path.replace(self.index_path)
+
+    def Build(self): # Rescans the library, only presets whose mtime changed are read, returns how many were
+        found = {}
+        read = 0
+        for preset_path in FindPresets(self.directory):
+            relative = preset_path.relative_to(self.directory).as_posix()
+            mtime = preset_path.stat().st_mtime_ns
+            entry = self.files.get(relative)
+            if entry is None or entry["mtime"] != mtime:
+                entry = {"mtime": mtime, "songs": [list(song) for song in ReadSongs(preset_path)]}
+                read += 1
+            found[relative] = entry
+
+        changed = read or found.keys() != self.files.keys()
+        self.files = found
+        self.Rehash()
+        if changed:
+            self.Save()
+        return read
+
+    def Rehash(self):
+        self.songs = {}
+        self.titles = {}
+        self.fuzzy_cache = {}
+        for relative, entry in sorted(self.files.items()):
+            for artist, title in entry["songs"]:
+                self.AddSong(SongKey(artist, title), relative)
+        for key, relative in self.aliases.items(): # Hand made aliases win over whatever the files say
+            self.AddSong(key, relative, replace=True)
+
+    def AddSong(self, key, relative, replace = False):
+        if key in self.songs:
+            if replace:
+                self.songs[key] = relative
+            return # Otherwise there's two presets for one song, the first one (by path) wins
+        self.songs[key] = relative
+        self.titles.setdefault(key.split(" - ", 1)[1], []).append(key)
+
+    def AddAlias(self, artist, title, preset_path: Path):
+        relative = Path(preset_path).resolve().relative_to(self.directory.resolve()).as_posix()
+        key = SongKey(artist, title)
+        self.aliases[key] = relative
+        self.AddSong(key, relative, replace=True)
+        self.fuzzy_cache = {}
+        self.Save()
+
+    def Lookup(self, artist, title): # Preset path for a song or None, exact first, then by title, then fuzzy
+        key = SongKey(artist, title)
+        relative = self.songs.get(key)
+        if relative is None:
+            relative = self.LookupTitle(key)
+        if relative is None:
+            try:
+                relative = self.fuzzy_cache[key]
+            except KeyError:
+                relative = self.fuzzy_cache[key] = self.LookupFuzzy(key)
+        if relative is None:
+            return None
+        return self.directory / relative
+
+    def LookupTitle(self, key): # Only when one preset has the title, and either the player gave no artist or that preset has none (named only after the title)
+        artist, title = key.split(" - ", 1)
+        candidates = self.titles.get(title, [])
+        if len(candidates) == 1 and (not artist or candidates[0].startswith(" - ")):
+            return self.songs[candidates[0]]
+        return None
+
+    def LookupFuzzy(self, key):
+        matches = difflib.get_close_matches(key, self.songs.keys(), n=1, cutoff=FUZZY_CUTOFF)
+        if not matches:
+            return None
+        return self.songs[matches[0]]
+
+    def __len__(self):
+        return len(self.songs)
+
+    def __repr__(self):
+        return f"<PresetIndex {self.directory} | {len(self.files)} presets, {len(self.songs)} songs>"
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class PresetPrewarmer():
+    # Starts loading (and if needed compiling) presets in the background as soon as a song is known
+    # Loaded frames are kept in a small LRU, so going back to a song or prewarming the next one costs nothing later
+    index: PresetIndex = None
+    cache_dir: Path = None
+    executor = None # None means the loop's default thread pool
+    keep = 4
+    loading: OrderedDict = None # Preset path -> future of its frames (RunLengthFrames)
+
+    def __init__(self, index: PresetIndex, cache_dir: Path = None, executor = None, keep = 4):
+        self.index = index
+        self.cache_dir = cache_dir
+        self.executor = executor
+        self.keep = keep
+        self.loading = OrderedDict()
+
+    def Prewarm(self, artist, title): # Returns the future of the song's frames, or None when there's no preset for it
+        preset_path = self.index.Lookup(artist, title)
+        if preset_path is None:
+            return None
+
+        future = self.loading.get(preset_path)
+        if future is not None and not (future.done() and future.exception() is not None): # Failed loads get another try
+            self.loading.move_to_end(preset_path)
+            return future
+
+        future = asyncio.get_running_loop().run_in_executor(self.executor, PC.LoadPreset, preset_path, self.cache_dir)
+        self.loading[preset_path] = future
+        while len(self.loading) > self.keep:
+            self.loading.popitem(last=False)
+        return future
+
+    async def Get(self, artist, title): # Frames of the song's preset, None if there isn't one
+        future = self.Prewarm(artist, title)
+        if future is None:
+            return None
+        return await future
+
+    def OnSong(self, song): # Doesn't return the future, the watcher would wait for it
+        if song is not None:
+            self.Prewarm(song.artist, song.title)
+
+    def Attach(self, watcher): # Starts loading every song the NowPlayingWatcher announces
+        watcher.Subscribe(self.OnSong)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build the song to preset index of a library, or look a song up in it")
+    parser.add_argument("directory", type=Path)
+    parser.add_argument("--lookup", nargs=2, metavar=("ARTIST", "TITLE"))
+    parser.add_argument("--alias", nargs=3, metavar=("ARTIST", "TITLE", "PRESET"))
+    args = parser.parse_args()
+
+    index = PresetIndex(args.directory)
+    read = index.Build()
+    print(f"{index} ({read} presets read)")
+    if args.alias:
+        index.AddAlias(*args.alias)
+    if args.lookup:
+        print(index.Lookup(*args.lookup))
@@ -0,0 +1,211 @@
+# Run-length compressed frames, a held color costs one entry no matter how long it's held
+# Consecutive identical frames collapse into one run (its hold lasts until the next run starts)
+# Inside a run, neighbouring LEDs with the same color are one span (start, length, color), and only spans where something changed are stored
+# A full keyframe every keyframe_interval runs keeps seeking cheap, same idea as timeline_index.py but with plain arrays so it can live in the preset cache
+import numpy as np
+
+import sequence_definitions as SD
+from frame_buffer import FrameBuffer
+
+DEFAULT_KEYFRAME_INTERVAL = 64
+
+
+class RunLengthFrames():
+    timestamps = None # (runs,) int64, sorted, where every run starts
+    keyframes = None # (runs // interval + 1, leds, 3) uint8, full state at the start of run k * interval
+    span_offsets = None # (runs + 1,) int64, spans of run i are span_*[span_offsets[i]:span_offsets[i + 1]]
+    span_starts = None # (spans,) uint16, first strip position of the span
+    span_lengths = None # (spans,) uint16
+    span_colors = None # (spans, 3) uint8
+    keyframe_interval = DEFAULT_KEYFRAME_INTERVAL
+
+    def __init__(self, timestamps, keyframes, span_offsets, span_starts, span_lengths, span_colors, keyframe_interval = DEFAULT_KEYFRAME_INTERVAL):
+        self.timestamps = timestamps
+        self.keyframes = keyframes
+        self.span_offsets = span_offsets
+        self.span_starts = span_starts
+        self.span_lengths = span_lengths
+        self.span_colors = span_colors
+        self.keyframe_interval = max(int(keyframe_interval), 1)
+
+        self.cursor = -1 # Last run GetFrame returned and the state it had, playback mostly moves forward so we continue from there
+        self.cursor_state = np.zeros((self.keyframes.shape[1], 3), dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def GetDurations(self): # Hold time of every run in ms, the last one holds forever so it's 0
+        durations = np.zeros(len(self), dtype=np.int64)
+        durations[:-1] = np.diff(self.timestamps)
+        return durations
+
+    def Locate(self, timestamp): # Index of the run playing at timestamp, -1 before the first one
+        return int(np.searchsorted(self.timestamps, timestamp, side="right")) - 1
+
+    def ApplySpans(self, first, last, out): # Spans of runs first..last (inclusive) onto out, later ones overwrite earlier ones
+        begin = int(self.span_offsets[first])
+        end = int(self.span_offsets[last + 1])
+        if end - begin == 1: # Most common by far, one color over a range
+            start = int(self.span_starts[begin])
+            out[start:start + int(self.span_lengths[begin])] = self.span_colors[begin]
+        elif end > begin:
+            lengths = self.span_lengths[begin:end].astype(np.intp)
+            firsts = np.cumsum(lengths) - lengths # Where every span begins in the expanded list
+            leds = np.repeat(self.span_starts[begin:end].astype(np.intp) - firsts, lengths) + np.arange(int(lengths.sum()))
+            out[leds] = np.repeat(self.span_colors[begin:end], lengths, axis=0) # Repeated LEDs keep the last value assigned
+        return out
+
+    def StateAfter(self, run, out = None): # Full strip state during a run, from the closest keyframe
+        if out is None:
+            out = np.empty((self.keyframes.shape[1], 3), dtype=np.uint8)
+        if run < 0:
+            out[:] = 0
+            return out
+
+        keyframe = run // self.keyframe_interval
+        out[:] = self.keyframes[keyframe]
+        if run > keyframe * self.keyframe_interval:
+            self.ApplySpans(keyframe * self.keyframe_interval + 1, run, out)
+        return out
+
+    def GetState(self, timestamp): # Independent copy of the state at any point of the song
+        return self.StateAfter(self.Locate(timestamp))
+
+    def GetFrame(self, timestamp): # Same as GetState but reuses one buffer (copy it if you need to keep it), meant for playback
+        run = self.Locate(timestamp)
+        if run == self.cursor:
+            return self.cursor_state
+
+        if self.cursor < run and run - self.cursor < self.keyframe_interval:
+            self.ApplySpans(self.cursor + 1, run, self.cursor_state)
+        else:
+            self.StateAfter(run, self.cursor_state)
+        self.cursor = run
+        return self.cursor_state
+
+    def NextChange(self, timestamp): # When the run playing at timestamp ends, None if it's the last one
+        run = self.Locate(timestamp) + 1
+        if run >= len(self):
+            return None
+        return int(self.timestamps[run])
+
+    def View(self): # Same arrays with a cursor of its own, for reading while something else plays this one
+        return RunLengthFrames(self.timestamps, self.keyframes, self.span_offsets, self.span_starts, self.span_lengths, self.span_colors, self.keyframe_interval)
+
+    def Decompress(self): # Back to one full frame per run
+        frames = np.empty((len(self), self.keyframes.shape[1], 3), dtype=np.uint8)
+        state = np.zeros((self.keyframes.shape[1], 3), dtype=np.uint8)
+        for run in range(len(self)):
+            frames[run] = self.ApplySpans(run, run, state)
+        return FrameBuffer(np.array(self.timestamps, dtype=np.int64), frames)
+
+    def GetBytes(self):
+        return sum(getattr(self, name).nbytes for name in ("timestamps", "keyframes", "span_offsets", "span_starts", "span_lengths", "span_colors"))
+
+    def __repr__(self):
+        return f"<RunLengthFrames {len(self)} runs, {len(self.span_starts)} spans, {len(self.keyframes)} keyframes, {self.GetBytes()} bytes>"
+
+    def __str__(self):
+        return self.__repr__()
+
+
+def FindSpans(frames, changed): # frames (runs, leds, 3), changed (runs, leds) bool -> (run, start, length, color) of every span with a change in it
+    runs, leds = changed.shape
+    begins = np.empty((runs, leds), dtype=bool) # Where a new color starts inside a frame
+    begins[:, 0] = True
+    begins[:, 1:] = np.any(frames[:, 1:] != frames[:, :-1], axis=2)
+    begins = begins.ravel()
+
+    span_id = np.cumsum(begins) - 1
+    flat_starts = np.flatnonzero(begins)
+    lengths = np.diff(np.append(flat_starts, runs * leds))
+    keep = np.bincount(span_id, weights=changed.ravel(), minlength=len(flat_starts)) > 0
+    flat_starts = flat_starts[keep]
+    return flat_starts // leds, flat_starts % leds, lengths[keep], frames.reshape(-1, 3)[flat_starts]
+
+
+STREAM_CHUNK = 256 # Frames CompressStream collects before compressing them in one go
+
+
+def CompressRuns(timestamps, frames, previous, first_run, keyframe_interval):
+    # Runs and spans of a block of frames, previous is the state before the block (the last run so far, or a dark strip), first_run the index the block's first run gets
+    before = np.concatenate((previous[np.newaxis], frames[:-1]))
+    starts = np.flatnonzero(np.any(frames != before, axis=(1, 2))) # A run starts wherever the frame differs from the one before it
+    if first_run == 0 and (not len(starts) or starts[0] != 0):
+        starts = np.concatenate(([0], starts)) # The very first frame always starts a run, even a dark one
+    runs = frames[starts]
+
+    changed = np.any(runs != np.concatenate((previous[np.newaxis], runs[:-1])), axis=2) # (runs, leds), which LEDs every run changes
+    run_index, span_starts, span_lengths, span_colors = FindSpans(runs, changed)
+    numbers = first_run + np.arange(len(runs))
+    return np.asarray(timestamps)[starts], (run_index + first_run, span_starts, span_lengths, span_colors), runs[numbers % keyframe_interval == 0]
+
+
+def CopyRuns(source: RunLengthFrames, begin, end, first_run, keyframe_interval):
+    # Runs begin..end-1 of source as a piece for BuildRunLength, numbered from first_run on, the spans stay as they are and only the keyframes get rebuilt
+    numbers = np.arange(first_run, first_run + end - begin)
+    run_index = np.repeat(numbers, np.diff(source.span_offsets[begin:end + 1]))
+    span_begin = int(source.span_offsets[begin])
+    span_end = int(source.span_offsets[end])
+    keyframes = np.empty((int(np.count_nonzero(numbers % keyframe_interval == 0)), source.keyframes.shape[1], 3), dtype=np.uint8)
+    for i, number in enumerate(numbers[numbers % keyframe_interval == 0]):
+        source.StateAfter(begin + int(number) - first_run, keyframes[i])
+    spans = (run_index, source.span_starts[span_begin:span_end], source.span_lengths[span_begin:span_end], source.span_colors[span_begin:span_end])
+    return source.timestamps[begin:end], spans, keyframes
+
+
+def BuildRunLength(timestamps, spans, keyframes, led_count, keyframe_interval): # Puts the pieces of one or more CompressRuns together
+    timestamps = np.concatenate(timestamps) if timestamps else np.zeros(0, dtype=np.int64)
+    run_index, starts, lengths, colors = (np.concatenate(part) for part in zip(*spans)) if spans else (np.zeros(0, dtype=np.int64),) * 3 + (np.zeros((0, 3), dtype=np.uint8),)
+    span_offsets = np.zeros(len(timestamps) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(run_index, minlength=len(timestamps)), out=span_offsets[1:])
+    return RunLengthFrames(
+        timestamps.astype(np.int64),
+        np.concatenate(keyframes) if keyframes else np.zeros((0, led_count, 3), dtype=np.uint8),
+        span_offsets,
+        starts.astype(np.uint16),
+        lengths.astype(np.uint16),
+        np.ascontiguousarray(colors, dtype=np.uint8),
+        keyframe_interval,
+    )
+
+
+def CompressFrameBuffer(frame_buffer: FrameBuffer, keyframe_interval = DEFAULT_KEYFRAME_INTERVAL):
+    keyframe_interval = max(int(keyframe_interval), 1)
+    frames = frame_buffer.frames
+    if not len(frames):
+        return BuildRunLength([], [], [], frames.shape[1], keyframe_interval)
+
+    timestamps, spans, keyframes = CompressRuns(frame_buffer.timestamps, frames, np.zeros(frames.shape[1:], dtype=np.uint8), 0, keyframe_interval)
+    return BuildRunLength([timestamps], [spans], [keyframes], frames.shape[1], keyframe_interval)
+
+
+def CompressStream(frames, keyframe_interval = DEFAULT_KEYFRAME_INTERVAL, led_count = None):
+    # Same as CompressFrameBuffer for (timestamp, frame) pairs, eg. frame_stream.StreamFrames, only STREAM_CHUNK frames are ever held uncompressed
+    keyframe_interval = max(int(keyframe_interval), 1)
+    led_count = SD.MAX_LED if led_count is None else led_count
+    chunk = np.empty((STREAM_CHUNK, led_count, 3), dtype=np.uint8)
+    chunk_timestamps = []
+    parts = ([], [], [])
+    previous = np.zeros((led_count, 3), dtype=np.uint8)
+    run_count = 0
+
+    def Flush():
+        nonlocal run_count
+        timestamps, spans, keyframes = CompressRuns(chunk_timestamps, chunk[:len(chunk_timestamps)], previous, run_count, keyframe_interval)
+        if len(timestamps):
+            previous[:] = chunk[len(chunk_timestamps) - 1] # Last frame of the chunk is the state the next one continues from
+        run_count += len(timestamps)
+        for part, value in zip(parts, (timestamps, spans, keyframes)):
+            part.append(value)
+        chunk_timestamps.clear()
+
+    for timestamp, frame in frames:
+        chunk[len(chunk_timestamps)] = frame
+        chunk_timestamps.append(timestamp)
+        if len(chunk_timestamps) == STREAM_CHUNK:
+            Flush()
+    if chunk_timestamps:
+        Flush()
+
+    return BuildRunLength(*parts, led_count, keyframe_interval)
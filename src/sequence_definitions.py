@@ -1,19 +1,28 @@
 #Stores definitions and internal code of classes representing sequences
 from enum import Enum
 from dataclasses import dataclass
+from collections import OrderedDict, namedtuple
+import heapq
+import numpy as np
+from compositor import LayerCompositor
+from argbex_syntax import ArgbexSyntaxError
+import easing as Easing
+import instrumentation as Instr
 MAX_LED = 300
 MAX_APS = 100
 class ARGBEX_BASE():
+    __slots__ = () # Otherwise every value type below gets a __dict__ no matter what slots it declares
     construction_types = []
+    abstract = True # Presets can't call a class that sets this itself, subclasses don't inherit it (see preset_compiler.GetConstructor)
 
-def snapNearest(self, value, less, more):
+def snapNearest(value, less, more):
         less_dist = value - less
         more_dist = more - value
         
         if less_dist <= more_dist:
             return less
         elif less_dist > more_dist:
-            return more_dist
+            return more
 
 def MergeTimelines(timeline_a, timeline_b, step = 0):
     # We expect that timeline_a is properly fit into the step system
@@ -24,25 +33,85 @@ def MergeTimelines(timeline_a, timeline_b, step = 0):
         if key % step != 0: #We need to snap to nearest
             less = (key // step) * step
             more = less + step
-            key = snapNearest(key, less, more) # Snap to nearest timestamp
+            key = int(snapNearest(key, less, more)) # Snap to nearest timestamp
         
         try:
             led_setup: TimelineData = timeline_a[key]
             # If this hasn't failed this means that something is already there, we need to merge by TimelineData, which happens in that class
             
-            led_setup.MergeWith(timeline_b[key]) #Merge the two TimelineDatas
+            led_setup.MergeWith(val_copy) #Merge the two TimelineDatas
         except KeyError:
-            timeline_a[key] = val_copy
+            timeline_a[key] = val_copy.Copy() # Our copy gets merged into later, the original may be shared (cached sequences)
+            continue
+        if Instr.ENABLED:
+            Instr.Count("merge_collisions")
     
 
 
 class Timeline():
     min_step = 0 #Minimum step (time it takes between actions), defined by maximum actions per second
     tmline: dict[int, str] = {}
+    lazy = False # Lazy timelines only remember what was scheduled, frames are generated on demand by frame_stream.py
+    sources = None # (timestamp, source) pairs of a lazy timeline, in the order they were scheduled
 
-    def __init__(self, max_aps):
+    def __init__(self, max_aps, lazy = False):
         self.min_step = round(1/max_aps, 3) * 1000 #Adjust for miliseconds
         self.tmline = {}
+        self.lazy = lazy
+        self.sources = []
+
+    def SnapKey(self, key): # Nearest point of the step grid, ties go to the earlier one
+        less = (key // self.min_step) * self.min_step
+        if key - less <= self.min_step / 2:
+            return int(less)
+        return int(less + self.min_step)
+
+    def SnapKeys(self, keys): # SnapKey for a whole array at once
+        keys = np.asarray(keys, dtype=np.float64)
+        less = np.floor(keys / self.min_step) * self.min_step
+        return np.where(keys - less <= self.min_step / 2, less, less + self.min_step).astype(np.int64)
+
+    def Schedule(self, timestamp: int, source): # source is anything with GetTimeline(), normally an Action
+        if self.lazy:
+            self.sources.append((timestamp, source))
+        else:
+            self.addAction(timestamp, source.GetTimeline())
+
+    def ScheduleAll(self, scheduled): # Many (timestamp, source) pairs at once, priority is the order they come in
+        if self.lazy:
+            self.sources.extend(scheduled)
+        else:
+            with Instr.Span("expand"):
+                actions = [(timestamp, source.GetTimeline()) for timestamp, source in scheduled]
+            self.addActions(actions)
+
+    def addActions(self, actions): # Bulk addAction, every (timestamp, timeline dict) is snapped and merged into tmline in one go
+        flat_keys = list(self.tmline.keys()) # Whatever is already here was added first, so it has priority over everything new
+        flat_tdatas = list(self.tmline.values())
+        priorities = [0] * len(flat_keys)
+        for order, (timestamp, action) in enumerate(actions, start=1):
+            flat_keys.extend(key + timestamp for key in action.keys())
+            flat_tdatas.extend(action.values())
+            priorities.extend([order] * len(action))
+
+        if not flat_keys:
+            return
+        with Instr.Span("merge"):
+            existing = len(self.tmline)
+            snapped = self.SnapKeys(flat_keys) # The whole batch hits the step grid in one numpy call
+            # Stable sort by (time, priority) is the k-way merge of all the action timelines, done in numpy instead of a Python heap
+            merge_order = np.lexsort((np.asarray(priorities, dtype=np.int64), snapped)).tolist()
+            snapped = snapped.tolist()
+
+            merged = {}
+            for i in merge_order:
+                key = snapped[i]
+                try:
+                    merged[key].MergeWith(flat_tdatas[i])
+                except KeyError:
+                    merged[key] = flat_tdatas[i] if i < existing else flat_tdatas[i].Copy() # Existing entries are already ours, new ones may be shared
+            self.tmline = merged
+            Instr.Count("merge_collisions", len(merge_order) - len(merged))
 
     def addAction(self, timestamp: int, action: dict):
         #print(f"Adding {action}")
@@ -50,9 +119,12 @@ class Timeline():
         for key in action.keys():
             unlocalized_action[int(key + timestamp)] = action[key] # Shift the actions to fit the timeline when we actually called it
 
-        MergeTimelines(self.tmline, unlocalized_action, self.min_step)
+        with Instr.Span("merge"):
+            MergeTimelines(self.tmline, unlocalized_action, self.min_step)
     
     def GetFullTimeline(self):
+        if self.lazy: # tmline is never filled, an empty dict here would look like a silent song
+            raise RuntimeError("GetFullTimeline needs an eager timeline, use IterFrames or GetFrameBuffer on a lazy one")
         timeline_copy = self.tmline.copy()
 
         for key in timeline_copy.keys():
@@ -60,11 +132,81 @@ class Timeline():
         
         return timeline_copy
 
+    def GetFrameBuffer(self): # Dense alternative to GetFullTimeline, see frame_buffer.py
+        from frame_buffer import RenderTimeline
+        return RenderTimeline(self)
+
+    def GetRunLengthFrames(self, keyframe_interval = None): # Compressed alternative to GetFrameBuffer, see run_length.py
+        from run_length import CompressStream, DEFAULT_KEYFRAME_INTERVAL
+        return CompressStream(self.IterFrames(), keyframe_interval or DEFAULT_KEYFRAME_INTERVAL)
+
+    def GetIndex(self, keyframe_interval = None): # Seek index, see timeline_index.py
+        from timeline_index import TimelineIndex, DEFAULT_KEYFRAME_INTERVAL
+        return TimelineIndex(self, keyframe_interval or DEFAULT_KEYFRAME_INTERVAL)
+
+    def IterFrames(self, lookahead = None): # Yields (timestamp, frame) in time order without materializing the timeline
+        from frame_stream import StreamFrames
+        return StreamFrames(self, lookahead)
+
 
 # SELECTORS
+# Selectors never store plain lists, only the smallest thing that describes them (range, stride pattern, sorted array or other selectors)
+# LED ids are 1-based (All() is 1..MAX_LED), internally everything works on 0-based strip positions (indices)
+def IDsToIndices(ids): # Converts an array of LED ids to strip positions, dropping everything that doesn't fit on the strip
+    ids = np.asarray(ids, dtype=np.intp)
+    return ids[(ids >= 1) & (ids <= MAX_LED)] - 1
+
 class Selector(ARGBEX_BASE):
-    selection = None
+    __slots__ = ()
+    abstract = True
     s_name = ""
+    indices = None # Cached 0-based strip positions, sorted and unique
+    indices_max = None # MAX_LED the cache was computed for
+
+    def ComputeIndices(self): # Overriden in every selector
+        raise NotImplementedError
+
+    def GetIndices(self):
+        if self.indices is None or self.indices_max != MAX_LED:
+            self.indices = self.ComputeIndices()
+            self.indices_max = MAX_LED
+        return self.indices
+
+    def GetWriteKey(self): # Whatever indexes a (MAX_LED, 3) frame the fastest, contiguous selectors override it with a slice
+        return self.GetIndices()
+
+    def GetMask(self): # Bitset version, used for set algebra
+        mask = np.zeros(MAX_LED, dtype=bool)
+        mask[self.GetWriteKey()] = True
+        return mask
+
+    def GetIDs(self): # 1-based LED ids, for the dict based API
+        return (self.GetIndices() + 1).tolist()
+
+    @property
+    def selection(self): # Old list based API, prefer GetIndices()
+        return self.GetIDs()
+
+    def __len__(self):
+        return len(self.GetIndices())
+
+    def __contains__(self, led_id):
+        return 1 <= led_id <= MAX_LED and bool(self.GetMask()[led_id - 1])
+
+    def __iter__(self):
+        return iter(self.GetIDs())
+
+    def __or__(self, other):
+        return Union(self, other)
+
+    def __and__(self, other):
+        return Intersect(self, other)
+
+    def __sub__(self, other):
+        return Difference(self, other)
+
+    def __invert__(self):
+        return Invert(self)
 
     def __str__(self) -> str:
         return self.__repr__()
@@ -73,61 +215,181 @@ class Selector(ARGBEX_BASE):
         return f"SELECTOR<{self.s_name}>"
 
 
+class RangeSelector(Selector): # Contiguous block of LED ids, start and end are both included
+    abstract = True
+    start = 1
+    end = None # None means the end of the strip, whatever MAX_LED is at the time
+
+    def GetBounds(self): # Clipped to the strip, as 0-based [lo, hi)
+        end = MAX_LED if self.end is None else min(self.end, MAX_LED)
+        lo = max(self.start, 1) - 1
+        return lo, max(lo, end)
 
-class All(Selector):
+    def ComputeIndices(self):
+        return np.arange(*self.GetBounds(), dtype=np.intp)
+
+    def GetWriteKey(self):
+        return slice(*self.GetBounds())
+
+    def __len__(self):
+        lo, hi = self.GetBounds()
+        return hi - lo
+
+    def __contains__(self, led_id):
+        lo, hi = self.GetBounds()
+        return lo < led_id <= hi
+
+    def GetIDs(self):
+        lo, hi = self.GetBounds()
+        return range(lo + 1, hi + 1)
+
+
+class All(RangeSelector):
     s_name = "All"
     def __init__(self):
-        self.selection = list(range(1, MAX_LED + 1))
+        self.start = 1
+        self.end = None
 
 
 class Checker(Selector):
     s_name = "Checker"
     construction_types = ["int", "int", "int"]
+    start_from = 0
+    led_selected = 0
+    led_distance = 0
+
+    def __init__(self, start_from, led_selected, led_distance): # Blocks of led_selected LEDs with led_distance LEDs of gap between them
+        if led_selected <= 0 or led_distance < 0:
+            raise RuntimeError(f"Invalid Checker pattern {start_from} {led_selected} {led_distance}")
+        self.start_from = start_from
+        self.led_selected = led_selected
+        self.led_distance = led_distance
+
+    def ComputeIndices(self):
+        block_starts = np.arange(self.start_from, MAX_LED + 1, self.led_selected + self.led_distance, dtype=np.intp)
+        ids = (block_starts[:, None] + np.arange(self.led_selected, dtype=np.intp)).ravel() # Every block at once
+        return IDsToIndices(ids)
+
+    def GetWriteKey(self):
+        if self.led_selected == 1: # Single LED blocks are just a stride, no need for fancy indexing
+            stride = self.led_selected + self.led_distance
+            skipped = max(-(-(1 - self.start_from) // stride), 0) # Blocks before LED id 1, ComputeIndices drops them too
+            return slice(self.start_from + skipped * stride - 1, MAX_LED, stride)
+        return self.GetIndices()
 
-    def __init__(self, start_from, led_selected, led_distance):
-        self.selection = []
-        i = 0
-        while(True):
-
-            start = start_from + led_distance * i
-            end = start_from + led_selected + led_distance * i
-            #print(end)
-            if start >= MAX_LED:
-                break
-            if end >= MAX_LED:
-                end = MAX_LED
-                break
-            self.selection.extend(list(range(start,  end)))
-            i += 1
-            start_from = end
 
 class ID(Selector):
     s_name = "ID"
     construction_types = ["int"]
+    ids = None # Sorted, unique, int16 unless the strip is too long for that
+
     def __init__(self, id_):
-        self.selection = []
-        i = 0
-        for _ in range(len(id_)):
-            if id_[i] > MAX_LED:
-                del id_[i]
-            else:
-                i += 1
+        ids = np.unique(np.atleast_1d(np.asarray(id_, dtype=np.int64)))
+        ids = ids[(ids >= 1) & (ids <= MAX_LED)]
+        self.ids = ids.astype(np.int16 if MAX_LED <= np.iinfo(np.int16).max else np.int32)
 
-        self.selection = list(map(int, id_))
+    def ComputeIndices(self):
+        return IDsToIndices(self.ids)
 
-class Range(Selector):
+
+class Range(RangeSelector):
     s_name = "Range"
     construction_types = ["int", "int"]
     def __init__(self, start:int, end:int):
-        self.selection = []
-        if end > MAX_LED:
-            end = MAX_LED
-        self.selection = list(range(start, end+1))
+        self.start = start
+        self.end = end
+
+
+# Set algebra, works on bitsets so nothing gets materialized as a list
+class CombinedSelector(Selector):
+    abstract = True
+    operands = None
+
+    def Combine(self, *masks): # Overriden
+        raise NotImplementedError
+
+    def GetMask(self):
+        return self.Combine(*[operand.GetMask() for operand in self.operands])
+
+    def ComputeIndices(self):
+        return np.flatnonzero(self.GetMask())
+
+    def __repr__(self) -> str:
+        return f"SELECTOR<{self.s_name} {' '.join(map(str, self.operands))}>"
+
+
+class Union(CombinedSelector):
+    s_name = "Union"
+    construction_types = ["Selector", "Selector"]
+    def __init__(self, a, b):
+        self.operands = [a, b]
+
+    def Combine(self, a, b):
+        return a | b
+
+
+class Intersect(CombinedSelector):
+    s_name = "Intersect"
+    construction_types = ["Selector", "Selector"]
+    def __init__(self, a, b):
+        self.operands = [a, b]
+
+    def Combine(self, a, b):
+        return a & b
+
+
+class Difference(CombinedSelector):
+    s_name = "Difference"
+    construction_types = ["Selector", "Selector"]
+    def __init__(self, a, b):
+        self.operands = [a, b]
+
+    def Combine(self, a, b):
+        return a & ~b
+
+
+class Invert(CombinedSelector):
+    s_name = "Invert"
+    construction_types = ["Selector"]
+    def __init__(self, a):
+        self.operands = [a]
+
+    def Combine(self, a):
+        return ~a
+
+
+class RankSelector(Selector): # Some of another selector's LEDs, by their rank in it (0 is its first LED), used for the frames of moving actions
+    s_name = "Rank"
+    abstract = True # Only moving actions make these
+    base = None
+    ranks = None # slice (most moves are a window or a stride over the base) or sorted array
+
+    def __init__(self, base: Selector, ranks):
+        self.base = base
+        self.ranks = ranks
+
+    def GetIndices(self): # Not cached, every frame has its own and is drawn once
+        return self.base.GetIndices()[self.ranks]
+
+    def GetWriteKey(self):
+        if type(self.ranks) == slice and isinstance(self.base, RangeSelector): # Window of a range is a range, no fancy indexing at all
+            lo, hi = self.base.GetBounds()
+            start, stop, step = self.ranks.indices(hi - lo)
+            return slice(lo + start, lo + stop, step)
+        return self.GetIndices()
+
+    def __len__(self):
+        return len(self.GetIndices())
+
+    def __repr__(self) -> str:
+        return f"SELECTOR<{self.s_name} {self.base} {self.ranks}>"
 
 
 #COLOR SPECIFIERS
+# The value types below use __slots__, a rendered song has hundreds of thousands of them and a __dict__ each would be most of its memory
+# Subclasses have to declare __slots__ too (even an empty one), otherwise they get a __dict__ back
 class ColorData(ARGBEX_BASE):
-    red, green, blue = 0, 0, 0
+    __slots__ = ("red", "green", "blue")
     construction_types = ["int", "int", "int"]
 
     def __init__(self, red: int, green: int, blue: int):
@@ -136,14 +398,14 @@ class ColorData(ARGBEX_BASE):
         self.blue = blue
 
         self.ClampColors()
+
+    def GetRGB(self):
+        return (self.red, self.green, self.blue)
     
-    def ClampColors(self):
-        if self.red > 255:
-            self.red = 255
-        if self.green > 255:
-            self.green = 255
-        if self.blue > 255:
-            self.blue = 255
+    def ClampColors(self): # 0..255, anything outside wouldn't fit in the uint8 frames
+        self.red = min(max(self.red, 0), 255)
+        self.green = min(max(self.green, 0), 255)
+        self.blue = min(max(self.blue, 0), 255)
     
     def __str__(self):
         return self.__repr__()
@@ -151,11 +413,25 @@ class ColorData(ARGBEX_BASE):
     def __repr__(self):
         return f"<R: {self.red}, G: {self.green}, B: {self.blue}>"
 
+INTERN_LIMIT = 65536 # Distinct colors kept by InternColor, a gradient heavy song uses a few thousand
+color_cache = {}
+
+def InternColor(red, green, blue): # Flyweight ColorData, every (red, green, blue) gets one shared object, so never change what this returns
+    red, green, blue = min(max(red, 0), 255), min(max(green, 0), 255), min(max(blue, 0), 255) # Clamp before the key, 256 green would spill into red
+    key = (red << 16) | (green << 8) | blue # An int is a smaller key than a tuple
+    try:
+        return color_cache[key]
+    except KeyError:
+        if len(color_cache) >= INTERN_LIMIT:
+            color_cache.clear()
+        color = color_cache[key] = ColorData(red, green, blue)
+        return color
+
 class Color(ColorData):
-    timeframe = {} # Specifies what color happens at what time, used for color shifting, here it's static so it'll be timeframe[0] and only thiss
+    __slots__ = ("timeframe",) # Specifies what color happens at what time, used for color shifting, here it's static so it'll be timeframe[0] and only thiss
     
     def __init__(self, red, green, blue):
-        timeframe = {}
+        self.timeframe = {}
         self.red = red
         self.green = green
         self.blue = blue
@@ -174,79 +450,68 @@ class Color(ColorData):
             self.ComputeTimeframe()
         return self.timeframe
 
+    def IterTimeframe(self): # (local time, ColorData) pairs, without building the timeframe dict
+        yield 0, self
+
 class ColorShift(Color):
-    colorStart: ColorData = None
-    colorEnd: ColorData = None
-    time = None
-    operations: int = None
-    shiftTime: int = None
+    __slots__ = ("colorStart", "colorEnd", "operations", "shiftTime", "easing", "gradient") # gradient is (steps + 1, 3) uint8, the whole shift computed at once
+    colorStart: ColorData
+    colorEnd: ColorData
+    operations: int
+    shiftTime: int
     construction_types = ["ColorData", "ColorData", "float"] # We can also create it with Color, makes us able to use the same syntax as regular color definition, we're not doing anything with the object either way
-    def __init__(self, colorStart: ColorData, colorEnd: ColorData, time):
+    def __init__(self, colorStart: ColorData, colorEnd: ColorData, time, easing = "linear"):
         self.timeframe = {}
+        self.red, self.green, self.blue = 0, 0, 0 # Not one color, the slots just shouldn't be empty
         self.colorStart = colorStart
         self.colorEnd = colorEnd
         self.operations = time * MAX_APS  #This will give us how many operations do we need to perform
         self.shiftTime = 1000 / MAX_APS
+        self.easing = easing
+        self.gradient = None
+        Easing.GetEasing(easing) # Fail early on unknown easings
         #print(f"Operations: {self.operations}")
     
     def __repr__(self):
-        return f"<ColorShift R: {self.colorStart.red} -> {self.colorEnd.red}, G: {self.colorStart.green} -> {self.colorEnd.green}, B: {self.colorStart.blue} -> {self.colorEnd.blue} | Time: {self.operations / MAX_APS}>"
-    
-    def ComputeTimeframe(self):
-        self.timeframe[0] = TimelineData(color=self.colorStart)
-
-        st_red, st_green, st_blue = self.colorStart.red, self.colorStart.green, self.colorStart.blue
-        end_red, end_green, end_blue = self.colorEnd.red, self.colorEnd.green, self.colorEnd.blue
-
-        step_red = (end_red - st_red) / self.operations
-        step_green = (end_green - st_green) / self.operations
-        step_blue = (end_blue - st_blue) / self.operations
+        return f"<ColorShift R: {self.colorStart.red} -> {self.colorEnd.red}, G: {self.colorStart.green} -> {self.colorEnd.green}, B: {self.colorStart.blue} -> {self.colorEnd.blue} | Time: {self.operations / MAX_APS} | {self.easing}>"
 
-        #print(f"Steps {step_red}, {step_green}, {step_blue}")
+    def GetGradient(self):
+        if self.gradient is None:
+            self.gradient = Easing.Gradient(self.colorStart.GetRGB(), self.colorEnd.GetRGB(), round(self.operations), self.easing)
+        return self.gradient
 
-        t_red, t_green, t_blue = st_red, st_green, st_blue
-
-        red_values = []
-        green_values = []
-        blue_values = []
-
-        while(abs(t_red - end_red) > abs(step_red)): # While the distance between start and end is greater than step, means we can still add to it and won't go above/below end value
-            t_red += step_red
-            red_values.append(round(t_red)) # We are rounding, because the color value is an integer. We're losing smoothness but nothing we can do about it
-
-        while(abs(t_green - end_green) > abs(step_green)):
-            t_green += step_green
-            green_values.append(round(t_green)) 
-
-        while(abs(t_blue - end_blue) > abs(step_blue)):
-            t_blue += step_blue
-            blue_values.append(round(t_blue))
+    def GetKeys(self): # Local time of every row of the gradient
+        return (np.arange(len(self.GetGradient())) * self.shiftTime).astype(np.int64)
+    
+    def ComputeTimeframe(self):
+        gradient = self.GetGradient()
+        keys = self.GetKeys().tolist()
 
-        for i in range(max(len(red_values), len(green_values), len(blue_values))):
-            try:
-                red = red_values[i] # If we cannot get the value it means that we stopped tweening this color, so set this to end value
-            except:                 # This only happens if precision errors caused the lists to be uneven, fear not as this is not a problem
-                red = end_red
-            
-            try:
-                green = green_values[i]
-            except:
-                green = end_green
-            
-            try:
-                blue = blue_values[i]
-            except:
-                blue = end_blue
-            
-            
+        self.timeframe = {}
+        self.timeframe[keys[0]] = TimelineData(color=self.colorStart)
+        for key, (red, green, blue) in zip(keys[1:-1], gradient[1:-1].tolist()):
+            self.timeframe[key] = TimelineData(color=InternColor(red, green, blue))
+        self.timeframe[keys[-1]] = TimelineData(color=self.colorEnd)
+
+    def IterTimeframe(self):
+        gradient = self.gradient # Don't cache it here, streamed shifts shouldn't stay in memory once they're played
+        if gradient is None:
+            gradient = Easing.Gradient(self.colorStart.GetRGB(), self.colorEnd.GetRGB(), round(self.operations), self.easing)
+        last = len(gradient) - 1
+
+        for i, (red, green, blue) in enumerate(gradient.tolist()):
+            key = int(i * self.shiftTime)
+            if i == 0:
+                yield key, self.colorStart
+            elif i == last:
+                yield key, self.colorEnd
+            else:
+                yield key, InternColor(red, green, blue)
 
-            last_time = list(self.timeframe.keys())[-1] # Keys represent the time (local time, it gets shifted when computed by other classes)
-            #print(int(last_time + self.shiftTime))
 
-            to_append = TimelineData(color=ColorData(red, green, blue))
-            self.timeframe[int(last_time + self.shiftTime)] = to_append
-    
-        self.timeframe[int(self.operations * self.shiftTime)] = TimelineData(color=self.colorEnd)
+class EasedShift(ColorShift): # ColorShift with an easing curve as the last parameter, see easing.py for the names
+    __slots__ = ()
+    construction_types = ["ColorData", "ColorData", "float", "str"]
 
 
 class Tags(ARGBEX_BASE):
@@ -257,14 +522,32 @@ class Tags(ARGBEX_BASE):
 
 
 class TimelineData():
-    selector: Selector = None
-    color: ColorData = None
-    
-    led_dict = None
-    def __init__(self, color = None, selector = None):
+    __slots__ = ("color", "selector", "priority", "led_dict", "compositor_")
+    selector: Selector
+    color: ColorData
+
+    def __init__(self, color = None, selector = None, priority = 0):
         self.color = color
         self.selector = selector
-        self.led_dict = []
+        self.priority = priority
+        self.led_dict = None
+        self.compositor_ = None # Most TimelineDatas are never merged or rendered on their own, so it's only made when someone asks
+
+    @property
+    def compositor(self) -> LayerCompositor: # Holds this TimelineData and everything merged into it as layers
+        if self.compositor_ is None:
+            self.compositor_ = LayerCompositor()
+            self.compositor_.AddLayer(self)
+        return self.compositor_
+
+    @compositor.setter
+    def compositor(self, compositor: LayerCompositor):
+        self.compositor_ = compositor
+
+    def GetLayers(self): # Our layers without making a compositor if we're the only one
+        if self.compositor_ is None:
+            return (self,)
+        return self.compositor_.GetLayers()
 
     def GetDict(self):
         #print(f'Getting dict for {self.selector} : {self.color}')
@@ -275,26 +558,19 @@ class TimelineData():
     
     def ComputeDict(self):
         #print(f"Computing dict for {self}")
-        all_leds = self.selector.selection
-
-        temp_dict = {}
-        for led in all_leds:
-            temp_dict[led] = self.color
-        
-        self.led_dict = temp_dict
+        self.led_dict = self.compositor.GetDict()
             
     
-    def MergeWith(self, tdata):
-        self.GetDict() # Just to be sure we have generated one
+    def Copy(self): # Same layers, but merging into the copy doesn't touch us
+        copy = TimelineData(self.color, self.selector, self.priority)
+        if self.compositor_ is not None: # Otherwise we're a single layer, and so is the copy
+            copy.compositor_ = self.compositor_.Copy()
+        return copy
 
-        other_dict = tdata.GetDict()
-
-        ot_keys = list(other_dict.keys())
-        for key in ot_keys:
-            if int(key) in list(self.led_dict.keys()): #We have a duplicate
-                del other_dict[key] # We have priority (totally not egoistic behaviour)
-            else:
-                self.led_dict[key] = other_dict[key] # If that doesn't exist copy
+    def MergeWith(self, tdata):
+        # No dicts are touched here, tdata just becomes a layer below us (we have priority, totally not egoistic behaviour)
+        self.compositor.AddLayers(tdata)
+        self.led_dict = None # Needs to be recomputed
     
     def __repr__(self):
         return f"<TD [{self.selector}] -> [{self.color}]>"
@@ -306,13 +582,13 @@ class TimelineData():
 
 #ACTIONS
 class Action(ARGBEX_BASE): # Base class for every predefined action or user-defined sequences
-    selector: Selector = None
-    color: Color = None
-    tags = None
+    __slots__ = ("selector", "color", "tags", "timeline")
+    selector: Selector
+    color: Color
 
-    timeline = None
     construction_types = ["Selector", "Color", "Tags"]
     act_name = ""
+    abstract = True
 
     def __init__(self, selector, color, tags):
         self.tags = tags
@@ -325,10 +601,13 @@ class Action(ARGBEX_BASE): # Base class for every predefined action or user-defi
         if self.timeline:
             return self.timeline
         else:
-            print(f"Computing timeline for {self}")
+            Instr.Count("action_timelines_computed")
             self.ComputeTimeline()
             #print(self.timeline)
             return self.timeline
+
+    def IterTimeline(self): # (local time, TimelineData) pairs in time order, overriden when it can be done without the dict
+        return iter(sorted(self.GetTimeline().items()))
         
     def __str__(self):
         return self.__repr__()
@@ -339,6 +618,7 @@ class Action(ARGBEX_BASE): # Base class for every predefined action or user-defi
 
 # Static led change without any animations performed
 class Static(Action):
+    __slots__ = ()
     act_name = "STATIC"
     def ComputeTimeline(self):
         color_timeline = self.color.GetTimeframe()
@@ -356,11 +636,153 @@ class Static(Action):
         #print("Timelinetest")
         #print(self.timeline)
 
+    def IterTimeline(self):
+        for key, color in self.color.IterTimeframe():
+            yield key, TimelineData(color, self.selector)
+
+# Moving actions, every frame's LEDs come from the base selector by index arithmetic on ranks (offset, stride, window), nothing is listed per frame
+# Frames only get emitted when the lit LEDs or the color change, so a slow move costs as much as the number of steps it actually takes
+class MovingAction(Action):
+    __slots__ = ("size", "time")
+    construction_types = ["Selector", "Color", "int", "float", "Tags"]
+    abstract = True
+    clears = True # The rest of the selector goes dark, otherwise whatever the move passed over keeps its color (Wipe)
+
+    def __init__(self, selector, color, size, time, tags):
+        if size <= 0 or time <= 0:
+            raise RuntimeError(f"Invalid {type(self).__name__} size {size} / time {time}")
+        super().__init__(selector, color, tags)
+        self.size = size
+        self.time = time
+
+    def GetSteps(self): # Frames of the move, not counting the first one
+        return max(int(round(self.time * MAX_APS)), 1)
+
+    def GetRanks(self, step, steps, count): # Overriden, ranks lit at step of steps in a selector of count LEDs, a slice where possible
+        raise NotImplementedError
+
+    def IterRanks(self, steps, count): # Ranks of every step in order, overriden when one step depends on the ones before it
+        for step in range(steps + 1):
+            yield self.GetRanks(step, steps, count)
+
+    def MakeFrame(self, color, ranks, dark):
+        tdata = TimelineData(color, RankSelector(self.selector, ranks))
+        if dark is not None: # Below the lit LEDs, so it only gets what they don't cover
+            compositor = LayerCompositor() # Same as MergeWith, without going through it for every frame
+            compositor.AddLayer(tdata)
+            compositor.AddLayer(dark)
+            tdata.compositor = compositor
+        return tdata
+
+    def ComputeTimeline(self):
+        self.timeline = dict(self.IterTimeline())
+
+    def IterTimeline(self): # Move and color change together on the step grid, same grid ColorShift uses
+        count = len(self.selector)
+        steps = self.GetSteps()
+        shift_time = 1000 / MAX_APS
+        dark = TimelineData(InternColor(0, 0, 0), self.selector) if self.clears else None # One layer every frame shares
+        colors = self.color.IterTimeframe()
+        _, color = next(colors)
+        next_color = next(colors, None)
+        moves = self.IterRanks(steps, count)
+        ranks = None
+        last_color = last_ranks = None
+
+        i = 0
+        while i <= steps or next_color is not None: # A ColorShift longer than the move keeps going on the last frame
+            key = int(i * shift_time)
+            while next_color is not None and next_color[0] <= key:
+                color = next_color[1]
+                next_color = next(colors, None)
+            if i <= steps:
+                ranks = next(moves)
+            same = type(ranks) == slice and type(last_ranks) == slice and ranks == last_ranks # Arrays (Sparkle) always count as a change
+            if color is not last_color or not same:
+                yield key, self.MakeFrame(color, ranks, dark)
+                last_color, last_ranks = color, ranks
+            i += 1
+
+    def __repr__(self):
+        return f"ACTION<{self.act_name} {self.selector} -> {self.color} | {self.size}, {self.time}s, TAGS: {self.tags}>"
+
+
+class Chase(MovingAction): # Every size-th LED is lit, the pattern moves the length of the selector in time seconds
+    __slots__ = ()
+    act_name = "CHASE"
+
+    def GetRanks(self, step, steps, count): # Never more than one LED a step, faster than that a repeating pattern looks frozen or runs backwards
+        offset = min(count, steps) * step // steps
+        return slice(offset % self.size, count, self.size)
+
+
+class Bounce(MovingAction): # Block of size LEDs goes to the end of the selector and back in time seconds
+    __slots__ = ()
+    act_name = "BOUNCE"
+
+    def GetRanks(self, step, steps, count):
+        travel = max(count - self.size, 0)
+        position = travel * (steps - abs(2 * step - steps)) // steps # Triangle wave, 0 -> travel -> 0
+        return slice(position, position + self.size)
+
+
+SPARKLE_CHUNK = 256 # Steps Sparkle picks its LEDs for at once
+
+def PickRanks(keys, size): # size lowest of random keys is a pick without repeats, sorted, for every row of keys
+    return np.sort(np.argpartition(keys, size - 1, axis=-1)[..., :size], axis=-1)
+
+class Sparkle(MovingAction): # size random LEDs of the selector every frame, for time seconds
+    __slots__ = ()
+    act_name = "SPARKLE"
+    seed = 1234 # Same sparkles every time the song is rendered, the preset cache relies on that
+
+    def GetRanks(self, step, steps, count): # Only for a single step, IterRanks is what renders use
+        size = min(self.size, count)
+        if not size or step >= steps: # Empty selector, or the last frame which is dark
+            return slice(0, 0)
+        bit_generator = np.random.PCG64(self.seed) # What default_rng uses
+        bit_generator.advance(step * count) # Every random float is one draw, this skips the keys of all the steps before
+        return PickRanks(np.random.Generator(bit_generator).random(count), size)
+
+    def IterRanks(self, steps, count):
+        size = min(self.size, count)
+        if not size: # Empty selector
+            yield from (slice(0, 0) for _ in range(steps + 1))
+            return
+        rng = np.random.default_rng(self.seed)
+        for begin in range(0, steps, SPARKLE_CHUNK): # A whole block of steps in one go
+            yield from PickRanks(rng.random((min(SPARKLE_CHUNK, steps - begin), count)), size)
+        yield slice(0, 0) # Last frame is dark
+
+
+class Wipe(MovingAction): # The color fills the selector from its first LED to its last in time seconds, the rest isn't touched
+    __slots__ = ()
+    act_name = "WIPE"
+    construction_types = ["Selector", "Color", "float", "Tags"]
+    clears = False
+
+    def __init__(self, selector, color, time, tags):
+        super().__init__(selector, color, 1, time, tags)
+
+    def GetRanks(self, step, steps, count):
+        return slice(0, -(-count * step // steps)) # Rounded up, the last step fills everything
+
+    def __repr__(self):
+        return f"ACTION<{self.act_name} {self.selector} -> {self.color} | {self.time}s, TAGS: {self.tags}>"
+
+SequenceCacheInfo = namedtuple("SequenceCacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
 class UserDefinedSequence():
     name = ""
     ud_parameters = None
     actions_raw: list = None
+    ops: list = None # Compiled body (see preset_compiler.py), used instead of actions_raw when it's set
     all_sequence_definitions: dict = None
+    cache_size = 128 # Expanded timelines kept per sequence, least recently used ones get dropped
+    timeline_cache: OrderedDict = None
+    hits = 0
+    misses = 0
+    expanding = False
 
 
     def __init__(self, name, parameters, sequences):
@@ -368,45 +790,268 @@ class UserDefinedSequence():
         self.ud_parameters = [str(x) for x in parameters]
         self.all_sequence_definitions = sequences
         self.actions_raw = []
+        self.ops = None
+        self.timeline_cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.expanding = False
 
-    def addActionRaw(self, action: list):
+    def addActionRaw(self, action: list): # (name, [params]), or ("loop", [args], [body actions]) for a loop block
         self.actions_raw.append(action)
+        self.ClearCache() # Definition changed, old expansions are wrong now
 
-    def ReplaceVarsInActionRaw(self, action, values): # action argument is mutable, but it may contain immutable tuples, which is a problem. We need to re-construct it from scratch :sob:
-        name, params = action # Unpack
-        #print(f"Replace {action}, {self.ud_parameters} -> {values}")
-        
-        for i in range(len(params)):
+    def SetOps(self, ops):
+        self.ops = ops
+        self.ClearCache()
 
-            if type(params[i]) == tuple: # Function in function type scenario, similar to what happens in Objectify()
-                self.ReplaceVarsInActionRaw(params[i], values)
+    def ReplaceVarsInActionRaw(self, action, values): # Builds a new action, actions_raw is never touched since Objectify edits whatever it gets
+        name, params = action[0], action[1] # Unpack
+        #print(f"Replace {action}, {self.ud_parameters} -> {values}")
+        replaced = []
+        for param in params:
+            if type(param) == tuple: # Function in function type scenario, similar to what happens in Objectify()
+                replaced.append(self.ReplaceVarsInActionRaw(param, values))
+            elif param in self.ud_parameters:
+                replaced.append(values[self.ud_parameters.index(param)]) # Replace the var
             else:
-                for j in range(len(self.ud_parameters)):
-                    if params[i] == self.ud_parameters[j]:
-                        #print(f"Replacing {params[i]} with {values[j]}")
-                        params[i] = values[j] # Replace the var
+                replaced.append(param)
 
-        return name, params
+        if len(action) > 2: # Loop, its body can use our parameters too
+            return name, replaced, [self.ReplaceVarsInActionRaw(statement, values) for statement in action[2]]
+        return name, replaced
 
-    
-    def GetTimeline(self, parameters): # This is always computed at runtime, since we can use different variables
+    def GetCacheKey(self, parameters):
+        return tuple(str(x) for x in parameters)
+
+    def GetTimeline(self, parameters = ()): # Relative timeline {ms : TimelineData}, expanded once per distinct set of arguments
         if len(parameters) != len(self.ud_parameters):
             raise RuntimeError(f"Wrong amount of numbers passed {parameters}, {self.ud_parameters}")
-        
-        actions = self.actions_raw.copy() # Important that we don't touch the list in this class
 
+        key = self.GetCacheKey(parameters)
+        try:
+            timeline = self.timeline_cache[key]
+            self.timeline_cache.move_to_end(key)
+            self.hits += 1
+            Instr.Count("sequence_cache_hits")
+            return timeline # Shared between every call, Timeline.addAction shifts and copies it on insertion
+        except KeyError:
+            self.misses += 1
+            Instr.Count("sequence_cache_misses")
+
+        timeline = self.ComputeTimeline(parameters)
+        self.timeline_cache[key] = timeline
+        if len(self.timeline_cache) > self.cache_size:
+            self.timeline_cache.popitem(last=False)
+        return timeline
+
+    def ComputeTimeline(self, parameters):
+        return self.Expand(parameters, MergeParts)
+
+    def IterTimeline(self, parameters = ()): # Lazy GetTimeline, loops are repeated while iterating instead of being written out, nothing gets cached
+        if len(parameters) != len(self.ud_parameters):
+            raise RuntimeError(f"Wrong amount of numbers passed {parameters}, {self.ud_parameters}")
+        return self.Expand(parameters, IterParts)
+
+    def Expand(self, parameters, merge): # merge is MergeParts or IterParts, both expand nested sequences right away so the guard covers them
+        if self.expanding:
+            raise RuntimeError(f"Sequence {self.name} calls itself")
+
+        self.expanding = True
+        try:
+            if self.ops is not None:
+                from preset_compiler import RunOps
+                parts, _ = RunOps(self.ops, parameters, self.all_sequence_definitions)
+            else:
+                parts, _ = self.ExpandParts([self.ReplaceVarsInActionRaw(action, parameters) for action in self.actions_raw])
+            return merge(parts)
+        finally:
+            self.expanding = False
+
+    def ExpandParts(self, actions): # Objectifies actions, returns their (local offset, source) pairs and the local time after the last Wait
         from argbex_parser import Objectify as Obj
 
-        if len(self.ud_parameters):
-            for i in range(len(actions)):
-                actions[i] = self.ReplaceVarsInActionRaw(actions[i], parameters) #This will turn it into ready to process objects :) [hopefully, the bugs are killing me]
+        parts = []
+        offset = 0 # Local time, moved forward by every Wait and loop
+        for action in actions:
+            if len(action) > 2:
+                loop = self.BuildLoop(action[1], action[2], offset)
+                parts.append((offset, loop))
+                offset += loop.GetDuration()
+                continue
+
+            obj, params = Obj(action, self.all_sequence_definitions) #This will turn it into ready to process objects :)
+            if isinstance(obj, Wait):
+                offset += int(round(obj.wait * 1000))
+            elif isinstance(obj, UserDefinedSequence):
+                parts.append((offset, SequenceCall(obj, params)))
+            else:
+                parts.append((offset, obj))
+        return parts, offset
 
-        for i in range(len(actions)):
-                actions[i] = Obj(actions[i], self.all_sequence_definitions) #This will turn it into ready to process objects :) [hopefully, the bugs are killing me]  
-        
-        #TODO: Process the objects and return a timeline, and this should be it!
+    def BuildLoop(self, args, body, start): # start is the local time the loop begins at
+        kind, value, force = ParseLoopArgs(args)
+        parts, period = self.ExpandParts(body)
+        return MakeLoop(kind, value, force, parts, period, start)
+
+    def CacheInfo(self):
+        return SequenceCacheInfo(self.hits, self.misses, self.cache_size, len(self.timeline_cache))
+
+    def ClearCache(self):
+        self.timeline_cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f"SEQUENCE<{self.name}({' '.join(self.ud_parameters)})>"
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class SequenceCall(): # A user defined sequence together with its arguments, so it can be scheduled like any Action
+    sequence: UserDefinedSequence = None
+    parameters = None
+
+    def __init__(self, sequence, parameters):
+        self.sequence = sequence
+        self.parameters = list(parameters)
+
+    def GetTimeline(self):
+        return self.sequence.GetTimeline(self.parameters)
+
+    def IterTimeline(self):
+        return self.sequence.IterTimeline(self.parameters)
+
+    def __repr__(self):
+        return f"CALL<{self.sequence.name}({' '.join(map(str, self.parameters))})>"
+
+    def __str__(self):
+        return self.__repr__()
+
+
+# LOOPS
+# loop(for N) { .. } repeats its body N times, loop(T until) { .. } until T seconds into the sequence (the last iteration still finishes)
+# loop(T until force) stops right at T, cutting the last iteration short, whatever comes after the loop starts at T either way
+# The body is expanded once, IterTimeline repeats it while iterating so a lazy timeline never holds more than one copy
+# where is the (line, column, path) of the loop for errors, empty when it isn't known
+def ParseLoopArgs(args, where = ()): # Raw loop arguments -> ("for", count, False) or ("until", time, force), values can still be sequence parameters
+    words = [arg.lower() if type(arg) == str else arg for arg in args]
+    if len(words) == 2 and words[0] == "for":
+        return "for", args[1], False
+    if len(words) in (2, 3) and words[1] == "until" and (len(words) == 2 or words[2] == "force"):
+        return "until", args[0], len(words) == 3
+    raise ArgbexSyntaxError(f"Expected loop(for COUNT), loop(TIME until) or loop(TIME until force), got loop({' '.join(map(str, args))})", *where)
+
+def MakeLoop(kind, value, force, parts, period, start, where = ()): # value is still text when it came from the preset, "until" times count from the start of the sequence
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise ArgbexSyntaxError(f"Loop needs a number, got {value!r}", *where) from None
+
+    if kind == "for":
+        if value < 0 or value != int(value):
+            raise ArgbexSyntaxError(f"Loop count has to be a whole number, got {value}", *where)
+        return SequenceLoop(parts, period, int(value))
+
+    if period <= 0:
+        raise ArgbexSyntaxError(f"Loop until {value} never ends, its body has to Wait", *where)
+    end = max(int(round(value * 1000)) - start, 0)
+    count = -(-end // period) # Every iteration that starts before the end
+    return SequenceLoop(parts, period, count, end if force else None)
+
+
+class SequenceLoop():
+    parts = None # (local offset, source) pairs of a single iteration
+    period = 0 # ms from one iteration to the next, all the Waits of the body
+    count = 0
+    end = None # ms, with force nothing at or after it is played
+    body = None # Sorted (local time, TimelineData) pairs of one iteration, merged on first use
+
+    def __init__(self, parts, period, count, end = None):
+        self.parts = parts
+        self.period = period
+        self.count = count
+        self.end = end
+        self.body = None
+
+    def GetDuration(self):
+        return self.end if self.end is not None else self.count * self.period
+
+    def GetBody(self):
+        if self.body is None:
+            self.body = sorted(MergeParts(self.parts).items())
+        return self.body
+
+    def GetTimeline(self): # Every iteration written out, for eager timelines
+        body = dict(self.GetBody())
+        timeline = Timeline(MAX_APS)
+        timeline.addActions([(i * self.period, body) for i in range(self.count)]) # Earlier iterations win where they overlap
+        if self.end is not None:
+            return {key: tdata for key, tdata in timeline.tmline.items() if key < self.end}
+        return timeline.tmline
+
+    def IterTimeline(self): # Same pairs as GetTimeline in time order, only the iterations overlapping the current time are alive
+        body = self.GetBody()
+        if not body or not self.count:
+            return iter(())
+        return self.IterIterations(body)
+
+    def IterIterations(self, body):
+        grid = Timeline(MAX_APS)
+        heap = [] # (time, iteration, index into body)
+        iteration = 0
+        while True:
+            while iteration < self.count: # Start every iteration that begins before what's already waiting
+                start = grid.SnapKey(iteration * self.period + body[0][0])
+                if heap and start > heap[0][0]:
+                    break
+                heapq.heappush(heap, (start, iteration, 0))
+                iteration += 1
+            if not heap:
+                return
+
+            key, current, index = heapq.heappop(heap)
+            if self.end is not None and key >= self.end:
+                return
+            yield key, body[index][1]
+            if index + 1 < len(body):
+                heapq.heappush(heap, (grid.SnapKey(current * self.period + body[index + 1][0]), current, index + 1))
+
+    def __repr__(self):
+        return f"LOOP<{self.count} x {self.period}ms, {len(self.parts)} parts>"
+
+    def __str__(self):
+        return self.__repr__()
+
+
+def IterSource(source): # Local (time, TimelineData) pairs of anything that can be scheduled on a Timeline
+    if hasattr(source, "IterTimeline"):
+        return source.IterTimeline()
+    return iter(sorted(source.GetTimeline().items()))
+
+def MergeParts(parts): # (local offset, source) pairs -> relative timeline dict, earlier parts win
+    timeline = Timeline(MAX_APS)
+    for offset, source in parts:
+        timeline.addAction(offset, source.GetTimeline())
+    return timeline.tmline
+
+def IterParts(parts): # Lazy MergeParts, yields (local time, TimelineData) in time order, several per time in priority order
+    grid = Timeline(MAX_APS)
+    heap = [] # (time, part, TimelineData, offset, iterator), one entry per part
+    for order, (offset, source) in enumerate(parts): # Every part starts right away, so a sequence calling itself fails now and not halfway through playback
+        PushNextPart(heap, grid, order, offset, IterSource(source))
+    return DrainParts(heap, grid)
+
+def PushNextPart(heap, grid, order, offset, events):
+    for key, tdata in events:
+        heapq.heappush(heap, (grid.SnapKey(int(key + offset)), order, tdata, offset, events)) # Snapped like addAction does it
+        return
 
-        return actions
+def DrainParts(heap, grid):
+    while heap:
+        key, order, tdata, offset, events = heapq.heappop(heap)
+        yield key, tdata
+        PushNextPart(heap, grid, order, offset, events)
 
 
 class Wait(ARGBEX_BASE):
@@ -428,6 +1073,7 @@ def getglobals():
 #Need this for Objectify
 int = int
 float = float
+str = str
 #a = Color(2, 10, 0)
 #print(a.GetTimeframe()[0].green)
 
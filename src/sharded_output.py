@@ -0,0 +1,448 @@
+# Splits rendered frames over several controllers, every controller gets its own part of the strip through its own persistent connection
+# A segment map says which LED ids of the preset go to which controller (and where on that controller's strip they start)
+# Every controller has its own sender task, a slow or unreachable one only drops its own frames, the others and the scheduler never wait for it
+import argparse
+import asyncio
+import json
+import socket
+import struct
+import time
+from collections import deque
+from pathlib import Path
+
+import numpy as np
+import sequence_definitions as SD
+import instrumentation as Instr
+from wire_protocol import DeltaEncoder
+
+DEFAULT_PORT = 7777
+RETRY_DELAY = 0.1 # Seconds before reconnecting to a controller that failed, doubled on every failure in a row
+MAX_RETRY_DELAY = 2.0
+IO_TIMEOUT = 1.0 # Seconds a connect, send or close may take, a controller slower than that counts as failed
+
+
+class Controller():
+    name = ""
+    host = "127.0.0.1"
+    port = DEFAULT_PORT
+    protocol = "udp" # "udp" or "tcp", same framing as wire_protocol's transports
+    led_count = 0
+    keyframe_interval = 100
+
+    def __init__(self, name, host, port = DEFAULT_PORT, protocol = "udp", led_count = 0, keyframe_interval = 100):
+        if protocol not in ("udp", "tcp"):
+            raise ValueError(f"Controller {name}: unknown protocol {protocol!r}")
+        self.name = name
+        self.host = host
+        self.port = int(port)
+        self.protocol = protocol
+        self.led_count = int(led_count)
+        self.keyframe_interval = int(keyframe_interval)
+
+    def GetAddress(self):
+        return self.protocol, self.host, self.port
+
+    def __repr__(self):
+        return f"<Controller {self.name} {self.protocol}://{self.host}:{self.port} | {self.led_count} LEDs>"
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class Segment(): # count LEDs starting at LED id first (1-based, like Range) go to the controller, starting at its LED id controller_first
+    controller = ""
+    first = 1
+    count = 0
+    controller_first = 1
+
+    def __init__(self, controller, first, count, controller_first = 1):
+        self.controller = controller
+        self.first = int(first)
+        self.count = int(count)
+        self.controller_first = int(controller_first)
+
+    def __repr__(self):
+        return f"<Segment {self.first}..{self.first + self.count - 1} -> {self.controller} @ {self.controller_first}>"
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class SegmentMap():
+    controllers: dict = None # Name -> Controller, in the order they were given
+    segments: list = None
+    frame_leds = 0 # LEDs in a rendered frame
+    gathers: dict = None # Name -> (controller positions, frame positions) index arrays, or a slice when one segment covers the whole controller
+
+    def __init__(self, controllers, segments, frame_leds = None):
+        self.controllers = {controller.name: controller for controller in controllers}
+        self.segments = list(segments)
+        self.frame_leds = frame_leds or SD.MAX_LED
+        self.Validate()
+        self.gathers = {name: self.BuildGather(name) for name in self.controllers}
+
+    def Validate(self):
+        if len(self.controllers) == 0:
+            raise ValueError("Segment map has no controllers")
+        owners = np.full(self.frame_leds, -1, dtype=np.intp) # Which segment every frame LED goes to, a frame LED can only go to one place
+        for controller in self.controllers.values():
+            if controller.led_count <= 0:
+                controller.led_count = sum(segment.count for segment in self.segments if segment.controller == controller.name) # Default, exactly what's mapped to it
+        used = {name: np.zeros(controller.led_count, dtype=bool) for name, controller in self.controllers.items()}
+
+        for i, segment in enumerate(self.segments):
+            if segment.controller not in self.controllers:
+                raise ValueError(f"{segment} uses an unknown controller")
+            if segment.count <= 0 or segment.first < 1 or segment.first + segment.count - 1 > self.frame_leds:
+                raise ValueError(f"{segment} doesn't fit in a frame of {self.frame_leds} LEDs")
+            start = segment.controller_first - 1
+            strip = used[segment.controller]
+            if start < 0 or start + segment.count > len(strip):
+                raise ValueError(f"{segment} doesn't fit on {self.controllers[segment.controller]}")
+
+            frame_range = owners[segment.first - 1:segment.first - 1 + segment.count]
+            if np.any(frame_range >= 0):
+                raise ValueError(f"{segment} overlaps {self.segments[int(frame_range[frame_range >= 0][0])]}")
+            if np.any(strip[start:start + segment.count]):
+                raise ValueError(f"{segment} overlaps another segment on {segment.controller}")
+            frame_range[:] = i
+            strip[start:start + segment.count] = True
+
+    def BuildGather(self, name):
+        controller = self.controllers[name]
+        segments = [segment for segment in self.segments if segment.controller == name]
+        if len(segments) == 1 and segments[0].count == controller.led_count: # One piece of the frame as it is, no copying needed to cut it out
+            first = segments[0].first - 1
+            return slice(first, first + segments[0].count)
+
+        targets = np.concatenate([np.arange(segment.count, dtype=np.intp) + segment.controller_first - 1 for segment in segments]) if segments else np.zeros(0, dtype=np.intp)
+        sources = np.concatenate([np.arange(segment.count, dtype=np.intp) + segment.first - 1 for segment in segments]) if segments else np.zeros(0, dtype=np.intp)
+        return targets, sources
+
+    def Split(self, frame): # Yields (controller name, its (led_count, 3) part of the frame), parts may be views of frame
+        for name, gather in self.gathers.items():
+            if type(gather) == slice:
+                yield name, frame[gather]
+            else:
+                targets, sources = gather
+                part = np.zeros((self.controllers[name].led_count, 3), dtype=np.uint8) # LEDs nothing is mapped to stay dark
+                part[targets] = frame[sources]
+                yield name, part
+
+    def ToDict(self):
+        return {
+            "frame_leds": self.frame_leds,
+            "controllers": [{"name": c.name, "host": c.host, "port": c.port, "protocol": c.protocol, "leds": c.led_count, "keyframe_interval": c.keyframe_interval} for c in self.controllers.values()],
+            "segments": [{"controller": s.controller, "first": s.first, "count": s.count, "controller_first": s.controller_first} for s in self.segments],
+        }
+
+    def __repr__(self):
+        return f"<SegmentMap {len(self.controllers)} controllers, {len(self.segments)} segments, {self.frame_leds} LEDs>"
+
+    def __str__(self):
+        return self.__repr__()
+
+
+def SegmentMapFromDict(data):
+    controllers = [Controller(c["name"], c.get("host", "127.0.0.1"), c.get("port", DEFAULT_PORT), c.get("protocol", "udp"), c.get("leds", 0), c.get("keyframe_interval", 100)) for c in data["controllers"]]
+    segments = [Segment(s["controller"], s["first"], s["count"], s.get("controller_first", 1)) for s in data["segments"]]
+    return SegmentMap(controllers, segments, data.get("frame_leds"))
+
+def LoadSegmentMap(path: Path):
+    return SegmentMapFromDict(json.loads(Path(path).read_text()))
+
+def EvenSegmentMap(addresses, frame_leds = None, protocol = "udp"): # The frame cut into equal consecutive pieces, one per (host, port)
+    frame_leds = frame_leds or SD.MAX_LED
+    bounds = np.linspace(0, frame_leds, len(addresses) + 1).round().astype(int)
+    controllers = []
+    segments = []
+    for i, (host, port) in enumerate(addresses):
+        count = int(bounds[i + 1] - bounds[i])
+        controllers.append(Controller(f"strip{i}", host, port, protocol, count))
+        segments.append(Segment(f"strip{i}", int(bounds[i]) + 1, count))
+    return SegmentMap(controllers, segments, frame_leds)
+
+
+# CONNECTIONS
+class UdpConnection():
+    transport = None
+
+    async def Open(self, host, port):
+        self.transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(asyncio.DatagramProtocol, remote_addr=(host, port))
+
+    async def Send(self, packets):
+        for packet in packets:
+            self.transport.sendto(packet)
+
+    def IsOpen(self):
+        return self.transport is not None and not self.transport.is_closing()
+
+    async def Close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+
+class TcpConnection(): # Packets are prefixed with their u16 length, like TcpTransport
+    writer: asyncio.StreamWriter = None
+
+    async def Open(self, host, port):
+        _, self.writer = await asyncio.wait_for(asyncio.open_connection(host, port), IO_TIMEOUT)
+        self.writer.get_extra_info("socket").setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    async def Send(self, packets):
+        self.writer.write(b"".join(struct.pack("<H", len(packet)) + packet for packet in packets))
+        await asyncio.wait_for(self.writer.drain(), IO_TIMEOUT) # A controller that can't keep up makes us wait here, which is what makes its frames pile up and get dropped
+
+    def IsOpen(self):
+        return self.writer is not None and not self.writer.is_closing()
+
+    async def Close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await asyncio.wait_for(self.writer.wait_closed(), IO_TIMEOUT)
+            except (OSError, asyncio.TimeoutError): # It isn't taking what's left in the buffer, just drop it
+                self.writer.transport.abort()
+
+
+class ConnectionPool(): # Persistent connections by (protocol, host, port), they stay open across songs and segment maps
+    connections: dict = None # Address -> the connection Get hands out
+    users: dict = None # Connection -> how many links hold it, a link's failure can't close it under the others
+
+    def __init__(self):
+        self.connections = {}
+        self.users = {}
+        self.locks = {}
+
+    async def Get(self, address): # Every Get needs its Release
+        connection = self.connections.get(address)
+        if connection is None or not connection.IsOpen():
+            lock = self.locks.setdefault(address, asyncio.Lock()) # Two links to the same address shouldn't both connect
+            async with lock:
+                connection = self.connections.get(address)
+                if connection is None or not connection.IsOpen():
+                    protocol, host, port = address
+                    connection = UdpConnection() if protocol == "udp" else TcpConnection()
+                    await connection.Open(host, port)
+                    self.connections[address] = connection
+        self.users[connection] = self.users.get(connection, 0) + 1
+        return connection
+
+    async def Release(self, address, connection): # Connections Discard took out of the pool close once their last user lets go
+        users = self.users.pop(connection, 1) - 1
+        if users > 0:
+            self.users[connection] = users
+        elif self.connections.get(address) is not connection:
+            await connection.Close()
+
+    async def Discard(self, address, connection): # Broken connection, the next Get opens a new one, links still sending on it move over on their next frame
+        if self.connections.get(address) is connection: # Not if another link already replaced it
+            del self.connections[address]
+        await self.Release(address, connection)
+
+    async def Close(self):
+        connections = set(self.connections.values()) | set(self.users) # Discarded ones still held too
+        self.connections = {}
+        self.users = {}
+        await asyncio.gather(*(connection.Close() for connection in connections))
+
+    def __len__(self):
+        return len(self.connections)
+
+
+# OUTPUT
+class ControllerStats():
+    frames_offered = 0
+    frames_sent = 0
+    frames_dropped = 0 # Replaced by a newer frame before they could be sent
+    packets_sent = 0
+    bytes_sent = 0
+    send_errors = 0
+    connects = 0
+    total_send_time = 0.0 # Seconds, encoding included
+    max_send_time = 0.0
+
+    def __init__(self):
+        self.frames_offered = 0
+        self.frames_sent = 0
+        self.frames_dropped = 0
+        self.packets_sent = 0
+        self.bytes_sent = 0
+        self.send_errors = 0
+        self.connects = 0
+        self.total_send_time = 0.0
+        self.max_send_time = 0.0
+
+    def RecordSend(self, packets, nbytes, seconds):
+        self.frames_sent += 1
+        self.packets_sent += packets
+        self.bytes_sent += nbytes
+        self.total_send_time += seconds
+        if seconds > self.max_send_time:
+            self.max_send_time = seconds
+
+    def ToDict(self):
+        return {
+            "frames_offered": self.frames_offered,
+            "frames_sent": self.frames_sent,
+            "frames_dropped": self.frames_dropped,
+            "packets_sent": self.packets_sent,
+            "bytes_sent": self.bytes_sent,
+            "send_errors": self.send_errors,
+            "connects": self.connects,
+            "mean_send_ms": self.total_send_time * 1000 / self.frames_sent if self.frames_sent else 0.0,
+            "max_send_ms": self.max_send_time * 1000,
+        }
+
+    def __repr__(self):
+        return f"<ControllerStats sent: {self.frames_sent}, dropped: {self.frames_dropped}, errors: {self.send_errors}, {self.bytes_sent} bytes>"
+
+    def __str__(self):
+        return self.__repr__()
+
+
+class ControllerLink(): # One controller, its encoder and the frames waiting to be sent to it
+    controller: Controller = None
+    pool: ConnectionPool = None
+    encoder: DeltaEncoder = None
+    pending: deque = None # (position, frame), the oldest ones fall out when the controller can't keep up
+    stats: ControllerStats = None
+
+    def __init__(self, controller: Controller, pool: ConnectionPool, max_pending = 1):
+        self.controller = controller
+        self.pool = pool
+        self.encoder = DeltaEncoder(controller.led_count, controller.keyframe_interval)
+        self.pending = deque(maxlen=max(int(max_pending), 1))
+        self.stats = ControllerStats()
+        self.ready = asyncio.Event()
+        self.halt = asyncio.Event() # Set by Stop, cuts a reconnect delay short
+        self.stopped = False
+        self.task = None
+
+    def Offer(self, position, frame): # Never waits, the frame gets copied since the caller reuses its buffer
+        if len(self.pending) == self.pending.maxlen:
+            self.stats.frames_dropped += 1
+            if Instr.ENABLED:
+                Instr.Count("output_frames_dropped")
+        self.pending.append((position, frame.copy()))
+        self.stats.frames_offered += 1
+        self.ready.set()
+
+    async def Run(self):
+        address = self.controller.GetAddress()
+        retry_delay = RETRY_DELAY
+        connection = None # The one this link holds in the pool
+        try:
+            while not self.stopped:
+                if not self.pending:
+                    self.ready.clear()
+                    await self.ready.wait()
+                    continue
+
+                position, frame = self.pending.popleft()
+                started = time.perf_counter()
+                try:
+                    if connection is None or connection is not self.pool.connections.get(address) or not connection.IsOpen():
+                        if connection is not None:
+                            held, connection = connection, None
+                            await self.pool.Release(address, held)
+                        connection = await self.pool.Get(address)
+                        self.stats.connects += 1
+                        self.encoder.ForceKeyframe() # Whatever the controller had is unknown now
+                    packets = self.encoder.Encode(frame, position)
+                    await connection.Send(packets)
+                except (OSError, asyncio.TimeoutError) as e:
+                    self.stats.send_errors += 1
+                    if connection is not None:
+                        failed, connection = connection, None
+                        await self.pool.Discard(address, failed)
+                    self.encoder.ForceKeyframe()
+                    print(f"Output to {self.controller.name} failed: {str(e) or 'timed out'}")
+                    try:
+                        await asyncio.wait_for(self.halt.wait(), retry_delay) # Frames offered meanwhile just replace each other
+                    except asyncio.TimeoutError:
+                        pass
+                    retry_delay = min(retry_delay * 2, MAX_RETRY_DELAY)
+                    continue
+
+                retry_delay = RETRY_DELAY
+                self.stats.RecordSend(len(packets), sum(map(len, packets)), time.perf_counter() - started)
+                if Instr.ENABLED:
+                    Instr.Count("output_frames_sent")
+        finally:
+            if connection is not None:
+                await self.pool.Release(address, connection)
+
+    def Start(self):
+        self.task = asyncio.get_running_loop().create_task(self.Run())
+        return self.task
+
+    async def Stop(self):
+        self.stopped = True
+        self.ready.set()
+        self.halt.set()
+        if self.task is not None:
+            await self.task
+
+
+class ShardedOutput(): # Sink for PlaybackScheduler, cuts every frame by the segment map and hands the parts to the controllers
+    segment_map: SegmentMap = None
+    pool: ConnectionPool = None
+    links: dict = None # Controller name -> ControllerLink
+
+    def __init__(self, segment_map: SegmentMap, pool: ConnectionPool = None, max_pending = 1):
+        self.segment_map = segment_map
+        self.owns_pool = pool is None
+        self.pool = pool if pool is not None else ConnectionPool()
+        self.links = {name: ControllerLink(controller, self.pool, max_pending) for name, controller in segment_map.controllers.items()}
+
+    def __call__(self, position, frame):
+        for name, part in self.segment_map.Split(frame):
+            self.links[name].Offer(position, part)
+
+    def Start(self): # Sender tasks on the running loop, call it before the scheduler starts
+        for link in self.links.values():
+            link.Start()
+
+    async def Stop(self):
+        await asyncio.gather(*(link.Stop() for link in self.links.values()))
+        if self.owns_pool:
+            await self.pool.Close()
+
+    def ForceKeyframe(self): # eg. after a seek
+        for link in self.links.values():
+            link.encoder.ForceKeyframe()
+
+    def GetStats(self):
+        return {name: link.stats.ToDict() for name, link in self.links.items()}
+
+    async def __aenter__(self):
+        self.Start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.Stop()
+
+
+if __name__ == "__main__":
+    from preset_cache import LoadPreset
+    from playback import PlaybackScheduler
+    from post_process import AddPostProcessArguments, PostProcessorFromArguments, ProcessedSink
+
+    parser = argparse.ArgumentParser(description="Play a preset on several controllers at once")
+    parser.add_argument("preset", type=Path)
+    parser.add_argument("segment_map", type=Path, help="JSON file with \"controllers\" and \"segments\"")
+    parser.add_argument("--loop", action="store_true", help="Start over at the end of the song")
+    AddPostProcessArguments(parser)
+    args = parser.parse_args()
+
+    async def Main():
+        segment_map = LoadSegmentMap(args.segment_map)
+        print(segment_map)
+        async with ShardedOutput(segment_map) as output:
+            processor = PostProcessorFromArguments(args)
+            scheduler = PlaybackScheduler(LoadPreset(args.preset), ProcessedSink(processor, output) if len(processor) else output)
+            print(await scheduler.Run(loop_song=args.loop))
+        print(json.dumps(output.GetStats(), indent=1))
+
+    asyncio.run(Main())
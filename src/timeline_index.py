@@ -0,0 +1,85 @@
+# Seek index for a Timeline, sorted timestamps plus a full snapshot of the strip every keyframe_interval changes
+# Any position costs one bisect plus at most keyframe_interval - 1 deltas, no matter how far into the song it is
+from bisect import bisect_right
+
+import numpy as np
+
+import sequence_definitions as SD
+from frame_stream import StreamEvents
+
+DEFAULT_KEYFRAME_INTERVAL = 64
+
+
+class TimelineIndex():
+    timestamps = None # (changes,) int64, sorted
+    deltas = None # LayerCompositor of every change, same order as timestamps
+    snapshots = None # (changes // interval + 1, MAX_LED, 3) uint8, state right after change k * interval
+    keyframe_interval = DEFAULT_KEYFRAME_INTERVAL
+
+    def __init__(self, timeline: SD.Timeline, keyframe_interval = DEFAULT_KEYFRAME_INTERVAL):
+        self.keyframe_interval = max(int(keyframe_interval), 1)
+
+        timestamps = []
+        self.deltas = []
+        snapshots = []
+        state = np.zeros((SD.MAX_LED, 3), dtype=np.uint8)
+        for timestamp, compositor in StreamEvents(timeline):
+            compositor.Composite(state)
+            if len(self.deltas) % self.keyframe_interval == 0:
+                snapshots.append(state.copy())
+            timestamps.append(timestamp)
+            self.deltas.append(compositor)
+
+        self.timestamp_list = timestamps # bisect works on plain lists faster than on numpy scalars
+        self.timestamps = np.array(timestamps, dtype=np.int64)
+        self.snapshots = np.stack(snapshots) if snapshots else np.zeros((0, SD.MAX_LED, 3), dtype=np.uint8)
+
+        self.cursor = -1 # Last change GetFrame returned and the state after it, playback mostly moves forward so we continue from there
+        self.cursor_state = np.zeros((SD.MAX_LED, 3), dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.timestamp_list)
+
+    def Locate(self, timestamp): # Index of the last change at or before timestamp, -1 if nothing happened yet
+        return bisect_right(self.timestamp_list, timestamp) - 1
+
+    def StateAfter(self, change, out = None): # Full strip state right after a change, from the closest keyframe
+        if out is None:
+            out = np.empty((self.snapshots.shape[1], 3), dtype=np.uint8)
+        if change < 0:
+            out[:] = 0
+            return out
+
+        keyframe = change // self.keyframe_interval
+        out[:] = self.snapshots[keyframe]
+        for i in range(keyframe * self.keyframe_interval + 1, change + 1):
+            self.deltas[i].Composite(out)
+        return out
+
+    def GetState(self, timestamp): # Independent copy of the state at any point of the song
+        return self.StateAfter(self.Locate(timestamp))
+
+    def GetFrame(self, timestamp): # Same as GetState but reuses one buffer and replays forward from the last call when it's close, meant for playback
+        change = self.Locate(timestamp)
+        if change == self.cursor:
+            return self.cursor_state
+
+        if self.cursor < change and change - self.cursor < self.keyframe_interval:
+            for i in range(self.cursor + 1, change + 1):
+                self.deltas[i].Composite(self.cursor_state)
+        else:
+            self.StateAfter(change, self.cursor_state)
+        self.cursor = change
+        return self.cursor_state
+
+    def NextChange(self, timestamp): # Timestamp of the first change after timestamp, None at the end
+        change = self.Locate(timestamp) + 1
+        if change >= len(self.timestamp_list):
+            return None
+        return self.timestamp_list[change]
+
+    def __repr__(self):
+        return f"<TimelineIndex {len(self)} changes, {len(self.snapshots)} keyframes every {self.keyframe_interval}>"
+
+    def __str__(self):
+        return self.__repr__()
@@ -0,0 +1,181 @@
+# Binary protocol for the ESP32, only the LED runs that changed since the last frame are sent, with a full keyframe every now and then
+# Packet (little endian):
+#   header: magic "AX" | version u8 | flags u8 | sequence u32 | timestamp ms u32 | run count u16
+#   runs:   start u16 | length u16 | length * (r, g, b)
+# Runs carry absolute positions so every packet can be applied on its own, a lost packet is repaired by the next keyframe
+import socket
+import struct
+
+import numpy as np
+
+MAGIC = b"AX"
+VERSION = 1
+HEADER = struct.Struct("<2sBBIIH")
+RUN_HEADER = struct.Struct("<HH")
+
+FLAG_KEYFRAME = 1 # Runs cover the whole strip
+FLAG_END = 2 # Last packet of a frame
+
+MAX_PAYLOAD = 1400 # Stays under a normal ethernet/wifi MTU, bigger frames get split into several packets
+MERGE_GAP = 1 # Unchanged LEDs between two runs that are cheaper to resend than to start a new run (3 bytes each vs 4 for a run header)
+
+
+def FindRuns(changed): # (starts, lengths) of the True blocks in a boolean array, blocks closer than MERGE_GAP get joined
+    padded = np.concatenate(([False], changed, [False]))
+    edges = np.flatnonzero(padded[1:] != padded[:-1])
+    starts, ends = edges[0::2], edges[1::2]
+
+    if len(starts) > 1:
+        keep = np.concatenate(([True], starts[1:] - ends[:-1] > MERGE_GAP)) # Runs that start far enough from the previous one
+        starts = starts[keep]
+        ends = np.concatenate((ends[:-1][keep[1:]], ends[-1:]))
+    return starts, ends - starts
+
+
+class DeltaEncoder():
+    led_count = 0
+    keyframe_interval = 0 # Frames between keyframes, 0 means only the first one (and after ForceKeyframe)
+    max_payload = MAX_PAYLOAD
+    previous = None
+    sequence = 0
+    frame_count = 0
+
+    def __init__(self, led_count, keyframe_interval = 100, max_payload = MAX_PAYLOAD):
+        if keyframe_interval < 0:
+            raise ValueError(f"Keyframe interval can't be negative, got {keyframe_interval}")
+        self.led_count = led_count
+        self.keyframe_interval = int(keyframe_interval)
+        self.max_payload = max_payload
+        self.previous = None
+        self.sequence = 0
+        self.frame_count = 0
+
+    def ForceKeyframe(self): # Next frame goes out in full, eg. after a seek or a reconnect
+        self.previous = None
+
+    def Encode(self, frame, timestamp): # Returns a list of packets for one (led_count, 3) frame
+        frame = np.ascontiguousarray(frame[:self.led_count], dtype=np.uint8)
+        keyframe = self.previous is None or (self.keyframe_interval > 0 and self.frame_count % self.keyframe_interval == 0)
+
+        if keyframe:
+            starts, lengths = np.array([0]), np.array([len(frame)])
+        else:
+            starts, lengths = FindRuns(np.any(frame != self.previous, axis=1))
+
+        self.previous = frame.copy()
+        self.frame_count += 1
+        return self.Packetize(frame, starts.tolist(), lengths.tolist(), int(timestamp), FLAG_KEYFRAME if keyframe else 0)
+
+    def Packetize(self, frame, starts, lengths, timestamp, flags):
+        packets = []
+        body = []
+        body_len = 0
+        runs = 0
+        room = self.max_payload - HEADER.size
+
+        def Flush(end):
+            packets.append(HEADER.pack(MAGIC, VERSION, flags | (FLAG_END if end else 0), self.sequence, timestamp & 0xFFFFFFFF, runs) + b"".join(body))
+            self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+
+        for start, length in zip(starts, lengths):
+            while length:
+                fits = (room - body_len - RUN_HEADER.size) // 3
+                if fits <= 0:
+                    Flush(False)
+                    body, body_len, runs = [], 0, 0
+                    continue
+                take = min(length, fits)
+                body.append(RUN_HEADER.pack(start, take))
+                body.append(frame[start:start + take].tobytes())
+                body_len += RUN_HEADER.size + take * 3
+                runs += 1
+                start += take
+                length -= take
+
+        Flush(True) # Even an unchanged frame gets a header only packet, the device uses it for timing
+        return packets
+
+
+class DeltaDecoder(): # What the ESP32 does, also used by the emulator
+    led_count = 0
+    state = None
+    last_sequence = None
+    packets_lost = 0
+    packets = 0
+    frames = 0
+
+    def __init__(self, led_count):
+        self.led_count = led_count
+        self.state = np.zeros((led_count, 3), dtype=np.uint8)
+        self.last_sequence = None
+        self.packets_lost = 0
+        self.packets = 0
+        self.frames = 0
+
+    def Decode(self, packet: bytes): # Applies the packet to state, returns (timestamp, flags)
+        magic, version, flags, sequence, timestamp, runs = HEADER.unpack_from(packet, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError("Not an aRGBeX packet")
+
+        if self.last_sequence is not None:
+            gap = (sequence - self.last_sequence - 1) & 0xFFFFFFFF
+            if gap < 0x80000000: # Anything "behind" us is a reordered packet, not a loss
+                self.packets_lost += gap
+        self.last_sequence = sequence
+        self.packets += 1
+
+        offset = HEADER.size
+        for _ in range(runs):
+            start, length = RUN_HEADER.unpack_from(packet, offset)
+            offset += RUN_HEADER.size
+            end = min(start + length, self.led_count)
+            if end > start:
+                self.state[start:end] = np.frombuffer(packet, dtype=np.uint8, count=(end - start) * 3, offset=offset).reshape(-1, 3)
+            offset += length * 3
+
+        if flags & FLAG_END:
+            self.frames += 1
+        return timestamp, flags
+
+
+class UdpTransport():
+    def __init__(self, host, port):
+        self.address = (host, port)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def Send(self, packet):
+        self.sock.sendto(packet, self.address)
+
+    def Close(self):
+        self.sock.close()
+
+
+class TcpTransport(): # Packets are prefixed with their u16 length, TCP has no message boundaries
+    def __init__(self, host, port):
+        self.sock = socket.create_connection((host, port))
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def Send(self, packet):
+        self.sock.sendall(struct.pack("<H", len(packet)) + packet)
+
+    def Close(self):
+        self.sock.close()
+
+
+class OutputStage(): # Sink for PlaybackScheduler, encodes every frame and pushes the packets through a transport
+    encoder: DeltaEncoder = None
+    transport = None
+    bytes_sent = 0
+    packets_sent = 0
+
+    def __init__(self, transport, led_count, keyframe_interval = 100):
+        self.transport = transport
+        self.encoder = DeltaEncoder(led_count, keyframe_interval)
+        self.bytes_sent = 0
+        self.packets_sent = 0
+
+    def __call__(self, position, frame):
+        for packet in self.encoder.Encode(frame, position):
+            self.transport.Send(packet)
+            self.bytes_sent += len(packet)
+            self.packets_sent += 1
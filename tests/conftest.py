@@ -0,0 +1,39 @@
+import sys
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+import numpy as np
+import pytest
+
+import sequence_definitions as SD
+
+
+def Selectors(): # Every kind of selector with the awkward edges, starts before the first LED, overlaps, gaps and ranks
+    yield SD.All()
+    yield SD.Range(1, 150)
+    yield SD.Range(290, 400)
+    yield SD.Range(-5, 3)
+    yield SD.ID([1, 5, 300, 301, 0])
+    for start_from in (-4, -1, 0, 1, 2, 7, 299, 300, 301):
+        for selected in (1, 2, 3):
+            for distance in (0, 1, 2, 5):
+                yield SD.Checker(start_from, selected, distance)
+    yield SD.Union(SD.Checker(0, 1, 1), SD.Range(10, 20))
+    yield SD.Intersect(SD.All(), SD.Checker(3, 2, 2))
+    yield SD.Difference(SD.All(), SD.Range(5, 250))
+    yield SD.Invert(SD.Checker(0, 1, 2))
+    yield SD.RankSelector(SD.Range(20, 80), slice(3, 40))
+    yield SD.RankSelector(SD.All(), slice(2, 300, 3))
+    yield SD.RankSelector(SD.Checker(0, 1, 2), slice(1, None, 3))
+    yield SD.RankSelector(SD.All(), np.array([0, 7, 8, 150, 299]))
+
+
+@pytest.fixture(params=list(Selectors()), ids=repr)
+def selector(request): # One test per selector
+    return request.param
+
+
+@pytest.fixture
+def selectors(): # All of them at once, for tests that pick their own
+    return list(Selectors())
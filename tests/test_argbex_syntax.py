@@ -0,0 +1,29 @@
+import pytest
+
+from argbex_syntax import ArgbexSyntaxError, ParseSource
+
+
+@pytest.mark.parametrize("source, message, line, column", [
+    ("<Sequences>\n<Nope>\n", "Unknown section <Nope>", 2, 1),
+    ("<Sequences>\nfoo_bar() {\n}\n<Playback>\n", "'_' is not allowed in names", 2, 1),
+    ("<Sequences>\nfoo() {\n    Wait(1)\n<Playback>\n", "Expected a name, found '<Playback>'", 4, 1),
+    ("<Sequences>\n<Playback>\n0:0 Static(All() Color(1 2 3))\n", "Invalid timestamp '0:0'", 3, 1),
+    ("<Sequences>\n<Playback>\n00:00:00 Static(All() { Color(1 2 3))\n", "Unexpected '{' inside Static", 3, 23),
+    ("<Sequences>\n<Playback>\n00:00:00 Static(All() Color(1 2 3)\n", "Missing ')' for Static opened at line 3, column 10", 4, 1),
+    ("<Sequences>\nfoo() {\n    loop(for 2) {\n        Wait(1)\n}\n<Playback>\n", "Expected a name, found '<Playback>'", 6, 1),
+])
+def test_error_positions(source, message, line, column):
+    with pytest.raises(ArgbexSyntaxError) as error:
+        ParseSource(source, "preset.argbex")
+    assert message in error.value.message
+    assert (error.value.line, error.value.column, error.value.path) == (line, column, "preset.argbex")
+    assert f"line {line}, column {column}" in str(error.value)
+
+
+def test_positions_of_nodes():
+    preset = ParseSource("<Sequences>\nfoo(x) {\n    loop(for x) {\n        Wait(1)\n    }\n}\n<Playback>\n00:02:00 foo(3)\n", None)
+    loop = preset.sequences[0].body[0]
+    assert (loop.line, loop.column) == (3, 5)
+    assert (loop.body[0].line, loop.body[0].column) == (4, 9)
+    call = preset.playback[0].call
+    assert (preset.playback[0].timestamp, call.line, call.column) == (2000, 8, 10)
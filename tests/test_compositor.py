@@ -0,0 +1,28 @@
+import numpy as np
+import pytest
+
+import sequence_definitions as SD
+from compositor import LayerCompositor
+
+
+def MaskComposite(layers, frame): # How Composite used to do it, every LED goes to the first layer that claims it
+    owned = np.zeros(len(frame), dtype=bool)
+    for layer in layers:
+        idx = layer.selector.GetIndices()
+        free = idx[~owned[idx]]
+        frame[free] = layer.color.GetRGB()
+        owned[free] = True
+    return frame
+
+
+@pytest.mark.parametrize("seed", range(50))
+def test_painters_order_matches_mask(seed, selectors):
+    rng = np.random.default_rng(seed)
+    compositor = LayerCompositor()
+    for _ in range(rng.integers(2, 7)):
+        color = SD.Color(*(int(value) for value in rng.integers(0, 256, 3)))
+        compositor.AddLayer(SD.TimelineData(color, selectors[rng.integers(len(selectors))], int(rng.integers(0, 3))))
+
+    frame = rng.integers(0, 256, (SD.MAX_LED, 3), dtype=np.uint8) # Whatever was there before has to survive where nothing writes
+    expected = MaskComposite(compositor.GetLayers(), frame.copy())
+    assert np.array_equal(compositor.Composite(frame.copy()), expected)
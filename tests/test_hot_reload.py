@@ -0,0 +1,44 @@
+import re
+from pathlib import Path
+
+import numpy as np
+import pytest
+from frame_buffer import RenderTimeline
+from hot_reload import IncrementalPreset
+from run_length import CompressFrameBuffer
+
+PRESETS = Path(__file__).resolve().parent.parent / "presets"
+FIELDS = ("timestamps", "keyframes", "span_offsets", "span_starts", "span_lengths", "span_colors")
+
+
+def AssertFullRender(preset: IncrementalPreset): # Incremental result has to be exactly what compressing a full render gives
+    reference = CompressFrameBuffer(RenderTimeline(preset.timeline))
+    for field in FIELDS:
+        assert np.array_equal(getattr(preset.frames, field), getattr(reference, field)), field
+
+
+@pytest.mark.parametrize("name", ["motion", "strobe", "test"])
+def test_edits_match_full_render(name):
+    path = PRESETS / f"{name}.argbex"
+    lines = path.read_text().splitlines()
+    preset = IncrementalPreset(path)
+    preset.Reload("\n".join(lines), full=True)
+    AssertFullRender(preset)
+
+    for value, i in enumerate(i for i, line in enumerate(lines) if "Color(" in line):
+        lines[i] = re.sub(r"Color\(\d+", f"Color({value * 37 % 256}", lines[i], count=1)
+        preset.Reload("\n".join(lines))
+        AssertFullRender(preset)
+
+
+def test_removed_and_added_lines():
+    path = PRESETS / "motion.argbex"
+    source = path.read_text()
+    lines = source.splitlines()
+    preset = IncrementalPreset(path)
+    preset.Reload(source, full=True)
+    for i in [i for i, line in enumerate(lines) if re.match(r"\d\d:\d\d:\d\d ", line)]:
+        preset.Reload("\n".join(lines[:i] + lines[i + 1:]))
+        AssertFullRender(preset)
+        preset.Reload(source)
+        AssertFullRender(preset)
@@ -0,0 +1,70 @@
+import numpy as np
+import pytest
+
+import sequence_definitions as SD
+from argbex_parser import ParseFile
+
+BODY = """        Static(Range(1 50) ColorShift(Color(255 0 0) Color(0 0 255) 2))
+        Wait(1)
+        Static(Range(40 80) Color(0 255 0))
+        Wait(0.5)
+"""
+
+LOOPED = {
+    "for": "    loop(for 3) {\n" + BODY + "    }\n",
+    "until": "    Wait(0.5)\n    loop(4 until) {\n" + BODY + "    }\n", # Starts at 0.5, so iterations at 0.5, 2 and 3.5 start before 4
+    "force": "    Wait(0.5)\n    loop(4 until force) {\n" + BODY + "    }\n",
+    "nested": "    loop(for 2) {\n        loop(for 2) {\n" + BODY + "        }\n        Wait(0.25)\n    }\n",
+}
+
+UNROLLED = {
+    "for": BODY * 3,
+    "until": "    Wait(0.5)\n" + BODY * 3,
+}
+
+
+def Render(tmp_path, body, lazy):
+    path = tmp_path / "loop.argbex"
+    path.write_text(f"<Sequences>\nseq() {{\n{body}    Static(All() Color(9 9 9))\n}}\n<Playback>\n00:00:00 seq()\n00:10:00 seq()\n")
+    return ParseFile(path, SD.Timeline(100, lazy=lazy)).GetFrameBuffer()
+
+
+def AssertSame(a, b):
+    assert np.array_equal(a.timestamps, b.timestamps)
+    assert np.array_equal(a.frames, b.frames)
+
+
+@pytest.mark.parametrize("kind", list(LOOPED))
+def test_lazy_matches_eager(tmp_path, kind):
+    AssertSame(Render(tmp_path, LOOPED[kind], True), Render(tmp_path, LOOPED[kind], False))
+
+
+@pytest.mark.parametrize("kind", list(UNROLLED))
+@pytest.mark.parametrize("lazy", [False, True])
+def test_loop_matches_unrolled(tmp_path, kind, lazy):
+    AssertSame(Render(tmp_path, LOOPED[kind], lazy), Render(tmp_path, UNROLLED[kind], False))
+
+
+def Merged(pairs): # {key: {led: rgb}}, pairs at the same key are merged like the timeline does it, the first one wins
+    merged = {}
+    for key, tdata in pairs:
+        leds = merged.setdefault(key, {})
+        for led, color in tdata.compositor.GetDict().items():
+            leds.setdefault(led, tuple(color.GetRGB()))
+    return merged
+
+
+@pytest.mark.parametrize("end", [None, 2500, 3000])
+def test_iter_timeline_matches_timeline(end): # Lazy iterations come out one by one where they overlap, merged they're the same
+    parts = [(0, SD.Static(SD.Range(1, 50), SD.ColorShift(SD.Color(255, 0, 0), SD.Color(0, 0, 255), 2), [])), (1000, SD.Static(SD.Range(40, 80), SD.Color(0, 255, 0), []))]
+    loop = SD.SequenceLoop(parts, 1500, 3, end)
+    lazy = list(loop.IterTimeline())
+    assert [key for key, _ in lazy] == sorted(key for key, _ in lazy)
+    assert Merged(lazy) == Merged(sorted(loop.GetTimeline().items()))
+
+
+def test_lazy_full_timeline_raises():
+    timeline = SD.Timeline(100, lazy=True)
+    timeline.Schedule(0, SD.Static(SD.All(), SD.Color(1, 2, 3), []))
+    with pytest.raises(RuntimeError, match="IterFrames or GetFrameBuffer"):
+        timeline.GetFullTimeline()
@@ -0,0 +1,63 @@
+import asyncio
+
+import numpy as np
+from playback import PlaybackScheduler
+
+
+class Frames(): # Every frame is just its own position
+    timestamps = np.array([0, 1000], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def GetFrame(self, position):
+        return position
+
+
+def Play(sink_step, max_aps = 50):
+    sent = []
+
+    async def Main():
+        scheduler = None
+
+        async def Sink(position, frame):
+            sent.append(position)
+            await sink_step(scheduler, len(sent))
+            if len(sent) >= 6:
+                scheduler.Stop()
+
+        scheduler = PlaybackScheduler(Frames(), Sink, max_aps=max_aps)
+        await asyncio.wait_for(scheduler.Run(), 5)
+
+    asyncio.run(Main())
+    return sent
+
+
+def test_resume_doesnt_resend_paused_frame():
+    async def Step(scheduler, count):
+        if count == 2:
+            scheduler.Pause()
+            asyncio.get_running_loop().call_later(0.05, scheduler.Resume)
+
+    sent = Play(Step)
+    assert sent == sorted(set(sent)) # No frame twice, nothing played backwards
+    assert sent[:2] == [0.0, 20.0]
+
+
+def test_seek_during_emit_sends_target():
+    async def Step(scheduler, count):
+        if count == 2:
+            scheduler.Seek(20) # Lands on the frame that's being emitted right now
+            await asyncio.sleep(0.01)
+
+    sent = Play(Step)
+    assert sent[:3] == [0.0, 20.0, 20.0]
+
+
+def test_seek_moves_playback():
+    async def Step(scheduler, count):
+        if count == 1:
+            scheduler.Seek(500)
+
+    sent = Play(Step)
+    assert sent[:3] == [0.0, 500.0, 520.0]
@@ -0,0 +1,46 @@
+import os
+
+import numpy as np
+import preset_cache as PC
+
+PRESET = "<Sequences>\n<Playback>\n00:00:00 Static(All() Color({red} 0 0))\n00:01:00 Static(Range(1 10) Color(0 0 255))\n"
+
+
+def Frames(frames):
+    return frames.Decompress().frames
+
+
+def test_rebuild_while_old_frames_are_mapped(tmp_path):
+    preset = tmp_path / "song.argbex"
+    preset.write_text(PRESET.format(red=255))
+    old = PC.LoadPreset(preset)
+    preset.write_text(PRESET.format(red=128))
+    new = PC.LoadPreset(preset) # The old version's file is never replaced, the new one goes next to it
+
+    assert Frames(old)[0, 20].tolist() == [255, 0, 0]
+    assert Frames(new)[0, 20].tolist() == [128, 0, 0]
+    caches = sorted(path.name for path in (tmp_path / PC.CACHE_DIR_NAME).iterdir())
+    assert caches == [PC.GetCachePath(preset, PC.PresetHash(preset.read_bytes())).name] # Old version removed once nothing needs it (here nothing stops it)
+
+
+def test_unwritable_cache_plays_from_memory(tmp_path, monkeypatch):
+    def Refuse(source, target):
+        raise PermissionError("file is mapped")
+    monkeypatch.setattr(PC.os, "replace", Refuse)
+
+    preset = tmp_path / "song.argbex"
+    preset.write_text(PRESET.format(red=255))
+    frames = PC.LoadPreset(preset)
+    assert Frames(frames)[-1, 5].tolist() == [0, 0, 255]
+    assert os.listdir(tmp_path / PC.CACHE_DIR_NAME) == [] # No tmp file left behind
+
+
+def test_same_name_presets_in_a_shared_dir(tmp_path):
+    for folder, red in (("a", 10), ("b", 20)):
+        (tmp_path / folder).mkdir()
+        (tmp_path / folder / "intro.argbex").write_text(PRESET.format(red=red))
+    cache_dir = tmp_path / "cache"
+    a = PC.LoadPreset(tmp_path / "a" / "intro.argbex", cache_dir)
+    b = PC.LoadPreset(tmp_path / "b" / "intro.argbex", cache_dir)
+    assert (Frames(a)[0, 0, 0], Frames(b)[0, 0, 0]) == (10, 20)
+    assert len(list(cache_dir.iterdir())) == 2
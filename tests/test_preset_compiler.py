@@ -0,0 +1,89 @@
+from pathlib import Path
+
+import pytest
+
+import sequence_definitions as SD
+from argbex_parser import Objectify, ParseFile
+from argbex_syntax import ArgbexSyntaxError, ParseSource
+from preset_compiler import GetConstructor
+
+PRESETS = Path(__file__).resolve().parent.parent / "presets"
+SEQUENCES = """<Sequences>
+s(x) {
+    Static(Range(x 3) Color(1 2 3))
+    Wait(1)
+}
+<Playback>
+"""
+
+
+def Load(tmp_path, playback):
+    path = tmp_path / "preset.argbex"
+    path.write_text(SEQUENCES + playback + "\n")
+    return ParseFile(path, SD.Timeline(100))
+
+
+@pytest.mark.parametrize("playback, message, line, column", [
+    ("00:00:00 Tags(a)", "isn't an action", 7, 10),
+    ("00:00:00 Static(Selector() Color(1 2 3))", "not found", 7, 17),
+    ("00:00:00 MovingAction(All() Color(1 2 3) 3 1)", "not found", 7, 10),
+    ("00:00:00 Static(RankSelector(All() 1) Color(1 2 3))", "not found", 7, 17),
+    ("00:00:00 Static(Range(a 3) Color(1 2 3))", "Invalid parameters for Range", 7, 17),
+    ("00:00:00 s(q)", "Invalid parameters for Range", 3, 12), # Only fails once the sequence runs, the position is still the call inside it
+])
+def test_constructor_errors_have_positions(tmp_path, playback, message, line, column):
+    with pytest.raises(ArgbexSyntaxError) as error:
+        Load(tmp_path, playback)
+    assert message in error.value.message
+    assert (error.value.line, error.value.column) == (line, column)
+
+
+def test_list_parameters():
+    assert GetConstructor("Tags").Build(["intro"]).tags == ["intro"] # One word is one tag, not its letters
+    assert GetConstructor("Tags").Build([["a", "b"]]).tags == ["a", "b"]
+
+
+@pytest.mark.parametrize("sequence, call, message, line, column", [
+    ("s(x) {\n    loop(for x) {\n        Wait(1)\n    }\n}", "s(abc)", "needs a number", 3, 5),
+    ("s(x) {\n    loop(for x) {\n        Wait(1)\n    }\n}", "s(1.5)", "whole number", 3, 5),
+    ("s(x) {\n    loop(x until) {\n        Static(All() Color(1 2 3))\n    }\n}", "s(2)", "never ends", 3, 5),
+    ("s(x) {\n    loop(x sometimes) {\n        Wait(1)\n    }\n}", "s(2)", "Expected loop", 3, 5),
+])
+def test_loop_errors_have_positions(tmp_path, sequence, call, message, line, column):
+    path = tmp_path / "loops.argbex"
+    path.write_text(f"<Sequences>\n{sequence}\n<Playback>\n00:00:00 {call}\n")
+    with pytest.raises(ArgbexSyntaxError) as error:
+        ParseFile(path, SD.Timeline(100)).GetFullTimeline()
+    assert message in error.value.message
+    assert (error.value.line, error.value.column) == (line, column)
+
+
+def ObjectifyFile(path): # The way presets were built before the compiler, sequences keep their raw statements and Objectify builds everything
+    preset = ParseSource(path.read_text(), path)
+    sequences = {}
+    for definition in preset.sequences:
+        sequence = SD.UserDefinedSequence(definition.name, definition.params, sequences)
+        for statement in definition.body:
+            sequence.addActionRaw(statement.ToRaw())
+        sequences[definition.name] = sequence
+
+    scheduled = []
+    for line in preset.playback:
+        if line.call.name == "nothing":
+            continue
+        action, params = Objectify(line.call.ToRaw(), sequences)
+        if isinstance(action, SD.UserDefinedSequence):
+            action = SD.SequenceCall(action, params)
+        scheduled.append((line.timestamp, action))
+    timeline = SD.Timeline(100)
+    timeline.ScheduleAll(scheduled)
+    return timeline
+
+
+def Resolved(timeline): # GetFullTimeline with plain rgb tuples, ColorData objects themselves don't compare
+    return {key: {led: tuple(color.GetRGB()) for led, color in leds.items()} for key, leds in timeline.GetFullTimeline().items()}
+
+
+@pytest.mark.parametrize("path", sorted(PRESETS.glob("*.argbex")), ids=lambda path: path.name)
+def test_compiled_matches_objectify(path):
+    assert Resolved(ParseFile(path, SD.Timeline(100))) == Resolved(ObjectifyFile(path))
@@ -0,0 +1,22 @@
+import pytest
+
+from preset_index import Normalize, NormalizeArtist
+
+
+@pytest.mark.parametrize("title, normalized", [
+    ("Mix Tape - Edit Pieces", "mix tape edit pieces"), # Words that look like tags but are part of the title
+    ("Song - Live at Wembley", "song live at wembley"),
+    ("Live Forever", "live forever"),
+    ("Hey Jude - Remastered 2015", "hey jude"),
+    ("Hey Jude - 2015 Remaster", "hey jude"),
+    ("Song - Radio Edit", "song"),
+    ("Song (Live) - Mono Version", "song"),
+    ("Don’t Stop Me Now - Live", "dont stop me now"),
+])
+def test_title_suffixes(title, normalized):
+    assert Normalize(title) == normalized
+
+
+def test_artists_keep_their_suffix():
+    assert NormalizeArtist("The Band - Live") == "the band live"
+    assert NormalizeArtist("Simon & Garfunkel") == "simon"
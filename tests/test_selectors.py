@@ -0,0 +1,14 @@
+import numpy as np
+
+import sequence_definitions as SD
+
+
+def test_write_key_matches_indices(selector):
+    written = np.zeros(SD.MAX_LED, dtype=bool)
+    written[selector.GetWriteKey()] = True
+    assert np.array_equal(np.flatnonzero(written), selector.GetIndices())
+
+
+def test_checker_before_first_led():
+    assert SD.Checker(0, 1, 1).GetIndices()[:3].tolist() == [1, 3, 5]
+    assert SD.Checker(-4, 1, 2).GetIndices()[:3].tolist() == [1, 4, 7]
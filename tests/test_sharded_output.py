@@ -0,0 +1,63 @@
+import asyncio
+import time
+
+import numpy as np
+import sharded_output as SO
+
+
+def test_discard_keeps_shared_connection_open():
+    async def Main():
+        pool = SO.ConnectionPool()
+        address = ("udp", "127.0.0.1", 17999)
+        first = await pool.Get(address)
+        assert await pool.Get(address) is first # Second link, same controller
+
+        await pool.Discard(address, first) # One link failed on it
+        assert first.IsOpen() # The other one is still sending on it
+        replacement = await pool.Get(address)
+        assert replacement is not first
+
+        await pool.Discard(address, first) # Failing late on the old one doesn't touch the new one
+        assert not first.IsOpen()
+        assert pool.connections[address] is replacement and replacement.IsOpen()
+
+        await pool.Release(address, replacement)
+        assert replacement.IsOpen() # Current connections stay open for the next song
+        await pool.Close()
+        assert not replacement.IsOpen()
+
+    asyncio.run(Main())
+
+
+def test_stop_with_stuck_controller(monkeypatch):
+    monkeypatch.setattr(SO, "IO_TIMEOUT", 0.2)
+
+    async def Main():
+        release = asyncio.Event()
+
+        async def NeverReads(reader, writer):
+            await release.wait()
+            writer.close()
+
+        server = await asyncio.start_server(NeverReads, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        leds = 20000
+        output = SO.ShardedOutput(SO.SegmentMap([SO.Controller("stuck", "127.0.0.1", port, "tcp", leds)], [SO.Segment("stuck", 1, leds)], leds))
+        frames = np.random.default_rng(0).integers(0, 256, (2, leds, 3), dtype=np.uint8) # Every LED changes every frame
+        async with output:
+            link = output.links["stuck"]
+            deadline = time.perf_counter() + 10
+            position = 0
+            while not link.stats.send_errors and time.perf_counter() < deadline:
+                output(position * 10, frames[position % 2])
+                position += 1
+                await asyncio.sleep(0.001)
+            assert link.stats.send_errors # The buffers filled up and the send timed out instead of waiting forever
+            started = time.perf_counter()
+        assert time.perf_counter() - started < 2
+        release.set()
+        await asyncio.sleep(0.01)
+        server.close()
+        await server.wait_closed()
+
+    asyncio.run(Main())
@@ -0,0 +1,36 @@
+import pytest
+
+import sequence_definitions as SD
+
+
+def ValueTypes():
+    color = SD.Color(1, 2, 3)
+    yield SD.ColorData(1, 2, 3)
+    yield color
+    yield SD.InternColor(4, 5, 6)
+    yield SD.ColorShift(color, SD.Color(7, 8, 9), 0.1)
+    yield SD.EasedShift(color, SD.Color(7, 8, 9), 0.1, "linear")
+    yield SD.TimelineData(color, SD.All())
+    yield SD.Static(SD.All(), color, [])
+    yield SD.Chase(SD.All(), color, 3, 0.1, [])
+    yield SD.Bounce(SD.All(), color, 3, 0.1, [])
+    yield SD.Sparkle(SD.All(), color, 3, 0.1, [])
+    yield SD.Wipe(SD.All(), color, 0.1, [])
+
+
+@pytest.mark.parametrize("value", list(ValueTypes()), ids=lambda value: type(value).__name__)
+def test_no_instance_dict(value):
+    assert not hasattr(value, "__dict__")
+
+
+@pytest.mark.parametrize("rgb, clamped", [
+    ((0, 256, 0), (0, 255, 0)), # Unclamped this key is 1 << 16, pure red
+    ((-1, 0, 0), (0, 0, 0)),
+    ((300, 0, 300), (255, 0, 255)),
+])
+def test_intern_color_clamps_before_key(rgb, clamped):
+    SD.color_cache.clear()
+    SD.InternColor(1, 0, 0) # Would collide with (0, 256, 0)
+    assert SD.InternColor(*rgb).GetRGB() == clamped
+    assert SD.InternColor(*rgb) is SD.InternColor(*clamped)
+    assert SD.InternColor(1, 0, 0).GetRGB() == (1, 0, 0)